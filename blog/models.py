@@ -1,5 +1,7 @@
 from django.db import models
 
+from mysite.db import ReturningSaveMixin
+
 
 class Blog(models.Model):
     name = models.CharField(max_length=100)
@@ -17,7 +19,7 @@ class Author(models.Model):
         return self.name
 
 
-class Entry(models.Model):
+class Entry(ReturningSaveMixin, models.Model):
     blog = models.ForeignKey(Blog, on_delete=models.CASCADE)
     headline = models.CharField(max_length=255)
     body_text = models.TextField()
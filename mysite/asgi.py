@@ -0,0 +1,17 @@
+"""
+ASGI config for mysite project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Django runs in a pool of threads, see mysite.asgi_handler.ASGIHandler: Django 2.1 has no async
+views or ORM, the views (OrderView, the polls views) stay synchronous.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+from mysite.asgi_handler import ASGIHandler
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+application = ASGIHandler(get_wsgi_application())
@@ -0,0 +1,112 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+class ASGIHandler:
+    """
+    ASGI 3 application serving a WSGI application (Django) from a pool of ASGI_THREADS threads.
+
+    The request body is received on the event loop, the WSGI call and the iteration of its response
+    (e.g. a streaming export) run in one thread, response chunks are sent as they are produced.
+    """
+
+    def __init__(self, wsgi_application):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(settings.ASGI_THREADS, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {}'.format(scope['type']))
+
+        body = await self.read_body(receive)
+        if body is None:
+            # the client has disconnected
+            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.run_wsgi, scope, body, send, loop)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                return body.getvalue()
+
+    def get_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+            'PATH_INFO': scope['path'].encode().decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+                name = 'HTTP_' + name
+            value = value.decode('latin1')
+            # repeated headers are joined like HTTP servers do
+            environ[name] = environ[name] + ',' + value if name in environ else value
+        return environ
+
+    def run_wsgi(self, scope, body, send, loop):
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        start = {}
+
+        def start_response(status, headers, exc_info=None):
+            start.update(
+                type='http.response.start',
+                status=int(status.split(' ', 1)[0]),
+                headers=[(name.encode('latin1'), value.encode('latin1')) for name, value in headers],
+            )
+
+        response = self.wsgi_application(self.get_environ(scope, body), start_response)
+        try:
+            started = False
+            for chunk in response:
+                if not chunk:
+                    continue
+                if not started:
+                    send_message(start)
+                    started = True
+                send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                send_message(start)
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            # fires request_finished in this thread, which closes its database connections
+            if hasattr(response, 'close'):
+                response.close()
@@ -0,0 +1,159 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connections, router
+from django.db.models import Prefetch, prefetch_related_objects
+from django.db.models.fields.related_descriptors import ReverseManyToOneDescriptor
+
+from mysite.pooled_postgresql.pool import PoolTimeout, no_wait
+from mysite.routers import get_routing_state, routing_state
+
+_executor = None
+_executor_lock = threading.Lock()
+# result of a task that got no connection, the caller runs it
+_NO_CONNECTION = object()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.ORM_CONCURRENCY_THREADS, thread_name_prefix='orm')
+        return _executor
+
+
+def in_transaction():
+    # other connections don't see uncommitted writes and have their own snapshot
+    return any(connections[alias].in_atomic_block for alias in connections)
+
+
+def get_execute_wrappers():
+    # {alias: execute wrappers of the connection}, e.g. of query guard or metrics middleware
+    return {alias: list(connections[alias].execute_wrappers) for alias in connections}
+
+
+@contextmanager
+def execute_wrappers(wrappers):
+    """
+    Queries of the connections of this thread in the block also go through `wrappers`
+    (see get_execute_wrappers), so they are measured as the queries of the thread they were taken from.
+    """
+    previous = {}
+    for alias, alias_wrappers in wrappers.items():
+        connection = connections[alias]
+        previous[alias] = connection.execute_wrappers
+        connection.execute_wrappers = alias_wrappers + previous[alias]
+    try:
+        yield
+    finally:
+        for alias, alias_wrappers in previous.items():
+            connections[alias].execute_wrappers = alias_wrappers
+
+
+def _run_task(func, state, wrappers):
+    try:
+        with routing_state(state):
+            # the caller holds a connection while it waits for the task: waiting for another one could
+            # deadlock a busy pool, so the task is handed back to the caller instead
+            try:
+                with no_wait():
+                    connections[router.db_for_read(None)].ensure_connection()
+            except OperationalError as e:
+                if not isinstance(e.__cause__, PoolTimeout):
+                    raise
+                return _NO_CONNECTION
+            with execute_wrappers(wrappers):
+                return func()
+    finally:
+        # connections are per thread, give this one back (to the pool) like at the end of a request
+        close_old_connections()
+
+
+def run_concurrently(*funcs):
+    """
+    Call blocking functions (independent database queries) at the same time, return their results.
+
+    The first one runs in the current thread, the others in a pool of ORM_CONCURRENCY_THREADS threads,
+    each with its own database connection and the execute wrappers of this thread's connections.
+    None functions give None. Inside a transaction or with ORM_CONCURRENCY_THREADS < 2 everything
+    runs here, one by one, as do the functions finding no free pooled connection.
+    """
+    calls = [(i, func) for i, func in enumerate(funcs) if func is not None]
+    results = [None] * len(funcs)
+    if len(calls) < 2 or settings.ORM_CONCURRENCY_THREADS < 2 or in_transaction():
+        for i, func in calls:
+            results[i] = func()
+        return results
+
+    (first, first_func), others = calls[0], calls[1:]
+    state = get_routing_state()
+    wrappers = get_execute_wrappers()
+    futures = [(i, func, get_executor().submit(_run_task, func, state, wrappers)) for i, func in others]
+    try:
+        results[first] = first_func()
+    finally:
+        for i, func, future in futures:
+            results[i] = future.result()
+    for i, func, future in futures:
+        if results[i] is _NO_CONNECTION:
+            results[i] = func()
+    return results
+
+
+def fetch_concurrently(queryset):
+    """
+    list(queryset) with its prefetches, the one-to-many ones (reverse foreign keys, e.g.
+    Prefetch('orderitem_set')) queried at the same time as each other.
+
+    They select the related rows of the fetched ids, like prefetch_related, so the queryset runs once
+    and every fetched row gets its related rows. Other prefetches run as usual after them.
+    Concurrent queries use separate connections, outside transactions (see run_concurrently).
+    """
+    lookups = queryset._prefetch_related_lookups
+    if not lookups or settings.ORM_CONCURRENCY_THREADS < 2 or in_transaction():
+        return list(queryset)
+
+    concurrent, other = [], []
+    for lookup in lookups:
+        prefetch = lookup if isinstance(lookup, Prefetch) else Prefetch(lookup)
+        descriptor = getattr(queryset.model, prefetch.prefetch_through, None)
+        if isinstance(descriptor, ReverseManyToOneDescriptor):
+            concurrent.append((prefetch, descriptor.rel))
+        else:
+            other.append(lookup)
+    if len(concurrent) < 2:
+        # nothing to query at the same time
+        return list(queryset)
+
+    instances = list(queryset.prefetch_related(None))
+    ids = [instance.pk for instance in instances]
+
+    def fetch_related(prefetch, rel):
+        related = prefetch.queryset if prefetch.queryset is not None else rel.related_model._default_manager.all()
+        return list(related.filter(**{rel.field.name + '__in': ids}))
+
+    results = run_concurrently(
+        *[lambda prefetch=prefetch, rel=rel: fetch_related(prefetch, rel) for prefetch, rel in concurrent]
+    ) if instances else [[] for _ in concurrent]
+    for (prefetch, rel), rows in zip(concurrent, results):
+        by_parent = defaultdict(list)
+        for row in rows:
+            by_parent[getattr(row, rel.field.attname)].append(row)
+        for instance in instances:
+            if prefetch.to_attr:
+                setattr(instance, prefetch.to_attr, by_parent[instance.pk])
+                continue
+            # what prefetch_related_objects stores for a reverse foreign key
+            related = getattr(instance, prefetch.prefetch_through).get_queryset()
+            related._result_cache = by_parent[instance.pk]
+            related._prefetch_done = True
+            if not hasattr(instance, '_prefetched_objects_cache'):
+                instance._prefetched_objects_cache = {}
+            instance._prefetched_objects_cache[rel.get_cache_name()] = related
+
+    if other:
+        prefetch_related_objects(instances, *other)
+    return instances
@@ -0,0 +1,43 @@
+from django.db import connections
+from django.db.models import sql
+
+
+class ReturningSaveMixin:
+    """
+    Model mixin for counter-like fields written as expressions, e.g. ``choice.votes = F('votes') + 1``.
+
+    On PostgreSQL the UPDATE issued by save() gets a RETURNING clause for the expression fields
+    and the resulting values are loaded back onto the instance in the same statement.
+    Other backends fall back to a refresh_from_db() of those fields.
+    """
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        expression_fields = [field for field, model, value in values if hasattr(value, 'resolve_expression')]
+        if not expression_fields:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+        connection = connections[using]
+        if connection.vendor != 'postgresql' or (self._meta.select_on_save and not forced_update):
+            updated = super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+            if updated:
+                self.refresh_from_db(using=using, fields=[field.attname for field in expression_fields])
+            return updated
+
+        # the same query QuerySet._update() builds, executed with RETURNING
+        query = base_qs.filter(pk=pk_val).query.chain(sql.UpdateQuery)
+        query.add_update_fields(values)
+        query._annotations = None
+        update_sql, params = query.get_compiler(using).as_sql()
+        returning_sql = ', '.join(connection.ops.quote_name(field.column) for field in expression_fields)
+
+        with connection.cursor() as cursor:
+            cursor.execute('{} RETURNING {}'.format(update_sql, returning_sql), params)
+            row = cursor.fetchone()
+        if row is None:
+            return False
+
+        for field, value in zip(expression_fields, row):
+            if hasattr(field, 'from_db_value'):
+                value = field.from_db_value(value, None, connection)
+            setattr(self, field.attname, value)
+        return True
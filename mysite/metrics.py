@@ -0,0 +1,223 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+from django.http import HttpResponse
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, float('inf'))
+REQUEST_LABELS = ('view', 'method', 'status', 'filters', 'ordering')
+# filters or ordering terms in a label value, more are labelled 'many'
+MAX_LABEL_TERMS = 3
+
+registry = []
+
+
+def format_labels(names, values, extra=''):
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines += self.sample_lines(label_values, value)
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def sample_lines(self, label_values, value):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, label_values), format_value(value))]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, label_values, value):
+        # per bucket (not cumulative) counts, sum
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def sample_lines(self, label_values, value):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                format_labels(self.labelnames, label_values, 'le="{}"'.format(format_value(bound))),
+                cumulative,
+            ))
+        labels = format_labels(self.labelnames, label_values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(value[-1])))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class CallbackMetric(Counter):
+    """
+    Gauge or counter read at exposition time, collect() returns {label values: value}.
+    """
+
+    def __init__(self, name, documentation, labelnames, collect, type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self.type = type
+
+    def expose(self):
+        values = self.collect()
+        with self.lock:
+            self.values = values
+        return super().expose()
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Request latency, middleware to response.', REQUEST_LABELS,
+)
+request_db_duration = Histogram(
+    'http_request_db_duration_seconds', 'Time spent in database queries per request.', REQUEST_LABELS,
+)
+request_db_queries = Counter('http_request_db_queries_total', 'Database queries.', REQUEST_LABELS)
+request_serialization_seconds = Counter(
+    'http_request_serialization_seconds_total', 'Time spent serializing response data.', REQUEST_LABELS,
+)
+
+
+class DatabaseTimer:
+    # connection.execute_wrapper counting queries and their time,
+    # also of the request's queries run by other threads (see mysite.concurrency)
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.seconds += time.perf_counter() - start
+                self.queries += 1
+
+
+@contextmanager
+def serialization_timer(request):
+    """
+    Add the time of the block to the serialization time of the request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request = getattr(request, '_request', request)  # DRF Request wraps the HttpRequest
+        request.metrics_serialization_seconds = (
+            getattr(request, 'metrics_serialization_seconds', 0.0) + time.perf_counter() - start
+        )
+
+
+def get_view_labels(view_func, params):
+    """
+    (view, filters, ordering) labels. Only names of the view's filterset filters and its ordering fields
+    are used as label values, each field once and at most MAX_LABEL_TERMS of them, so the number
+    of series stays bounded.
+    """
+    view_class = getattr(view_func, 'view_class', None)
+    view = view_class.__name__ if view_class else getattr(view_func, '__name__', 'unknown')
+
+    filterset_class = getattr(view_class, 'filterset_class', None)
+    filters = sorted(set(params) & set(filterset_class.base_filters)) if filterset_class else []
+    filters = ','.join(filters) if len(filters) <= MAX_LABEL_TERMS else 'many'
+
+    ordering = params.get('ordering', '')
+    if ordering:
+        allowed = set(getattr(view_class, 'ordering_fields', None) or ())
+        terms = OrderedDict()
+        for term in ordering.split(','):
+            # a repeated field doesn't change the order
+            terms.setdefault(term.strip().lstrip('-'), term.strip())
+        if not all(name in allowed for name in terms):
+            ordering = 'invalid'
+        elif len(terms) > MAX_LABEL_TERMS:
+            ordering = 'many'
+        else:
+            ordering = ','.join(terms.values())
+    return view, filters, ordering
+
+
+class MetricsMiddleware:
+    """
+    Record latency, database queries and time, serialization time of every request,
+    labelled by view, method, status and the filter and ordering parameters used.
+    Metrics are aggregated per process and exposed by metrics_view in Prometheus text format.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view_labels = get_view_labels(view_func, request.GET)
+
+    def __call__(self, request):
+        timer = DatabaseTimer()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(timer))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view, filters, ordering = getattr(request, 'metrics_view_labels', ('none', '', ''))
+        labels = (view, request.method, str(response.status_code), filters, ordering)
+        request_duration.observe(labels, duration)
+        request_db_duration.observe(labels, timer.seconds)
+        request_db_queries.inc(labels, timer.queries)
+        request_serialization_seconds.inc(labels, getattr(request, 'metrics_serialization_seconds', 0.0))
+        return response
+
+
+def metrics_view(request):
+    lines = [line for metric in registry for line in metric.expose()]
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,117 @@
+import threading
+
+from django.db.backends.postgresql import creation
+
+from mysite.metrics import CallbackMetric
+from mysite.postgresql import base
+from mysite.pooled_postgresql.pool import ConnectionPool
+
+# POOL key of the database settings
+DEFAULT_POOL_OPTIONS = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 10,  # seconds to wait for a free connection
+    'MAX_USES': 1000,  # checkouts before the connection is closed and replaced
+    'CHECK_AFTER': 1,  # seconds idle after which the connection is checked before use
+}
+
+# (alias, connection parameters) -> ConnectionPool
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params, options, connect):
+    key = (alias, tuple(sorted((name, str(value)) for name, value in conn_params.items())))
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None:
+            options = dict(DEFAULT_POOL_OPTIONS, **options)
+            pool = pools[key] = ConnectionPool(
+                connect,
+                min_size=options['MIN_SIZE'],
+                max_size=options['MAX_SIZE'],
+                timeout=options['TIMEOUT'],
+                max_uses=options['MAX_USES'],
+                check_after=options['CHECK_AFTER'],
+            )
+            created = True
+        else:
+            created = False
+    if created:
+        pool.fill()
+    return pool
+
+
+def close_pools(database=None):
+    """
+    Close idle connections of all pools (of `database` only if given) and forget those pools.
+    """
+    with pools_lock:
+        closed = [key for key in pools if database is None or ('database', database) in key[1]]
+        closing = [pools.pop(key) for key in closed]
+    for pool in closing:
+        pool.close()
+
+
+def pool_utilization():
+    """
+    {(alias, database): ConnectionPool.utilization()}
+    """
+    with pools_lock:
+        items = list(pools.items())
+    return {(alias, dict(params)['database']): pool.utilization() for (alias, params), pool in items}
+
+
+def collect(*fields):
+    def collect_fields():
+        return {
+            (alias, database, field) if len(fields) > 1 else (alias, database): stats[field]
+            for (alias, database), stats in pool_utilization().items() for field in fields
+        }
+    return collect_fields
+
+
+CallbackMetric('db_pool_connections', 'Open pooled connections by state.', ('alias', 'database', 'state'),
+               collect('idle', 'in_use'))
+CallbackMetric('db_pool_max_connections', 'Pool size limit.', ('alias', 'database'), collect('max_size'))
+CallbackMetric('db_pool_checkouts_total', 'Connections taken from the pool.', ('alias', 'database'),
+               collect('checkouts'), type='counter')
+CallbackMetric('db_pool_timeouts_total', 'Checkouts failed waiting for a free connection.', ('alias', 'database'),
+               collect('timeouts'), type='counter')
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # pooled connections would keep the test database in use
+        close_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend taking connections from an in-process ConnectionPool, configured with the POOL
+    key of the database settings (see DEFAULT_POOL_OPTIONS). Closing the connection, e.g. at the end
+    of a request with CONN_MAX_AGE = 0, returns it to the pool.
+    """
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(
+            self.alias, conn_params, self.settings_dict.get('POOL', {}),
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+        )
+        connection = pool.get()
+        self.pool = pool
+        # set by the parent's get_new_connection when the connection is opened
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if self.in_atomic_block:
+            # the connection stays attached to this wrapper until the atomic block exits
+            with self.wrap_database_errors:
+                return self.pool.discard(self.connection)
+        with self.wrap_database_errors:
+            self.pool.put(self.connection)
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+_local = threading.local()
+
+# connections inherited from the parent process: never used nor closed, closing them
+# would terminate the parent's sessions sharing the same sockets
+_forked_away = []
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+@contextmanager
+def no_wait():
+    """
+    Connections taken from pools by this thread in the block are never waited for,
+    get() raises PoolTimeout at once when all are in use.
+    """
+    previous = getattr(_local, 'no_wait', False)
+    _local.no_wait = True
+    try:
+        yield
+    finally:
+        _local.no_wait = previous
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Idle connections are reused last in, first out. A connection idle for more than `check_after` seconds
+    is checked with SELECT 1 before it's handed out, one used `max_uses` times is closed instead
+    of returned to the pool. get() waits up to `timeout` seconds when `max_size` connections are in use
+    (not at all inside no_wait()).
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, timeout=10, max_uses=1000, check_after=1):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.check_after = check_after
+        self.condition = threading.Condition()
+        self.stats = dict.fromkeys(
+            ('checkouts', 'waits', 'timeouts', 'created', 'recycled', 'failed_checks'), 0,
+        )
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = deque()  # (connection, returned at)
+        self.uses = {}  # connection -> number of checkouts, for all open connections
+        self.size = 0  # open connections, idle and in use
+        self.closed = False
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            _forked_away.extend(self.uses)
+            self._reset()
+
+    def fill(self):
+        # open connections up to min_size
+        while True:
+            with self.condition:
+                self._check_fork()
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            self.put(self._open(), checked_out=False)
+
+    def _open(self):
+        try:
+            connection = self.connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.uses[connection] = 0
+            self.stats['created'] += 1
+        return connection
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not connection.autocommit:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def get(self):
+        timeout = 0 if getattr(_local, 'no_wait', False) else self.timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            connection = None
+            with self.condition:
+                self._check_fork()
+                while not self.idle and self.size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if timeout:
+                            self.stats['timeouts'] += 1
+                        raise PoolTimeout('No connection available in {} seconds, {} in use'.format(
+                            timeout, self.size,
+                        ))
+                    self.stats['waits'] += 1
+                    self.condition.wait(remaining)
+                if self.idle:
+                    connection, returned_at = self.idle.pop()
+                else:
+                    self.size += 1
+
+            if connection is None:
+                connection = self._open()
+            elif time.monotonic() - returned_at > self.check_after and not self._is_healthy(connection):
+                with self.condition:
+                    self.stats['failed_checks'] += 1
+                self.discard(connection)
+                continue
+
+            with self.condition:
+                self.uses[connection] += 1
+                self.stats['checkouts'] += 1
+            return connection
+
+    def put(self, connection, checked_out=True):
+        """
+        Return a connection taken with get(), a transaction in progress is rolled back.
+        """
+        with self.condition:
+            if connection not in self.uses:
+                # taken before a fork, not ours anymore
+                return
+        if self.closed:
+            self.discard(connection)
+            return
+        if checked_out and self.uses[connection] >= self.max_uses:
+            with self.condition:
+                self.stats['recycled'] += 1
+            self.discard(connection)
+            return
+        try:
+            status = connection.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                raise psycopg2.InterfaceError('connection is broken')
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            self.discard(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self.condition:
+            if connection in self.uses:
+                del self.uses[connection]
+                self.size -= 1
+            self.condition.notify()
+
+    def close(self):
+        """
+        Close idle connections, connections in use are closed when they are returned.
+        """
+        with self.condition:
+            self._check_fork()
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+        for connection, returned_at in idle:
+            self.discard(connection)
+
+    def utilization(self):
+        with self.condition:
+            return dict(
+                self.stats,
+                size=self.size,
+                idle=len(self.idle),
+                in_use=self.size - len(self.idle),
+                max_size=self.max_size,
+            )
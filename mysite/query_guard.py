@@ -0,0 +1,125 @@
+import logging
+import re
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?\b')
+LIST_RE = re.compile(r'([(\[])\s*\?(?:\s*,\s*\?)*\s*([)\]])')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def normalize_sql(sql):
+    """
+    Shape of a query: literals and placeholders replaced with ?, IN lists and arrays collapsed.
+    """
+    sql = STRING_RE.sub('?', sql.replace('%s', '?'))
+    sql = NUMBER_RE.sub('?', sql)
+    sql = LIST_RE.sub(r'\1?\2', sql)
+    return ' '.join(sql.split())
+
+
+class QueryCapture:
+    """
+    Context manager recording SQL executed on all (or `using`) connections of the current thread.
+    Works with DEBUG off, unlike connection.queries.
+    """
+
+    def __init__(self, using=None):
+        self.aliases = [using] if using else list(connections)
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for alias in self.aliases:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def shapes(self):
+        return Counter(normalize_sql(sql) for sql in self.queries)
+
+    def problems(self, budget=None, repeat_threshold=None):
+        """
+        Messages for a query count above `budget` and for shapes repeated more than `repeat_threshold` times.
+        """
+        if repeat_threshold is None:
+            repeat_threshold = settings.QUERY_GUARD_REPEAT_THRESHOLD
+        problems = []
+        if budget is not None and len(self.queries) > budget:
+            problems.append('{} queries, the budget is {}'.format(len(self.queries), budget))
+        for shape, count in self.shapes.most_common():
+            if count <= repeat_threshold:
+                break
+            problems.append('{} times (N+1?): {}'.format(count, shape))
+        return problems
+
+
+class QueryGuardMiddleware:
+    """
+    Opt-in middleware checking the queries of every request against the view's `query_budget`
+    and QUERY_GUARD_REPEAT_THRESHOLD. Raises QueryBudgetExceeded with QUERY_GUARD_RAISE,
+    logs a warning otherwise. Queries of streaming responses run after the view returns and aren't counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(getattr(view_func, 'view_class', None), 'query_budget', None)
+
+    def __call__(self, request):
+        with QueryCapture() as capture:
+            response = self.get_response(request)
+
+        problems = capture.problems(getattr(request, 'query_budget', None))
+        if problems:
+            message = '{} {}: {}'.format(request.method, request.path, '; '.join(problems))
+            if settings.QUERY_GUARD_RAISE:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+
+class QueryGuardTestMixin:
+    """
+    TestCase mixin asserting on query budgets and repeated query shapes.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, budget=None, repeat_threshold=None):
+        with QueryCapture() as capture:
+            yield capture
+        problems = capture.problems(budget, repeat_threshold)
+        if problems:
+            self.fail('\n'.join(problems))
+
+    def assertConstantQueries(self, func, sizes):
+        """
+        func(size) runs the same number of queries for every size.
+        """
+        counts = {}
+        for size in sizes:
+            with QueryCapture() as capture:
+                func(size)
+            counts[size] = len(capture)
+        if len(set(counts.values())) > 1:
+            self.fail('Query count depends on size: {}'.format(counts))
@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+# seconds the replica is behind, 0 when it has replayed everything it received, NULL before the first replay
+LAG_SQL = (
+    'SELECT CASE '
+    'WHEN NOT pg_is_in_recovery() THEN 0 '
+    'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+STICKY_COOKIE = 'use_primary'
+
+_state = threading.local()
+# alias -> (monotonic time of the check, lag in seconds or None), shared by the threads
+_lags = {}
+_lags_lock = threading.Lock()
+
+
+def measure_replica_lag(alias):
+    """
+    Replication lag of `alias` in seconds, None if it can't be measured.
+    """
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        return None
+    return None if lag is None else float(lag)
+
+
+def get_replica_lag(alias):
+    with _lags_lock:
+        checked = _lags.get(alias)
+    now = time.monotonic()
+    if checked is None or now - checked[0] >= settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL:
+        # measured without the lock, threads checking at the same time measure it more than once
+        checked = (now, measure_replica_lag(alias))
+        with _lags_lock:
+            _lags[alias] = checked
+    return checked[1]
+
+
+def get_healthy_replicas():
+    healthy = []
+    for alias in settings.DATABASE_REPLICAS:
+        lag = get_replica_lag(alias)
+        if lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG:
+            healthy.append(alias)
+    return healthy
+
+
+@contextmanager
+def replica_reads():
+    """
+    Reads in the block go to a replica (the same one for the whole block), writes to the primary.
+    """
+    previous = (getattr(_state, 'replica_reads', False), getattr(_state, 'alias', None),
+                getattr(_state, 'wrote', False))
+    _state.replica_reads, _state.alias, _state.wrote = True, None, False
+    try:
+        yield
+    finally:
+        wrote = _state.wrote
+        _state.replica_reads, _state.alias, _state.wrote = previous
+        # and the enclosing block or request wrote, see PrimaryStickinessMiddleware
+        _state.wrote = _state.wrote or wrote
+
+
+@contextmanager
+def primary_reads():
+    """
+    Reads in the block go to the primary, e.g. results cached under the current data version:
+    a lagging replica would store data from before the change that bumped it.
+    """
+    previous = getattr(_state, 'replica_reads', False)
+    _state.replica_reads = False
+    try:
+        yield
+    finally:
+        _state.replica_reads = previous
+
+
+def get_routing_state():
+    """
+    Routing state of this thread, for threads doing a part of its work (see mysite.concurrency).
+    """
+    if getattr(_state, 'replica_reads', False) and getattr(_state, 'alias', None) is None:
+        # choose the replica now, so every thread reads from the same one
+        ReplicaRouter().db_for_read(None)
+    return dict(_state.__dict__)
+
+
+@contextmanager
+def routing_state(state):
+    previous = dict(_state.__dict__)
+    _state.__dict__.update(state)
+    try:
+        yield
+    finally:
+        _state.__dict__.clear()
+        _state.__dict__.update(previous)
+
+
+def iter_with_replica_reads(iterable):
+    # streaming responses are iterated after the view has returned
+    with replica_reads():
+        yield from iterable
+
+
+class ReplicaReadMixin:
+    """
+    View mixin sending the queries of the view to a replica, see ReplicaRouter.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Reads inside replica_reads() go to one of the DATABASE_REPLICAS whose lag is below
+    DATABASE_REPLICA_MAX_LAG, everything else to the primary ('default'). After a write, and for
+    DATABASE_PRIMARY_STICKY_SECONDS after a request that could write (see PrimaryStickinessMiddleware),
+    reads stay on the primary so they see that write.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'replica_reads', False) or _state.wrote or getattr(_state, 'sticky', False):
+            return None
+        if _state.alias is None:
+            replicas = get_healthy_replicas()
+            _state.alias = random.choice(replicas) if replicas else 'default'
+        return _state.alias
+
+    def db_for_write(self, model, **hints):
+        # explicitly, instances read from a replica would be written back to it otherwise
+        _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class PrimaryStickinessMiddleware:
+    """
+    Pin the reads of a client to the primary for DATABASE_PRIMARY_STICKY_SECONDS after its successful
+    unsafe request that wrote to the database.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.sticky = STICKY_COOKIE in request.COOKIES
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            wrote = _state.wrote
+        finally:
+            _state.sticky = _state.wrote = False
+        if wrote and response.status_code < 400 and request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
+            response.set_cookie(STICKY_COOKIE, '1', max_age=settings.DATABASE_PRIMARY_STICKY_SECONDS)
+        return response
@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mysite.metrics.MetricsMiddleware',
+    'mysite.routers.PrimaryStickinessMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,25 +78,76 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'mysite.wsgi.application'
 
+# mysite.asgi: threads running Django for ASGI requests
+ASGI_THREADS = 64
+# mysite.concurrency: threads running independent queries of a request at the same time, < 2 - disabled.
+# They share the POOL connections with ASGI_THREADS: a query finding none free runs in the request's thread
+ORM_CONCURRENCY_THREADS = 16
+
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
+# mysite.pooled_postgresql: connections are taken from an in-process pool and returned at the end of requests,
+# mysite.postgresql without the pool. Both list the partitioned tables, see shop.checks
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'mysite.pooled_postgresql',
         'NAME': 'dj21',
         'USER': 'dj21',
         'PASSWORD': 'dj21',
         'HOST': '127.0.0.1',
         'PORT': '5432',
+        'POOL': {
+            'MIN_SIZE': 1,
+            'MAX_SIZE': 10,
+            'TIMEOUT': 10,
+            'MAX_USES': 1000,
+            'CHECK_AFTER': 1,
+        },
     },
 }
 
+# mysite.routers: reads of list and export views go to replicas, e.g. DATABASE_REPLICAS = ['replica'] with
+# DATABASES['replica'] = {<connection of the standby>, 'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['mysite.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_MAX_LAG = 5  # seconds, a replica lagging more is out of rotation
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = 5  # seconds
+DATABASE_PRIMARY_STICKY_SECONDS = 10  # reads of a client stay on the primary after its write request
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 100
 }
 
+# shop.access: in-process cache of per-user allowed statuses and favorite manufacturers
+SHOP_ACCESS_CONTEXT_CACHE_SIZE = 1024
+SHOP_ACCESS_CONTEXT_TTL = 60  # seconds
+
+# shop.views: OrderView ?search= matches the SKUs of up to this many products (the best ranked)
+SHOP_SEARCH_PRODUCTS_LIMIT = 1000
+
+# shop.views.OrderView serializer: 'model' - OrderSerializer, 'values' - OrderValuesSerializer
+SHOP_ORDER_SERIALIZATION = 'model'
+
+# shop.counting: OrderView ?count=true, exact below the threshold of planner-estimated rows
+SHOP_EXACT_COUNT_THRESHOLD = 50000
+SHOP_COUNT_CACHE_TTL = 300  # seconds
+
+# shop.response_cache: OrderView responses, invalidated by any order data change, 0 - disabled.
+# Concurrent identical requests are computed once per cache. Enable it with a shared backend (memcached, redis)
+# when there are several processes: with the default per-process locmem cache, changes made by other processes
+# (other workers, the reprice_products and reconcile_order_totals commands) are served stale for up to the TTL.
+# Requests are coalesced with a cache.add() lock, with file locks for the file based backend
+SHOP_RESPONSE_CACHE = 'default'
+SHOP_RESPONSE_CACHE_TTL = 0  # seconds
+SHOP_RESPONSE_CACHE_LOCK_TIMEOUT = 10  # seconds
+
+# mysite.query_guard: opt in by adding 'mysite.query_guard.QueryGuardMiddleware' to MIDDLEWARE,
+# requests over the view's query_budget or repeating a query shape more than the threshold fail or log a warning
+QUERY_GUARD_REPEAT_THRESHOLD = 10
+QUERY_GUARD_RAISE = DEBUG
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
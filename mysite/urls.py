@@ -16,9 +16,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from mysite.metrics import metrics_view
+
 
 urlpatterns = [
     path('polls/', include('polls.urls')),
     path('shop/', include('shop.urls')),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
 ]
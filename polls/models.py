@@ -3,6 +3,8 @@ import datetime
 from django.db import models
 from django.utils import timezone
 
+from mysite.db import ReturningSaveMixin
+
 
 class Question(models.Model):
     question_text = models.CharField(max_length=200)
@@ -20,7 +22,7 @@ class Question(models.Model):
     was_published_recently.short_description = 'Published recently?'
 
 
-class Choice(models.Model):
+class Choice(ReturningSaveMixin, models.Model):
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice_text = models.CharField(max_length=200)
     votes = models.IntegerField(default=0)
@@ -1,10 +1,11 @@
 import datetime
 
+from django.db.models import F
 from django.test import TestCase
 from django.urls import reverse
 from django.utils import timezone
 
-from .models import Question
+from .models import Choice, Question
 
 
 def create_question(question_text, days):
@@ -95,3 +96,27 @@ class QuestionDetailViewTests(TestCase):
         url = reverse('polls:detail', args=(past_question.id,))
         response = self.client.get(url)
         self.assertContains(response, past_question.question_text)
+
+
+class VoteViewTests(TestCase):
+    def test_vote(self):
+        """
+        A vote increments the choice counter in the database.
+        """
+        question = create_question(question_text='Past Question.', days=-5)
+        choice = Choice.objects.create(question=question, choice_text='Choice', votes=2)
+        response = self.client.post(reverse('polls:vote', args=(question.id,)), {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:results', args=(question.id,)))
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 3)
+
+    def test_expression_save_loads_value(self):
+        """
+        Saving an expression-valued counter leaves the computed value on the instance.
+        """
+        question = create_question(question_text='Past Question.', days=-5)
+        choice = Choice.objects.create(question=question, choice_text='Choice', votes=2)
+        choice.votes = F('votes') + 1
+        with self.assertNumQueries(1):
+            choice.save(update_fields=['votes'])
+        self.assertEqual(choice.votes, 3)
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from mysite.concurrency import run_concurrently
+from shop.models import User
+
+# resolved per-user scope for the order list:
+# status_ids - statuses of the user's allowed status groups
+# favorite_manufacturer_ids - ids from User.favorite_manufactures
+AccessContext = namedtuple('AccessContext', ('user_id', 'status_ids', 'favorite_manufacturer_ids'))
+
+
+class TTLLRUCache:
+    """
+    Thread-safe in-process LRU cache, entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+access_context_cache = TTLLRUCache(
+    maxsize=getattr(settings, 'SHOP_ACCESS_CONTEXT_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'SHOP_ACCESS_CONTEXT_TTL', 60),
+)
+
+
+def load_access_context(user_id):
+    # LEFT JOIN through allowed_groups: [] - no such user, [None] - user without statuses
+    status_ids, favorite_manufacturer_ids = run_concurrently(
+        lambda: list(User.objects.filter(id=user_id).values_list('allowed_groups__orderstatus__id', flat=True)),
+        lambda: list(User.favorite_manufactures.through.objects.filter(
+            user_id=user_id,
+        ).values_list('manufacturer_id', flat=True)),
+    )
+    if not status_ids:
+        raise User.DoesNotExist('User matching query does not exist.')
+
+    return AccessContext(
+        user_id=user_id,
+        status_ids=tuple(sorted(set(status_ids) - {None})),
+        favorite_manufacturer_ids=tuple(sorted(set(favorite_manufacturer_ids))),
+    )
+
+
+def get_access_context(user_id):
+    context = access_context_cache.get(user_id)
+    if context is None:
+        context = load_access_context(user_id)
+        access_context_cache.set(user_id, context)
+    return context
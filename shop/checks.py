@@ -0,0 +1,19 @@
+from django.core import checks
+from django.db import connections
+
+
+@checks.register()
+def check_partitioned_tables(app_configs, **kwargs):
+    """
+    shop_orderitem is partitioned (migration 0007), the stock PostgreSQL backend doesn't list it
+    and flush would leave its rows.
+    """
+    errors = []
+    for alias in connections:
+        if not getattr(connections[alias].introspection, 'lists_partitioned_tables', False):
+            errors.append(checks.Error(
+                'The {} database backend does not list partitioned tables.'.format(alias),
+                hint="Use the 'mysite.postgresql' or 'mysite.pooled_postgresql' ENGINE.",
+                id='shop.E001',
+            ))
+    return errors
@@ -0,0 +1,66 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+
+from shop.response_cache import get_data_version
+
+
+def table_row_estimate(model, using='default'):
+    # planner statistics, kept fresh by (auto)vacuum/analyze
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    return max(int(row[0]), 0) if row else 0
+
+
+def planner_row_estimate(queryset):
+    """
+    Number of rows the planner expects `queryset` to return, from EXPLAIN (FORMAT JSON).
+    """
+    queryset = queryset.order_by()
+    if not queryset.query.where and not queryset.query.annotations:
+        return table_row_estimate(queryset.model, queryset.db)
+
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def make_count_cache_key(*parts):
+    # exact counts are invalidated with the cached responses, by any order data change
+    data = json.dumps([get_data_version()] + list(parts), sort_keys=True, default=str)
+    return 'shop:count:' + hashlib.md5(data.encode()).hexdigest()
+
+
+def get_result_count(queryset, cache_key, exact_allowed=True):
+    """
+    Return (count, is_exact) for `queryset`, cached under `cache_key`.
+
+    Counts are exact when `exact_allowed` (no filter that makes counting expensive) and the
+    planner expects at most SHOP_EXACT_COUNT_THRESHOLD rows, otherwise it's the planner estimate.
+    """
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
+
+    try:
+        estimate = planner_row_estimate(queryset)
+    except EmptyResultSet:
+        # e.g. status__in=[], nothing matches and there is no SQL to explain
+        result = (0, True)
+    else:
+        if exact_allowed and estimate <= settings.SHOP_EXACT_COUNT_THRESHOLD:
+            result = (queryset.count(), True)
+        else:
+            result = (estimate, False)
+
+    cache.set(cache_key, result, settings.SHOP_COUNT_CACHE_TTL)
+    return result
@@ -1,46 +1,103 @@
 from datetime import timedelta, date
-from random import randint, choice
+from random import randint, choice, sample
 
 import factory.fuzzy
+from django.db import connection, transaction
 from django.db.models import Sum
 
-from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Product, Manufacturer
+from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Product, Manufacturer, DailySales
 
 
-class UserFactory(factory.DjangoModelFactory):
+def random_existing(model):
+    # queried on every build: factory.Iterator keeps the rows it has seen, even of a dropped test database
+    return factory.LazyFunction(lambda: model.objects.order_by('?').first())
+
+
+class BulkModelFactory(factory.DjangoModelFactory):
+    """
+    Factory with a batch mode: create_bulk(size) builds instances in memory
+    and inserts them with a single bulk_create, post-generation hooks run in build mode only.
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def bulk_related(cls):
+        # field name -> existing instances to choose from, loaded once per batch
+        return {}
+
+    @classmethod
+    def build_bulk(cls, size, **kwargs):
+        related = {name: objs for name, objs in cls.bulk_related().items() if name not in kwargs}
+        return [
+            cls.build(**dict({name: choice(objs) for name, objs in related.items()}, **kwargs))
+            for _ in range(size)
+        ]
+
+    @classmethod
+    def create_bulk(cls, size, **kwargs):
+        return cls._meta.model.objects.bulk_create(cls.build_bulk(size, **kwargs))
+
+
+class UserFactory(BulkModelFactory):
     class Meta:
         model = User
 
     @factory.post_generation
-    def gen_status_groups_and_favorite_manufacturers(self, *args, **kwargs):
+    def gen_status_groups_and_favorite_manufacturers(self, create, *args, **kwargs):
+        if not create:
+            return
         man_ids = Manufacturer.objects.values_list('id', flat=True)
         self.favorite_manufactures.set([choice(man_ids) for _ in range(randint(1, 10))])
 
         st_groups_ids = StatusGroup.objects.values_list('id', flat=True)
         self.allowed_groups.set([choice(st_groups_ids) for _ in range(randint(1, 2))])
 
-
-class ManufacturerFactory(factory.DjangoModelFactory):
+    @classmethod
+    def create_bulk(cls, size, **kwargs):
+        man_ids = list(Manufacturer.objects.values_list('id', flat=True))
+        st_groups_ids = list(StatusGroup.objects.values_list('id', flat=True))
+        favorites_model = User.favorite_manufactures.through
+        groups_model = User.allowed_groups.through
+
+        with transaction.atomic():
+            users = super().create_bulk(size, **kwargs)
+            favorites_model.objects.bulk_create([
+                favorites_model(user_id=user.id, manufacturer_id=man_id)
+                for user in users for man_id in sample(man_ids, min(randint(1, 10), len(man_ids)))
+            ])
+            groups_model.objects.bulk_create([
+                groups_model(user_id=user.id, statusgroup_id=group_id)
+                for user in users for group_id in sample(st_groups_ids, min(randint(1, 2), len(st_groups_ids)))
+            ])
+        return users
+
+
+class ManufacturerFactory(BulkModelFactory):
     class Meta:
         model = Manufacturer
 
     name = factory.Faker('name')
 
 
-class ProductFactory(factory.DjangoModelFactory):
+class ProductFactory(BulkModelFactory):
     class Meta:
         model = Product
 
     sku = factory.fuzzy.FuzzyText()
     price = factory.fuzzy.FuzzyInteger(10, 100)
-    manufacturer = factory.Iterator(Manufacturer.objects.all())
+    manufacturer = random_existing(Manufacturer)
 
+    @classmethod
+    def bulk_related(cls):
+        return {'manufacturer': list(Manufacturer.objects.all())}
 
-class OrderItemFactory(factory.DjangoModelFactory):
+
+class OrderItemFactory(BulkModelFactory):
     class Meta:
         model = OrderItem
 
-    product = factory.Iterator(Product.objects.all())
+    product = random_existing(Product)
     price = factory.fuzzy.FuzzyInteger(10, 100)
 
     @factory.post_generation
@@ -50,21 +107,74 @@ class OrderItemFactory(factory.DjangoModelFactory):
         self.price = self.product.price
 
 
-class OrderFactory(factory.DjangoModelFactory):
+class OrderFactory(BulkModelFactory):
     class Meta:
         model = Order
 
     number = factory.fuzzy.FuzzyText()
     delivery_price = factory.fuzzy.FuzzyInteger(10, 50)
-    status = factory.Iterator(OrderStatus.objects.all())
+    status = random_existing(OrderStatus)
+
+    @classmethod
+    def build_items(cls, order, products):
+        # distinct products, an order has one item per product
+        return [
+            OrderItemFactory.build(order=order, product=product)
+            for product in sample(products, min(randint(3, 10), len(products)))
+        ]
 
     @factory.post_generation
     def gen_order_items(self, create, extracted=True, **kwargs):
-        if extracted is False:
+        if not create or extracted is False:
             return
-        for _ in range(randint(3, 10)):
-            OrderItemFactory.build(order=self).save()
+        OrderItem.objects.bulk_add(self.build_items(self, list(Product.objects.all())))
 
     @factory.post_generation
     def set_update_created_date(self, create, extracted, **kwargs):
         self.created = (self.created or date.today()) - timedelta(days=randint(1, 365))
+
+    @classmethod
+    def bulk_related(cls):
+        return {'status': list(OrderStatus.objects.all())}
+
+    @classmethod
+    def create_bulk(cls, size, gen_order_items=True, **kwargs):
+        """
+        Create `size` orders with their items in a fixed number of queries. Item aggregates are
+        computed here instead of by OrderItem.save / bulk_add, total_price is set by the database
+        triggers and computed here for the instances.
+        """
+        products = list(Product.objects.all()) if gen_order_items else []
+        orders = cls.build_bulk(size, **kwargs)
+        items = []
+        for order in orders:
+            order_items = cls.build_items(order, products) if gen_order_items else []
+            order.total_price = order.delivery_price + sum(item.price for item in order_items)
+            order.product_ids = sorted(item.product_id for item in order_items)
+            order.manufacturer_ids = sorted({item.product.manufacturer_id for item in order_items})
+            order.mismatched_items = sum(item.price != item.product.price for item in order_items)
+            items += order_items
+        if not orders:
+            return orders
+
+        created = [order.created for order in orders]
+        with transaction.atomic():
+            Order.objects.bulk_create(orders)
+            # created is auto_now_add, bulk_create has replaced the generated dates with today
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'UPDATE {order_table} O SET created = V.created '
+                    'FROM (VALUES {values}) V (id, created) WHERE O.id = V.id'.format(
+                        order_table=Order._meta.db_table,
+                        values=', '.join(['(%s, %s::date)'] * len(orders)),
+                    ),
+                    [value for order, order_created in zip(orders, created) for value in (order.id, order_created)]
+                )
+            for order, order_created in zip(orders, created):
+                order.created = order_created
+            for item in items:
+                # order ids are known only now
+                item.order = item.order
+            OrderItem.objects.bulk_create(items)
+            DailySales.objects.add_orders([order.id for order in orders])
+        return orders
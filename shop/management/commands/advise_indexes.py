@@ -0,0 +1,390 @@
+import datetime
+import hashlib
+import json
+import re
+import statistics
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.test.utils import CaptureQueriesContext
+
+from shop.management.commands.benchmark_order_filters import Command as BenchmarkCommand
+
+SCAN_NODES = ('Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan')
+JOIN_CONDITIONS = ('Hash Cond', 'Merge Cond', 'Join Filter')
+# estimated / actual rows of a filtered scan beyond which extended statistics are proposed
+MISESTIMATE_RATIO = 10
+# a scan returning more columns isn't turned into an index-only scan
+MAX_COVERING_COLUMNS = 3
+
+MIGRATION_TEMPLATE = '''# Generated by advise_indexes on {created}
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        {dependencies}
+    ]
+
+    operations = [
+{operations}
+    ]
+'''
+
+
+def parse_query_log(content):
+    """
+    SQL statements of a query log: PostgreSQL log lines ("... statement: SELECT ...")
+    or statements separated by semicolons.
+    """
+    statements = re.findall(r'(?:statement|execute [^:]*): (.*)$', content, re.M)
+    if not statements:
+        statements = content.split(';\n')
+    return [sql.strip().rstrip(';') for sql in statements if sql.strip().upper().startswith(('SELECT', 'WITH'))]
+
+
+def iter_nodes(plan, parent=None):
+    yield plan, parent
+    for child in plan.get('Plans', []):
+        yield from iter_nodes(child, plan)
+
+
+def column_conditions(alias, condition):
+    """
+    Columns of `alias` compared with constants in `condition`: (equality columns, range columns).
+    """
+    prefix = r'\b{}\.(\w+)'.format(re.escape(alias))
+    equality = re.findall(prefix + r' = (?:ANY \()?[\'\d(]', condition)
+    ranges = [column for column in re.findall(prefix + r' [<>]=? ', condition) if column not in equality]
+    return unique(equality), unique(ranges)
+
+
+def partial_predicates(alias, condition):
+    # conditions selecting a small part of the table that a partial index can be limited to
+    return re.findall(r'\({}\.(\w+ (?:> 0|<> 0|IS NOT NULL))\)'.format(re.escape(alias)), condition)
+
+
+def unique(columns):
+    return list(dict.fromkeys(columns))
+
+
+class Candidate:
+    def __init__(self, kind, table, columns, include=(), where=None):
+        self.kind = kind
+        self.table = table
+        self.columns = tuple(columns)
+        self.include = tuple(column for column in include if column not in columns)
+        self.where = where
+        self.queries = set()
+        self.report = None  # measurements, see Command.measure
+        digest = hashlib.md5(repr((kind, table, self.columns, self.include, where)).encode()).hexdigest()
+        prefix = '{}_{}'.format(table, '_'.join(self.columns)) if kind != 'statistics' else table + '_stat'
+        self.name = '{}_{}'.format(prefix[:52], digest[:8])
+
+    @property
+    def key(self):
+        return self.kind, self.table, self.columns, self.include, self.where
+
+    def create_sql(self, concurrently=False, table=None, name=None):
+        if self.kind == 'statistics':
+            return 'CREATE STATISTICS {} (dependencies, ndistinct) ON {} FROM {}'.format(
+                self.name, ', '.join(self.columns), self.table,
+            )
+        return 'CREATE INDEX {}{} ON {} ({}){}{}'.format(
+            'CONCURRENTLY ' if concurrently else '',
+            name or self.name,
+            table or self.table,
+            ', '.join(self.columns),
+            ' INCLUDE ({})'.format(', '.join(self.include)) if self.include else '',
+            ' WHERE {}'.format(self.where) if self.where else '',
+        )
+
+    def drop_sql(self):
+        return 'DROP {} IF EXISTS {}'.format('STATISTICS' if self.kind == 'statistics' else 'INDEX', self.name)
+
+    def migration_sql(self, partitions):
+        """
+        (forward statements, reverse statements) for a migration.
+        """
+        if self.kind == 'statistics':
+            return [self.create_sql()], [self.drop_sql()]
+        if not partitions:
+            return [self.create_sql(concurrently=True)], ['DROP INDEX CONCURRENTLY IF EXISTS {}'.format(self.name)]
+        # indexes of a partitioned table can't be created concurrently: the index of every partition is,
+        # then they are attached to the (invalid until then) index of the table
+        forward = [self.create_sql(table='ONLY ' + self.table)]
+        for i, partition in enumerate(partitions):
+            forward.append(self.create_sql(concurrently=True, table=partition, name='{}_p{}'.format(self.name[:55], i)))
+            forward.append('ALTER INDEX {} ATTACH PARTITION {}_p{}'.format(self.name, self.name[:55], i))
+        return forward, [self.drop_sql()]
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay the OrderView query mix (or a query log), inspect the plans and index usage, '
+        'measure candidate composite, covering and partial indexes and extended statistics '
+        'and write the useful ones as a migration. Candidates are created and dropped on the database, '
+        'run it on a copy of production data, not on production.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--query-log', help='SQL statements to replay instead of the OrderView query mix')
+        parser.add_argument('--user', type=int, help='user id of the OrderView query mix')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--pairs', action='store_true', help='add paired filters to the OrderView query mix')
+        parser.add_argument('--repeat', type=int, default=5, help='runs per query, the median is reported')
+        parser.add_argument('--min-improvement', type=float, default=0.1,
+                            help='share of the latency of its queries a candidate has to save')
+        parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+        parser.add_argument('--migration', help='write a migration with the recommended candidates to this file')
+
+    def get_workload(self, options):
+        if options['query_log']:
+            with open(options['query_log']) as f:
+                return parse_query_log(f.read())
+
+        benchmark = BenchmarkCommand()
+        user = benchmark.get_user(options['user'])
+        cases = benchmark.get_cases(benchmark.get_filter_values(user), not options['pairs'])
+        # in a transaction all queries of the view run on this connection (see mysite.concurrency)
+        with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+            for params in cases:
+                benchmark.run_case(user, params, options['page_size'], 1, False)
+        return [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+
+    def get_schema(self, cursor):
+        cursor.execute('SELECT inhrelid::regclass::text, inhparent::regclass::text FROM pg_inherits')
+        self.parents = dict(cursor.fetchall())
+        self.partitions = {}
+        for partition, parent in sorted(self.parents.items()):
+            self.partitions.setdefault(parent, []).append(partition)
+        cursor.execute(
+            'SELECT T.relname, I.relname, X.indnkeyatts, pg_get_expr(X.indpred, X.indrelid), '
+            'ARRAY(SELECT A.attname FROM unnest(X.indkey) WITH ORDINALITY K (attnum, n) '
+            'JOIN pg_attribute A ON A.attrelid = X.indrelid AND A.attnum = K.attnum ORDER BY K.n) '
+            'FROM pg_index X JOIN pg_class T ON T.oid = X.indrelid JOIN pg_class I ON I.oid = X.indexrelid '
+            'WHERE pg_table_is_visible(T.oid)'
+        )
+        # index -> (table, key columns, all columns, predicate)
+        self.indexes = {
+            index: (self.parents.get(table, table), tuple(columns[:key_count]), tuple(columns), predicate)
+            for table, index, key_count, predicate, columns in cursor.fetchall()
+        }
+
+    def is_covered(self, candidate):
+        # by an existing index starting with the same columns
+        if candidate.kind == 'statistics':
+            return False
+        return any(
+            table == candidate.table and key_columns[:len(candidate.columns)] == candidate.columns
+            and set(candidate.include) <= set(columns)
+            and predicate == (candidate.where and '({})'.format(candidate.where))
+            for table, key_columns, columns, predicate in self.indexes.values()
+        )
+
+    def scan_candidates(self, node, sort_columns):
+        table = self.parents.get(node['Relation Name'], node['Relation Name'])
+        alias = node['Alias']
+        condition = ' AND '.join(node.get(name, '') for name in ('Filter', 'Index Cond', 'Recheck Cond'))
+        equality, ranges = column_conditions(alias, condition)
+        outputs = unique(re.findall(r'^{}\.(\w+)$'.format(re.escape(alias)), '\n'.join(node.get('Output', [])), re.M))
+        order = sort_columns or []
+        if node['Node Type'] == 'Index Scan' and node.get('Index Name') in self.indexes:
+            # the index is used for its order, its columns are kept after the filtered ones
+            order = order or list(self.indexes[node['Index Name']][1])
+
+        candidates = []
+        filtered = node.get('Rows Removed by Filter', 0) > node['Actual Rows'] or node['Node Type'] == 'Seq Scan'
+        if filtered and (equality or ranges or order):
+            columns = unique(equality + order + ranges if order else equality + ranges)
+            candidates.append(Candidate('composite', table, columns))
+            if len(outputs) <= MAX_COVERING_COLUMNS:
+                candidates.append(Candidate('covering', table, columns, include=outputs))
+        for predicate in partial_predicates(alias, condition):
+            column = predicate.split()[0]
+            columns = unique([c for c in equality + order if c != column]) or ['id']
+            candidates.append(Candidate('partial', table, columns, where=predicate))
+
+        filter_columns = unique(equality + ranges)
+        estimated, actual = node['Plan Rows'], node['Actual Rows']
+        if len(filter_columns) > 1 and max(estimated, actual) > MISESTIMATE_RATIO * max(min(estimated, actual), 1):
+            candidates.append(Candidate('statistics', table, sorted(filter_columns)))
+        return candidates
+
+    def join_candidates(self, node, scans):
+        candidates = []
+        for name in JOIN_CONDITIONS:
+            for alias, column in re.findall(r'\b(\w+)\.(\w+)\b', node.get(name, '')):
+                for scan in scans.get(alias, []):
+                    if scan['Node Type'] != 'Seq Scan':
+                        continue
+                    table = self.parents.get(scan['Relation Name'], scan['Relation Name'])
+                    outputs = unique(re.findall(r'^\w+\.(\w+)$', '\n'.join(scan.get('Output', [])), re.M))
+                    candidates.append(Candidate('composite', table, [column]))
+                    if len(outputs) <= MAX_COVERING_COLUMNS:
+                        candidates.append(Candidate('covering', table, [column], include=outputs))
+        return candidates
+
+    def plan_candidates(self, plan):
+        scans = {}
+        for node, parent in iter_nodes(plan):
+            if node['Node Type'] in SCAN_NODES:
+                scans.setdefault(node['Alias'], []).append(node)
+                # partitions are scanned as <alias>_<n>, conditions above the Append use <alias>
+                scans.setdefault(re.sub(r'_\d+$', '', node['Alias']), []).append(node)
+
+        candidates = []
+        sorted_scans = {}
+        for node, parent in iter_nodes(plan):
+            if node['Node Type'] in ('Sort', 'Incremental Sort'):
+                child = node
+                while child.get('Plans') and child['Node Type'] not in SCAN_NODES:
+                    child = child['Plans'][0]
+                if child['Node Type'] in SCAN_NODES:
+                    keys = []
+                    for key in node['Sort Key']:
+                        match = re.match(r'^{}\.(\w+)(?: DESC)?(?: NULLS \w+)?$'.format(re.escape(child['Alias'])), key)
+                        if not match:
+                            break
+                        keys.append(match.group(1))
+                    sorted_scans[id(child)] = keys
+            elif any(name in node for name in JOIN_CONDITIONS):
+                candidates.extend(self.join_candidates(node, scans))
+        for node, parent in iter_nodes(plan):
+            if node['Node Type'] in SCAN_NODES:
+                candidates.extend(self.scan_candidates(node, sorted_scans.get(id(node))))
+        return candidates
+
+    def explain(self, cursor, sql):
+        cursor.execute('EXPLAIN (ANALYZE, VERBOSE, FORMAT JSON) ' + sql)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def time_query(self, cursor, sql, repeat):
+        cursor.execute(sql)  # warm up
+        cursor.fetchall()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql)
+            cursor.fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def measure(self, cursor, candidate, queries, before, repeat):
+        try:
+            cursor.execute(candidate.create_sql())
+            cursor.execute('ANALYZE {}'.format(candidate.table))
+            after = {sql: self.time_query(cursor, sql, repeat) for sql in queries}
+            # indexes of partitions are named by PostgreSQL
+            used_indexes = set(re.findall(r'"Index Name": "(\w+)"', json.dumps(
+                [self.explain(cursor, sql) for sql in queries]
+            ))) - set(self.indexes)
+        finally:
+            cursor.execute(candidate.drop_sql())
+        before_ms, after_ms = sum(before[sql] for sql in queries), sum(after.values())
+        return {
+            'kind': candidate.kind,
+            'name': candidate.name,
+            'table': candidate.table,
+            'sql': candidate.create_sql(),
+            'queries': len(queries),
+            'before_ms': round(before_ms, 3),
+            'after_ms': round(after_ms, 3),
+            'improvement': round(1 - after_ms / before_ms, 3) if before_ms else 0,
+            'used': candidate.kind == 'statistics' or bool(used_indexes),
+        }
+
+    def get_unused_indexes(self, cursor, tables):
+        cursor.execute(
+            'SELECT S.relname, S.indexrelname, S.idx_scan, pg_relation_size(S.indexrelid) '
+            'FROM pg_stat_user_indexes S JOIN pg_index X ON X.indexrelid = S.indexrelid '
+            'WHERE S.idx_scan = 0 AND NOT X.indisunique AND S.relname = ANY(%s) ORDER BY 4 DESC',
+            [tables]
+        )
+        return [
+            {'table': table, 'name': name, 'scans': scans, 'size': size}
+            for table, name, scans, size in cursor.fetchall()
+        ]
+
+    def write_migration(self, path, candidates):
+        loader = MigrationLoader(connection, ignore_no_migrations=True)
+        dependencies = ''.join(
+            '{!r},'.format(node) for node in sorted(loader.graph.leaf_nodes()) if node[0] == 'shop'
+        )
+        operations = []
+        for candidate in candidates:
+            forward, reverse = candidate.migration_sql(self.partitions.get(candidate.table))
+            operations.append(
+                '        # {kind}, {before_ms} -> {after_ms} ms\n'
+                '        migrations.RunSQL(\n'
+                '            {forward!r},\n'
+                '            {reverse!r},\n'
+                '        ),'.format(forward=forward, reverse=reverse, **candidate.report)
+            )
+        with open(path, 'w') as f:
+            f.write(MIGRATION_TEMPLATE.format(
+                created=datetime.date.today().isoformat(),
+                dependencies=dependencies,
+                operations='\n'.join(operations),
+            ))
+
+    def handle(self, *args, **options):
+        start_time = datetime.datetime.now()
+        workload = unique(self.get_workload(options))
+        if not workload:
+            raise CommandError('No SELECT queries to replay')
+
+        candidates = {}
+        with connection.cursor() as cursor:
+            self.get_schema(cursor)
+            before = {}
+            for i, sql in enumerate(workload, 1):
+                before[sql] = self.time_query(cursor, sql, options['repeat'])
+                for candidate in self.plan_candidates(self.explain(cursor, sql)):
+                    if not self.is_covered(candidate):
+                        candidates.setdefault(candidate.key, candidate).queries.add(sql)
+            self.stderr.write('{} queries, {} candidates'.format(len(workload), len(candidates)))
+
+            for i, candidate in enumerate(candidates.values(), 1):
+                candidate.report = self.measure(cursor, candidate, sorted(candidate.queries), before,
+                                                options['repeat'])
+                self.stderr.write('[{}/{}] {sql}: {before_ms} -> {after_ms} ms'.format(
+                    i, len(candidates), **candidate.report
+                ))
+            unused_indexes = self.get_unused_indexes(cursor, sorted({c.table for c in candidates.values()}))
+
+        # the best candidates first, one not improving other queries than the ones already chosen is redundant
+        recommended, improved = [], set()
+        for candidate in sorted(candidates.values(), key=lambda c: -c.report['improvement']):
+            if candidate.report['used'] and candidate.report['improvement'] >= options['min_improvement']:
+                if not candidate.queries <= improved:
+                    recommended.append(candidate)
+                    improved |= candidate.queries
+        report = {
+            'created': start_time.isoformat(),
+            'database': connection.settings_dict['NAME'],
+            'queries': len(workload),
+            'candidates': sorted((c.report for c in candidates.values()), key=lambda r: -r['improvement']),
+            'recommended': [candidate.name for candidate in recommended],
+            'unused_indexes': unused_indexes,
+        }
+        if options['migration']:
+            self.write_migration(options['migration'], recommended)
+
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stderr.write('Advisor time: {}'.format(str(total_sec)))
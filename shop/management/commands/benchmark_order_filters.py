@@ -0,0 +1,180 @@
+import datetime
+import json
+import statistics
+import time
+from itertools import combinations
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Avg, Count
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import urlencode
+from rest_framework.test import APIRequestFactory
+
+from mysite.query_guard import QueryCapture
+from shop.models import User, OrderStatus, Order, OrderItem, Manufacturer
+from shop.views import OrderView, OrderFilter
+
+
+class Command(BaseCommand):
+    help = (
+        'Run every OrderFilter filter and OrderView ordering, alone and paired, through OrderView '
+        'and report wall time, query count and EXPLAIN (ANALYZE, BUFFERS) of the page query as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='user id, the first user with status groups by default')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=3, help='runs per case, the median is reported')
+        parser.add_argument('--singles', action='store_true', help='skip paired cases')
+        parser.add_argument('--no-explain', action='store_true')
+        parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+        parser.add_argument('--baseline', help='JSON report to compare with')
+        parser.add_argument('--threshold', type=float, default=1.5,
+                            help='slowdown ratio against the baseline reported as a regression')
+        parser.add_argument('--min-delta-ms', type=float, default=5,
+                            help='ignore slowdowns smaller than this')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def get_user(self, user_id):
+        if user_id is not None:
+            return User.objects.get(id=user_id)
+        user = User.objects.filter(allowed_groups__isnull=False).order_by('id').first()
+        if user is None:
+            raise CommandError('No user with status groups, populate the database with fill_shop_db')
+        return user
+
+    def get_filter_values(self, user):
+        """
+        A deterministic sample value for every OrderFilter filter.
+        """
+        status_id = OrderStatus.objects.filter(group__user=user).order_by('id').values_list('id', flat=True)[0]
+        avg_total_price = int(Order.objects.aggregate(avg=Avg('total_price'))['avg'] or 0)
+        product_id = OrderItem.objects.order_by('id').values_list('product_id', flat=True).first()
+        number = Order.objects.order_by('id').values_list('number', flat=True).first() or ''
+        manufacturer_id = Manufacturer.objects.annotate(
+            products=Count('product'),
+        ).order_by('-products', 'id').values_list('id', flat=True).first()
+
+        values = {
+            'status': status_id,
+            'favorite_m': 'true',
+            'price_differ': 'true',
+            'manufacturer': manufacturer_id,
+            'product': product_id,
+            'search': number[2:8],
+            'fast_total_price__lte': avg_total_price,
+            'fast_total_price__gte': avg_total_price,
+            'slow_total_price__lte': avg_total_price,
+            'slow_total_price__gte': avg_total_price,
+        }
+        missing = set(OrderFilter.base_filters) - set(values)
+        if missing:
+            raise CommandError('No sample value for filters: {}'.format(', '.join(sorted(missing))))
+        return values
+
+    def get_cases(self, filter_values, singles):
+        filters = [{name: value} for name, value in sorted(filter_values.items())]
+        orderings = [
+            {'ordering': prefix + field} for field in OrderView.ordering_fields for prefix in ('', '-')
+        ]
+        cases = [{}] + filters + orderings
+        if not singles:
+            cases += [dict(a, **b) for a, b in combinations(filters, 2)]
+            cases += [dict(f, **o) for f in filters for o in orderings]
+        return cases
+
+    def run_case(self, user, params, page_size, repeat, explain):
+        params = dict(params, user=user.id, page_size=page_size)
+        # pagination links are absolute, the host has to pass ALLOWED_HOSTS validation
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        timings = []
+        for _ in range(repeat):
+            request = APIRequestFactory().get('/', params, HTTP_HOST=host)
+            view = OrderView(request=request, args=(), kwargs={}, format_kwarg=None)
+            request = view.request = view.initialize_request(request)
+            view.initial(request)
+
+            # QueryCapture also counts the queries run by other threads (mysite.concurrency),
+            # CaptureQueriesContext keeps the parameters of those of this thread
+            with QueryCapture() as captured, CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                queryset = view.filter_queryset(view.get_queryset())
+                page = view.paginate_queryset(queryset)
+                view.get_serializer(page, many=True).data
+                timings.append((time.perf_counter() - start) * 1000)
+
+        result = {
+            'params': {name: value for name, value in params.items() if name != 'user'},
+            'wall_ms': {'min': round(min(timings), 3), 'median': round(statistics.median(timings), 3)},
+            'queries': len(captured),
+        }
+        if explain and len(queries):
+            # the first query is the page itself, run by this thread, the rest are prefetches
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + queries[0]['sql'])
+                result['explain'] = '\n'.join(row[0] for row in cursor.fetchall())
+        return result
+
+    def compare(self, report, baseline, threshold, min_delta_ms):
+        regressions = []
+        for name, result in sorted(report['results'].items()):
+            base = baseline['results'].get(name)
+            if base is None:
+                continue
+            current_ms, base_ms = result['wall_ms']['median'], base['wall_ms']['median']
+            slower = current_ms - base_ms >= min_delta_ms and current_ms > base_ms * threshold
+            if slower or result['queries'] > base['queries']:
+                regressions.append({
+                    'case': name,
+                    'baseline_ms': base_ms,
+                    'current_ms': current_ms,
+                    'baseline_queries': base['queries'],
+                    'current_queries': result['queries'],
+                })
+        return regressions
+
+    def handle(self, *args, **options):
+        start_time = datetime.datetime.now()
+        user = self.get_user(options['user'])
+        cases = self.get_cases(self.get_filter_values(user), options['singles'])
+
+        report = {
+            'created': start_time.isoformat(),
+            'database': connection.settings_dict['NAME'],
+            'orders': Order.objects.count(),
+            'user': user.id,
+            'page_size': options['page_size'],
+            'results': {},
+        }
+        for i, params in enumerate(cases, 1):
+            name = urlencode(sorted(params.items())) or 'default'
+            report['results'][name] = self.run_case(
+                user, params, options['page_size'], options['repeat'], not options['no_explain'],
+            )
+            self.stderr.write('[{}/{}] {}: {} ms'.format(
+                i, len(cases), name, report['results'][name]['wall_ms']['median'],
+            ))
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            report['regressions'] = self.compare(
+                report, baseline, options['threshold'], options['min_delta_ms'],
+            )
+            for regression in report['regressions']:
+                self.stderr.write('REGRESSION {case}: {baseline_ms} -> {current_ms} ms, '
+                                  '{baseline_queries} -> {current_queries} queries'.format(**regression))
+
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)
+
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stderr.write('Benchmark time: {}'.format(str(total_sec)))
+        if options['fail_on_regression'] and report.get('regressions'):
+            raise CommandError('{} regressions against {}'.format(len(report['regressions']), options['baseline']))
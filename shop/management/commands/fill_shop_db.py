@@ -1,10 +1,16 @@
 import datetime
-from random import randint
+import io
+import random
+import re
+from array import array
+from itertools import accumulate
+from math import gcd
 
-from django.core.management import BaseCommand, call_command
+from django.core.management import BaseCommand, CommandError, call_command
 from django.db import connection
 
 from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Product, Manufacturer
+from shop.parallel import execute_sql, get_partitions, run_parallel, split_range
 
 # написать команду, которая сгенерит в базе:
 # 1 миллион заказов
@@ -15,159 +21,310 @@ from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Produc
 # 3 статуса заказа (новые, в работе, закрыт)
 # 2 группы статусов ( обрабатываются, завершены)
 COUNT = {
+    'Manufacturer': 500,
+    'Product': 3 * 10 ** 6,
     'Order': 10 ** 6,
     'OrderItems': 10 ** 7,
-    'Product': 3 * 10 ** 6,
+    'User': 10,
 }
 
+PRODUCT_BLOCK_SIZE = 100000
+ORDER_BLOCK_SIZE = 10000
+FIRST_ORDER_DATE = datetime.date(2017, 1, 10)
+# share of order items sold not at the product price
+MISMATCH_RATE = 0.01
+
+# generation parameters and product data, set in the parent process before workers are forked
+params = {}
+product_prices = array('i')
+product_manufacturers = array('i')
+order_block_item_offsets = []
+
+
+def block_rng(kind, block):
+    # every block has its own stream, data doesn't depend on the number of workers
+    return random.Random('{}:{}:{}'.format(params['seed'], kind, block))
+
+
+def zipf_rank(rng, n, s):
+    """
+    Rank in [1, n] with P(rank) ~ rank ** -s (inverse CDF of the continuous distribution).
+    """
+    u = rng.random()
+    if s == 1:
+        rank = n ** u
+    else:
+        rank = ((n ** (1 - s) - 1) * u + 1) ** (1 / (1 - s))
+    return min(int(rank), n)
+
+
+def rank_permutation(n):
+    # rank -> id, so the most popular products aren't just the lowest ids
+    step = int(n * 0.618) or 1
+    while gcd(step, n) != 1:
+        step += 1
+    return lambda rank: (rank - 1) * step % n + 1
+
+
+def order_block_item_counts(block):
+    rng = block_rng('items-count', block)
+    lo, hi = params['order_blocks'][block]
+    max_items = min(2 * params['items_per_order'] - 1, params['products'])
+    return [rng.randint(1, max_items) for _ in range(hi - lo + 1)]
+
+
+def copy_rows(table, columns, lines):
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)),
+            io.StringIO(''.join(lines)),
+        )
+
+
+def load_products(block):
+    lo, hi = block
+    rng = block_rng('products', lo)
+    lines = [
+        '{}\tSKU-{:08d}-{:08x}\t{}\t{}\n'.format(
+            product_id, product_id, rng.getrandbits(32),
+            product_prices[product_id], product_manufacturers[product_id],
+        )
+        for product_id in range(lo, hi + 1)
+    ]
+    copy_rows(Product._meta.db_table, ('id', 'sku', 'price', 'manufacturer_id'), lines)
+    return hi - lo + 1
+
+
+def load_orders(block):
+    """
+    Orders of the block with their items. Items are unique per order and totals, id arrays
+    and mismatch counters are computed here, so nothing is updated after the load.
+    """
+    lo, hi = params['order_blocks'][block]
+    rng = block_rng('orders', block)
+    product_id_of_rank = rank_permutation(params['products'])
+    item_id = order_block_item_offsets[block]
+
+    order_lines, item_lines = [], []
+    for order_id, items_count in zip(range(lo, hi + 1), order_block_item_counts(block)):
+        created = FIRST_ORDER_DATE + datetime.timedelta(days=rng.randint(0, 365))
+        delivery_price = rng.randint(0, 100)
+
+        product_ids = set()
+        while len(product_ids) < items_count:
+            product_ids.add(product_id_of_rank(zipf_rank(rng, params['products'], params['zipf'])))
+
+        total_price, mismatched_items = delivery_price, 0
+        for product_id in sorted(product_ids):
+            item_id += 1
+            price = product_prices[product_id]
+            if rng.random() < MISMATCH_RATE:
+                price += rng.randint(1, 40)
+                mismatched_items += 1
+            total_price += price
+            item_lines.append('{}\t{}\t{}\t{}\t{}\n'.format(item_id, created, order_id, product_id, price))
+
+        order_lines.append('{}\t{}\t{:010d}-{:012x}\t{}\t{}\t{}\t{{{}}}\t{{{}}}\t{}\n'.format(
+            order_id, created, order_id, rng.getrandbits(48), delivery_price,
+            rng.choice(params['status_ids']), total_price,
+            ','.join(map(str, sorted(product_ids))),
+            ','.join(map(str, sorted({product_manufacturers[p] for p in product_ids}))),
+            mismatched_items,
+        ))
 
-def speed_up_generate_sql(cursor, table_name, sql):
-    # disable index
-    cursor.execute('UPDATE pg_index '
-                   'SET indisready=false '
-                   'WHERE indrelid = ('
-                   'SELECT oid '
-                   'FROM pg_class '
-                   "WHERE relname='{}'"
-                   ')'.format(table_name))
-    # disable triggers
-    cursor.execute('ALTER TABLE {} DISABLE TRIGGER ALL'.format(table_name))
-
-    cursor.execute(sql)
-
-    # enable triggers
-    cursor.execute('ALTER TABLE {} ENABLE TRIGGER ALL'.format(table_name))
-    # enable index
-    cursor.execute('UPDATE pg_index '
-                   'SET indisready=true '
-                   'WHERE indrelid = ('
-                   'SELECT oid '
-                   'FROM pg_class '
-                   "WHERE relname='{}'"
-                   ')'.format(table_name))
-    # reindex
-    cursor.execute('REINDEX TABLE {};'.format(table_name))
+    copy_rows(
+        Order._meta.db_table,
+        ('id', 'created', 'number', 'delivery_price', 'status_id', 'total_price',
+         'product_ids', 'manufacturer_ids', 'mismatched_items'),
+        order_lines,
+    )
+    copy_rows(OrderItem._meta.db_table, ('id', 'created', 'order_id', 'product_id', 'price'), item_lines)
+    return len(item_lines)
+
+
+def drop_indexes(tables):
+    """
+    Drop constraints and indexes of `tables` (primary keys included), return statements restoring them
+    as (index statements, constraint statements, foreign key statements).
+
+    Indexes of a partitioned table are restored per partition by the (parallel) index statements,
+    then attached to the index of the table, created empty by the constraint statements.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT C.conrelid::regclass::text, C.conname, C.contype, I.relname, pg_get_constraintdef(C.oid) '
+            'FROM pg_constraint C LEFT JOIN pg_class I ON I.oid = C.conindid '
+            "WHERE C.contype IN ('p', 'u', 'f') AND C.conparentid = 0 AND (C.conrelid = ANY(%s::regclass[]) "
+            "OR (C.contype = 'f' AND C.confrelid = ANY(%s::regclass[])))",
+            [tables, tables]
+        )
+        constraints = cursor.fetchall()
+        cursor.execute(
+            'SELECT indrelid::regclass::text, indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index '
+            'WHERE indrelid = ANY(%s::regclass[])',
+            [tables]
+        )
+        indexes = cursor.fetchall()
+        partitions = {table: get_partitions(table) for table in tables}
+        constraint_indexes = {index_name for table, name, kind, index_name, definition in constraints}
+
+        index_sql, constraint_sql, foreign_key_sql = [], [], []
+        for table, name, definition in indexes:
+            if not partitions[table]:
+                index_sql.append(definition)
+                continue
+            for i, partition in enumerate(partitions[table]):
+                partition_definition = re.sub(
+                    r' INDEX \S+ ON ONLY \S+ USING ',
+                    ' INDEX {}_p{} ON {} USING '.format(name[:55], i, partition),
+                    definition,
+                )
+                index_sql.append(partition_definition)
+            if name not in constraint_indexes:
+                constraint_sql.append(definition)
+                constraint_sql.extend('ALTER INDEX {} ATTACH PARTITION {}_p{}'.format(name, name[:55], i)
+                                      for i in range(len(partitions[table])))
+
+        # foreign keys first, they depend on primary keys and unique constraints
+        for table, name, kind, index_name, definition in sorted(constraints, key=lambda c: c[2] != 'f'):
+            cursor.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, name))
+            if kind == 'f':
+                foreign_key_sql.append('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table, name, definition))
+                continue
+            using_index = 'ALTER TABLE {} ADD CONSTRAINT {} {} USING INDEX {}'
+            constraint_type = 'PRIMARY KEY' if kind == 'p' else 'UNIQUE'
+            if not partitions[table]:
+                # the index is built in parallel with the others and then attached to the constraint
+                constraint_sql.append(using_index.format(table, name, constraint_type, index_name))
+                continue
+            for i, partition in enumerate(partitions[table]):
+                partition_index = '{}_p{}'.format(index_name[:55], i)
+                constraint_sql.append(using_index.format(partition, partition_index, constraint_type, partition_index))
+            constraint_sql.append('ALTER TABLE ONLY {} ADD CONSTRAINT {} {}'.format(table, name, definition))
+            constraint_sql.extend('ALTER INDEX {} ATTACH PARTITION {}_p{}'.format(index_name, index_name[:55], i)
+                                  for i in range(len(partitions[table])))
+        for table, name, definition in indexes:
+            cursor.execute('DROP INDEX IF EXISTS {}'.format(name))
+    return index_sql, constraint_sql, foreign_key_sql
 
 
 class Command(BaseCommand):
+    help = 'Populate the shop tables with generated data using parallel COPY'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='multiplier for the number of manufacturers, products, orders and items')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='exponent of product and manufacturer popularity')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='flush the database without confirmation')
+
+    def log(self, message, start_time):
+        self.stdout.write('{}: {}'.format(message, (datetime.datetime.now() - start_time).total_seconds()))
+
+    def restore_indexes(self, index_sql, constraint_sql, workers):
+        # indexes (including the ones of primary keys and unique constraints) are built in parallel
+        done = set()
+        try:
+            done.update(run_parallel(execute_sql, index_sql, workers))
+            for sql in constraint_sql:
+                done.add(execute_sql(sql))
+        except Exception:
+            self.stderr.write('Restoring indexes and constraints failed, the remaining statements are:')
+            for sql in index_sql + constraint_sql:
+                if sql not in done:
+                    self.stderr.write(sql + ';')
+            raise
 
     def handle(self, *args, **options):
-        call_command('flush')
+        if options['scale'] <= 0:
+            raise CommandError('--scale must be positive')
+        call_command('flush', interactive=options['interactive'])
 
         start_time = datetime.datetime.now()
+        counts = {name: max(1, int(count * options['scale'])) for name, count in COUNT.items()}
+        counts['User'] = COUNT['User']
+        workers = options['workers']
+
         st_group_in_process = StatusGroup.objects.create(name='in process')
         st_group_finished = StatusGroup.objects.create(name='finished')
+        statuses = [
+            OrderStatus.objects.create(name='new', group=st_group_in_process),
+            OrderStatus.objects.create(name='in work', group=st_group_in_process),
+            OrderStatus.objects.create(name='closed', group=st_group_finished),
+        ]
 
-        OrderStatus.objects.create(name='new', group=st_group_in_process)
-        OrderStatus.objects.create(name='in work', group=st_group_in_process)
-        OrderStatus.objects.create(name='closed', group=st_group_finished)
+        order_blocks = split_range(1, counts['Order'], ORDER_BLOCK_SIZE)
+        params.update(
+            seed=options['seed'],
+            zipf=options['zipf'],
+            products=counts['Product'],
+            items_per_order=max(1, counts['OrderItems'] // counts['Order']),
+            status_ids=[status.id for status in statuses],
+            order_blocks=order_blocks,
+        )
 
-        with connection.cursor() as cursor:
-            # generate Manufacturers
-            speed_up_generate_sql(
-                cursor,
-                table_name=Manufacturer._meta.db_table,
-                sql='INSERT INTO {} (id, name) VALUES ('
-                               'generate_series(1,500), '
-                               'left(md5(random()::text), 15)'
-                               ')'.format(Manufacturer._meta.db_table),
+        # product data is needed by every order worker, generate it once before forking
+        rng = block_rng('product-data', 0)
+        manufacturer_of_rank = rank_permutation(counts['Manufacturer'])
+        product_prices[:] = array('i', [0] * (counts['Product'] + 1))
+        product_manufacturers[:] = array('i', [0] * (counts['Product'] + 1))
+        for product_id in range(1, counts['Product'] + 1):
+            product_prices[product_id] = rng.randint(1, 1000)
+            product_manufacturers[product_id] = manufacturer_of_rank(
+                zipf_rank(rng, counts['Manufacturer'], options['zipf'])
             )
+        # item ids are contiguous: every order block knows the number of items before it
+        order_block_item_offsets[:] = [0] + list(accumulate(
+            sum(order_block_item_counts(block)) for block in range(len(order_blocks) - 1)
+        ))
+        self.log('Product data generated', start_time)
 
-            # generate Products
-            speed_up_generate_sql(
-                cursor,
-                table_name=Product._meta.db_table,
-                sql='INSERT INTO {table} (id, sku, price, manufacturer_id) VALUES ('
-                               'generate_series(1, ({product_number})::int), '
-                               'concat(md5(random()::text), md5(random()::text)), '
-                               '(random() * 1000)::int, '
-                               'trunc(random() * 500) + 1'
-                               ')'.format(
-                    table=Product._meta.db_table,
-                    product_number=COUNT['Product'])
-            )
-
-            # generate Orders
-            speed_up_generate_sql(
-                cursor,
-                table_name=Order._meta.db_table,
-                sql='INSERT INTO {table} (id, created, number, delivery_price, status_id) VALUES ('
-                               'generate_series(1, ({order_number})::int), '
-                               "date '2017-01-10' + (random()*365)::int, "
-                               'concat(md5(random()::text), md5(random()::text)), '
-                               '(random() * 100)::int, '
-                               'trunc(random() * 3) + 1'
-                               ')'.format(
-                    table=Order._meta.db_table,
-                    order_number=COUNT['Order'], )
-            )
-
-            # OrderItems
-            speed_up_generate_sql(
-                cursor,
-                table_name=OrderItem._meta.db_table,
-                sql='INSERT INTO {table} (id, created, price, order_id, product_id) VALUES ('
-                    'generate_series(1, ({orderitem_number})::int), '
-                    "date '2018-01-10' + (random()*365)::int, "
-                    '0, '
-                    'trunc(random() * {order_number}) + 1, '
-                    'trunc(random() * {product_number}) + 1'
-                    ')'.format(
-                        table=OrderItem._meta.db_table,
-                        orderitem_number=COUNT['OrderItems'],
-                        order_number=COUNT['Order'],
-                        product_number=COUNT['Product'], )
-            )
+        tables = [Manufacturer._meta.db_table, Product._meta.db_table,
+                  Order._meta.db_table, OrderItem._meta.db_table]
+        index_sql, constraint_sql, foreign_key_sql = drop_indexes(tables)
 
-            # fix price in OrderItem - Product
-            speed_up_generate_sql(
-                cursor,
-                table_name=OrderItem._meta.db_table,
-                sql='UPDATE {order_table} '
-                    'SET price={product_table}.price '
-                    'FROM {product_table} '
-                    'WHERE {order_table}.product_id={product_table}.id'.format(
-                        order_table=OrderItem._meta.db_table,
-                        product_table=Product._meta.db_table,
-                    )
-            )
+        try:
+            copy_rows(Manufacturer._meta.db_table, ('id', 'name'), [
+                '{}\tmanufacturer {:04d}\n'.format(i, i) for i in range(1, counts['Manufacturer'] + 1)
+            ])
+            loaded = sum(run_parallel(load_products, split_range(1, counts['Product'], PRODUCT_BLOCK_SIZE), workers))
+            self.log('Products loaded ({})'.format(loaded), start_time)
+            # the loaders compute total_price, the triggers keeping it (see migration 0011) would add the items again
+            trigger_tables = [Order._meta.db_table, OrderItem._meta.db_table]
+            for table in trigger_tables:
+                execute_sql('ALTER TABLE {} DISABLE TRIGGER USER'.format(table))
+            try:
+                loaded = sum(run_parallel(load_orders, range(len(order_blocks)), workers))
+            finally:
+                for table in trigger_tables:
+                    execute_sql('ALTER TABLE {} ENABLE TRIGGER USER'.format(table))
+            self.log('Orders and items loaded ({})'.format(loaded), start_time)
+        finally:
+            # also after a failed load, the tables must not stay without their keys and constraints
+            self.restore_indexes(index_sql, constraint_sql + foreign_key_sql, workers)
+        self.log('Indexes built', start_time)
 
-            # change price for random 100k rows
-            speed_up_generate_sql(
-                cursor,
-                table_name=OrderItem._meta.db_table,
-                sql='UPDATE {table} '
-                    'SET price = price + trunc(random() * 40) '
-                    'WHERE id IN (SELECT id FROM {table} ORDER BY random() limit 100000);'.format(
-                        table=OrderItem._meta.db_table,
-                    )
-            )
+        with connection.cursor() as cursor:
+            for table in tables:
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), coalesce(max(id), 1)) FROM {}".format(
+                    table), [table])
+                cursor.execute('ANALYZE {}'.format(table))
 
-            # remove rows violate unique together constraint on order_id, product_id
-            cursor.execute('WITH u AS'
-                           '(SELECT DISTINCT ON (order_id, product_id) id FROM {table})'
-                           'DELETE FROM {table} WHERE {table}.id NOT IN (SELECT id FROM u)'.format(
-                table=OrderItem._meta.db_table
-            ))
-
-            # populate Order total_price
-            speed_up_generate_sql(
-                cursor,
-                table_name=Order._meta.db_table,
-                sql='UPDATE {order_table} O '
-                    'SET total_price = '
-                    'coalesce((SELECT SUM(price) FROM {orderitem_table} I WHERE I.order_id=O.id), 0) '
-                    '+ O.delivery_price'.format(
-                    order_table=Order._meta.db_table,
-                    orderitem_table=Order._meta.db_table,
-                )
-            )
+        # COPY bypasses the incremental maintenance of the rollup
+        call_command('rebuild_daily_sales', workers=workers, stdout=self.stdout)
+        self.log('Daily sales rebuilt', start_time)
 
         # Users
-        for i in range(10):
+        rng = block_rng('users', 0)
+        for i in range(counts['User']):
             user = User.objects.create()
-            user.favorite_manufactures.set([randint(1, 500) for _ in range(randint(1, 10))])
-            user.allowed_groups.set([randint(1, 2) for _ in range(randint(1, 2))])
+            user.favorite_manufactures.set([
+                manufacturer_of_rank(zipf_rank(rng, counts['Manufacturer'], options['zipf']))
+                for _ in range(rng.randint(1, 10))
+            ])
+            user.allowed_groups.set(rng.sample([st_group_in_process, st_group_finished], rng.randint(1, 2)))
 
-        total_sec = (datetime.datetime.now() - start_time).total_seconds()
-        self.stdout.write('DB populating time: {}'.format(str(total_sec)))
\ No newline at end of file
+        self.log('DB populating time', start_time)
@@ -0,0 +1,39 @@
+import datetime
+
+from django.core.management import BaseCommand, CommandError
+
+from shop.models import OrderItem
+from shop.parallel import execute_sql, get_partitions, run_parallel
+
+
+class Command(BaseCommand):
+    help = 'Vacuum, analyze or reindex the partitions of a partitioned table in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', default=OrderItem._meta.db_table)
+        parser.add_argument('--vacuum', action='store_true')
+        parser.add_argument('--analyze', action='store_true')
+        parser.add_argument('--reindex', action='store_true')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        start_time = datetime.datetime.now()
+        partitions = get_partitions(options['table'])
+        if not partitions:
+            raise CommandError('{} has no partitions'.format(options['table']))
+
+        statements = []
+        for partition in partitions:
+            if options['reindex']:
+                statements.append('REINDEX TABLE {}'.format(partition))
+            if options['vacuum']:
+                statements.append('VACUUM {}{}'.format('(ANALYZE) ' if options['analyze'] else '', partition))
+            elif options['analyze']:
+                statements.append('ANALYZE {}'.format(partition))
+        if not statements:
+            raise CommandError('Nothing to do, use --vacuum, --analyze or --reindex')
+
+        for sql in run_parallel(execute_sql, statements, options['workers']):
+            self.stdout.write(sql)
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stdout.write('Maintenance time: {}'.format(str(total_sec)))
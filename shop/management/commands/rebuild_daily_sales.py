@@ -0,0 +1,61 @@
+import datetime
+
+from django.core.management import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from shop.models import DailySales, Order
+from shop.parallel import run_parallel
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def rebuild_days(days):
+    return days, DailySales.objects.rebuild(*days)
+
+
+def split_days(day_from, day_to, size):
+    """
+    Split inclusive date range [day_from, day_to] into inclusive chunks of at most `size` days.
+    """
+    chunks = []
+    while day_from <= day_to:
+        chunk_to = min(day_from + datetime.timedelta(days=size - 1), day_to)
+        chunks.append((day_from, chunk_to))
+        day_from = chunk_to + datetime.timedelta(days=1)
+    return chunks
+
+
+class Command(BaseCommand):
+    help = 'Recompute the DailySales rollup from the orders, in parallel chunks of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=parse_date, help='first day, YYYY-MM-DD')
+        parser.add_argument('--to', dest='day_to', type=parse_date, help='last day, YYYY-MM-DD')
+        parser.add_argument('--chunk-days', type=int, default=7)
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        start_time = datetime.datetime.now()
+        if options['chunk_days'] < 1:
+            raise CommandError('--chunk-days must be positive')
+
+        # the rollup may have days without orders anymore
+        orders = Order.objects.aggregate(day_from=Min('created'), day_to=Max('created'))
+        sales = DailySales.objects.aggregate(day_from=Min('day'), day_to=Max('day'))
+        day_from = options['day_from'] or min(filter(None, (orders['day_from'], sales['day_from'])), default=None)
+        day_to = options['day_to'] or max(filter(None, (orders['day_to'], sales['day_to'])), default=None)
+        if day_from is None or day_to is None:
+            return
+
+        rows = 0
+        # every chunk is rebuilt in its own transaction
+        chunks = split_days(day_from, day_to, options['chunk_days'])
+        for (chunk_from, chunk_to), chunk_rows in run_parallel(rebuild_days, chunks, options['workers']):
+            rows += chunk_rows
+            if options['verbosity'] > 1:
+                self.stdout.write('{} - {}: {} rows'.format(chunk_from, chunk_to, chunk_rows))
+
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stdout.write('Rebuilt {} rows of {} - {} in {}'.format(rows, day_from, day_to, total_sec))
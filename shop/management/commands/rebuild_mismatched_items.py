@@ -0,0 +1,32 @@
+import datetime
+
+from django.core.management import BaseCommand
+from django.db.models import Max, Min
+
+from shop.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Recompute Order.mismatched_items from OrderItem and Product prices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50000)
+
+    def handle(self, *args, **options):
+        start_time = datetime.datetime.now()
+        batch_size = options['batch_size']
+
+        bounds = Order.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            return
+
+        updated = 0
+        # every batch is a separate autocommitted UPDATE
+        for start in range(bounds['min_id'], bounds['max_id'] + 1, batch_size):
+            updated += Order.objects.filter(id__range=(start, start + batch_size - 1)).refresh_item_aggregates(
+                fields=('mismatched_items', )
+            )
+            self.stdout.write('orders up to id {}: {} updated'.format(start + batch_size - 1, updated))
+
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stdout.write('Rebuild time: {}'.format(str(total_sec)))
@@ -0,0 +1,122 @@
+import datetime
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from shop.models import Order, OrderItem
+from shop.parallel import run_parallel, split_range
+from shop.response_cache import bump_data_version, is_process_local
+
+# total_price as it should be, O is the order
+EXPECTED_TOTAL_SQL = (
+    'O.delivery_price + coalesce((SELECT sum(I.price) FROM {orderitem_table} I WHERE I.order_id = O.id), 0)'
+)
+
+
+def get_expected_total_sql():
+    return EXPECTED_TOTAL_SQL.format(orderitem_table=OrderItem._meta.db_table)
+
+
+def find_mismatches(lo, hi):
+    """
+    [(id, total_price, expected total_price)] of the orders in [lo, hi] with a wrong total.
+    """
+    with connection.cursor() as cursor:
+        # one pass over the items of the range instead of a subquery per order
+        cursor.execute(
+            'SELECT O.id, O.total_price, O.delivery_price + coalesce(I.price, 0) '
+            'FROM {order_table} O LEFT JOIN ('
+            'SELECT order_id, sum(price) AS price FROM {orderitem_table} '
+            'WHERE order_id BETWEEN %s AND %s GROUP BY order_id'
+            ') I ON I.order_id = O.id '
+            'WHERE O.id BETWEEN %s AND %s AND O.total_price <> O.delivery_price + coalesce(I.price, 0) '
+            'ORDER BY O.id'.format(
+                order_table=Order._meta.db_table,
+                orderitem_table=OrderItem._meta.db_table,
+            ),
+            [lo, hi, lo, hi]
+        )
+        return cursor.fetchall()
+
+
+def repair_totals(order_ids):
+    """
+    Set total_price of the orders from their items, returns the number of orders changed.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        # recomputed under the row lock, concurrent writes may have fixed or changed the order since it was checked
+        cursor.execute(
+            'UPDATE {order_table} O SET total_price = {expected} '
+            'WHERE O.id = ANY(%s) AND O.total_price <> {expected}'.format(
+                order_table=Order._meta.db_table,
+                expected=get_expected_total_sql(),
+            ),
+            [order_ids]
+        )
+        if cursor.rowcount:
+            # reaches the web processes only through a shared SHOP_RESPONSE_CACHE, see Command.handle
+            bump_data_version()
+        return cursor.rowcount
+
+
+def reconcile_range(task):
+    lo, hi, repair_batch_size = task
+    checked = Order.objects.filter(id__range=(lo, hi)).count()
+    mismatches = find_mismatches(lo, hi)
+    repaired = 0
+    if repair_batch_size:
+        ids = [order_id for order_id, total, expected in mismatches]
+        for start in range(0, len(ids), repair_batch_size):
+            repaired += repair_totals(ids[start:start + repair_batch_size])
+    return lo, hi, checked, mismatches, repaired
+
+
+class Command(BaseCommand):
+    help = 'Compare Order.total_price to the sum of its item prices plus delivery_price and optionally repair it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--range-size', type=int, default=20000, help='orders checked by a task')
+        parser.add_argument('--repair', action='store_true')
+        parser.add_argument('--repair-batch-size', type=int, default=500,
+                            help='orders repaired by a transaction')
+        parser.add_argument('--show', type=int, default=20, help='mismatched orders to list')
+
+    def handle(self, *args, **options):
+        start_time = datetime.datetime.now()
+        if options['range_size'] < 1 or options['repair_batch_size'] < 1:
+            raise CommandError('--range-size and --repair-batch-size must be positive')
+
+        if options['repair'] and settings.SHOP_RESPONSE_CACHE_TTL and is_process_local():
+            self.stderr.write('SHOP_RESPONSE_CACHE is per process, cached order responses of the web processes '
+                              'keep the old totals until they expire')
+
+        bounds = Order.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            return
+        ranges = split_range(bounds['min_id'], bounds['max_id'], options['range_size'])
+        repair_batch_size = options['repair_batch_size'] if options['repair'] else 0
+        total_ids = bounds['max_id'] - bounds['min_id'] + 1
+
+        checked_ids, checked, repaired, mismatches = 0, 0, 0, []
+        for lo, hi, range_checked, range_mismatches, range_repaired in run_parallel(
+                reconcile_range, [(lo, hi, repair_batch_size) for lo, hi in ranges], options['workers']):
+            checked_ids += hi - lo + 1
+            checked += range_checked
+            repaired += range_repaired
+            mismatches += range_mismatches
+            seconds = (datetime.datetime.now() - start_time).total_seconds()
+            self.stdout.write('ids {}-{}: {} mismatched, {} repaired; {:.0f} orders/s, ETA {:.0f}s'.format(
+                lo, hi, len(range_mismatches), range_repaired,
+                checked / seconds if seconds else 0, seconds / checked_ids * (total_ids - checked_ids),
+            ))
+
+        mismatches.sort()
+        for order_id, total, expected in mismatches[:options['show']]:
+            self.stdout.write('order {}: total_price {}, expected {}'.format(order_id, total, expected))
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stdout.write('{} orders checked, {} mismatched, {} repaired. Reconciliation time: {}'.format(
+            checked, len(mismatches), repaired, total_sec,
+        ))
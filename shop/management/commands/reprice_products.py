@@ -0,0 +1,82 @@
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from shop.repricing import PercentRepricing, PriceListRepricing, read_price_file, resolve_skus
+from shop.response_cache import is_process_local
+
+
+class Command(BaseCommand):
+    help = ('Change product prices from a CSV file (sku,price) or by a percentage for manufacturers, '
+            'in batches of ids committed one by one. An interrupted run resumes where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='CSV file with sku and price columns')
+        parser.add_argument('--percent', type=Decimal, help='price change of the --manufacturer products, e.g. -5')
+        parser.add_argument('--manufacturer', type=int, action='append', default=[])
+        parser.add_argument('--job', help='job name for the progress, by default derived from the changes')
+        parser.add_argument('--restart', action='store_true', help='start a finished job again')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep after every batch')
+        parser.add_argument('--lock-timeout', type=int, default=2000,
+                            help='milliseconds a batch waits for locked rows before it is retried')
+        parser.add_argument('--retries', type=int, default=3)
+
+    def get_repricing(self, options):
+        kwargs = dict(batch_size=options['batch_size'], lock_timeout=options['lock_timeout'])
+        if options['file'] and options['percent'] is None:
+            try:
+                sku_prices = read_price_file(options['file'])
+            except (OSError, KeyError, ValueError) as e:
+                raise CommandError('Invalid price file: {!r}'.format(e))
+            if any(price < 0 for price in sku_prices.values()):
+                raise CommandError('Prices can not be negative')
+            prices, unknown = resolve_skus(sku_prices)
+            if unknown:
+                self.stderr.write('{} unknown SKUs skipped, e.g. {}'.format(len(unknown), ', '.join(unknown[:5])))
+            return PriceListRepricing(prices, **kwargs)
+        if options['percent'] is not None and options['manufacturer'] and not options['file']:
+            if options['percent'] <= -100:
+                raise CommandError('--percent must be above -100')
+            return PercentRepricing(dict.fromkeys(options['manufacturer'], options['percent']), **kwargs)
+        raise CommandError('Use either --file or --percent with --manufacturer')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        repricing = self.get_repricing(options)
+
+        job = repricing.get_job(options['job'])
+        if job.finished:
+            if not options['restart']:
+                self.stdout.write('Job {} finished at {}, use --restart to run it again'.format(job.name, job.finished))
+                return
+            job.last_id, job.products, job.orders, job.finished = 0, 0, 0, None
+            job.save()
+        elif job.last_id:
+            self.stdout.write('Resuming job {} after product id {}'.format(job.name, job.last_id))
+
+        if settings.SHOP_RESPONSE_CACHE_TTL and is_process_local():
+            self.stderr.write('SHOP_RESPONSE_CACHE is per process, cached order responses of the web processes '
+                              'keep the old prices until they expire')
+
+        start_time = datetime.datetime.now()
+        batches = repricing.get_batches(job.last_id)
+        products = 0
+        for done, (lo, hi, batch_products, batch_orders) in enumerate(
+                repricing.run(job, batches, pause=options['pause'], retries=options['retries']), 1):
+            products += batch_products
+            seconds = (datetime.datetime.now() - start_time).total_seconds()
+            self.stdout.write(
+                'ids {}-{}: {} products, {} orders; batch {}/{}, {:.0f} products/s, ETA {:.0f}s'.format(
+                    lo, hi, batch_products, batch_orders, done, len(batches),
+                    products / seconds if seconds else 0, seconds / done * (len(batches) - done),
+                )
+            )
+
+        total_sec = (datetime.datetime.now() - start_time).total_seconds()
+        self.stdout.write('Job {}: {} products repriced, {} orders refreshed in total. Repricing time: {}'.format(
+            job.name, job.products, job.orders, total_sec,
+        ))
@@ -0,0 +1,65 @@
+# Generated by Django 2.1.15 on 2026-10-18 12:48
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+BATCH_SIZE = 50000
+
+
+def backfill_item_arrays(apps, schema_editor):
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    Product = apps.get_model('shop', 'Product')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT min(id), max(id) FROM {}'.format(Order._meta.db_table))
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return
+        # non-atomic migration: every batch is committed separately
+        for start in range(min_id, max_id + 1, BATCH_SIZE):
+            cursor.execute(
+                'UPDATE {order_table} O SET '
+                'product_ids = ARRAY('
+                'SELECT I.product_id FROM {orderitem_table} I WHERE I.order_id = O.id ORDER BY 1), '
+                'manufacturer_ids = ARRAY('
+                'SELECT DISTINCT P.manufacturer_id FROM {orderitem_table} I '
+                'JOIN {product_table} P ON P.id = I.product_id WHERE I.order_id = O.id ORDER BY 1) '
+                'WHERE O.id BETWEEN %s AND %s'.format(
+                    order_table=Order._meta.db_table,
+                    orderitem_table=OrderItem._meta.db_table,
+                    product_table=Product._meta.db_table,
+                ),
+                [start, start + BATCH_SIZE - 1]
+            )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('shop', '0003_auto_20190129_0824'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='manufacturer_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='product_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.RunPython(backfill_item_arrays, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['product_ids'], name='shop_order_product_ids_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['manufacturer_ids'], name='shop_order_manuf_ids_gin'),
+        ),
+    ]
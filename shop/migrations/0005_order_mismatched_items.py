@@ -0,0 +1,52 @@
+# Generated by Django 2.1.15 on 2026-10-18 13:02
+
+from django.db import migrations, models
+
+BATCH_SIZE = 50000
+
+
+def backfill_mismatched_items(apps, schema_editor):
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    Product = apps.get_model('shop', 'Product')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT min(id), max(id) FROM {}'.format(Order._meta.db_table))
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return
+        # non-atomic migration: every batch is committed separately
+        for start in range(min_id, max_id + 1, BATCH_SIZE):
+            cursor.execute(
+                'UPDATE {order_table} O SET mismatched_items = ('
+                'SELECT count(*) FROM {orderitem_table} I JOIN {product_table} P ON P.id = I.product_id '
+                'WHERE I.order_id = O.id AND I.price <> P.price) '
+                'WHERE O.id BETWEEN %s AND %s'.format(
+                    order_table=Order._meta.db_table,
+                    orderitem_table=OrderItem._meta.db_table,
+                    product_table=Product._meta.db_table,
+                ),
+                [start, start + BATCH_SIZE - 1]
+            )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('shop', '0004_order_item_arrays'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='mismatched_items',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_mismatched_items, migrations.RunPython.noop),
+        # partial indexes are not supported by models.Index in Django 2.1
+        migrations.RunSQL(
+            'CREATE INDEX shop_order_mismatched_items_partial ON shop_order (id) WHERE mismatched_items > 0',
+            'DROP INDEX shop_order_mismatched_items_partial',
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.1.15 on 2026-10-18 12:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_order_mismatched_items'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='created',
+            field=models.DateField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='total_price',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created', 'id'], name='shop_order_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['total_price', 'id'], name='shop_order_total_price_id_idx'),
+        ),
+    ]
@@ -0,0 +1,122 @@
+import re
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 50000
+# frozen, the schema doesn't depend on the settings of the environment migrating;
+# change it with a new migration calling rebuild_orderitem_table
+PARTITIONS = 16
+
+
+def table_exists(cursor, table):
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [table])
+    return cursor.fetchone()[0]
+
+
+def rebuild_orderitem_table(schema_editor, partitions):
+    """
+    Recreate shop_orderitem hash-partitioned on order_id into `partitions` tables (a plain table if 0),
+    with the same columns, sequence, constraints and indexes. Rows are copied in batches of orders.
+
+    Unique constraints of a partitioned table must contain the partition key, so its primary key
+    is (id, order_id): id alone is not unique-indexed anymore, ids stay unique as long as they come
+    from the sequence. OrderItem looks its rows up by both, see OrderItem._do_update.
+
+    Each step commits, a failed run is resumed by migrating again:
+    1. rename shop_orderitem to shop_orderitem_old and create the new table (one transaction),
+    2. copy the orders above the last one copied, a transaction per batch,
+    3. drop shop_orderitem_old and create the constraints and indexes (one transaction).
+    To give up after a failure instead, in one transaction:
+    DROP TABLE shop_orderitem; ALTER TABLE shop_orderitem_old RENAME TO shop_orderitem;
+    ALTER SEQUENCE shop_orderitem_id_seq OWNED BY shop_orderitem.id;
+    """
+    connection = schema_editor.connection
+    if partitions and not getattr(connection.introspection, 'lists_partitioned_tables', False):
+        # flush would skip the partitioned table, see shop.checks
+        raise RuntimeError("Partitioning shop_orderitem requires the 'mysite.postgresql' or "
+                           "'mysite.pooled_postgresql' ENGINE")
+
+    table = 'shop_orderitem'
+    old_table = table + '_old'
+    with connection.cursor() as cursor:
+        if not table_exists(cursor, old_table):
+            with transaction.atomic(using=connection.alias):
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                sequence = cursor.fetchone()[0]
+                cursor.execute('ALTER TABLE {} RENAME TO {}'.format(table, old_table))
+                # partitions of an already partitioned table, their names are reused below
+                cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass',
+                               [old_table])
+                for (child,) in cursor.fetchall():
+                    if child.startswith(table + '_'):
+                        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(child, old_table + child[len(table):]))
+                cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS){}'.format(
+                    table, old_table, ' PARTITION BY HASH (order_id)' if partitions else '',
+                ))
+                for remainder in range(partitions):
+                    cursor.execute(
+                        'CREATE TABLE {table}_p{remainder} PARTITION OF {table} '
+                        'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'.format(
+                            table=table, partitions=partitions, remainder=remainder,
+                        )
+                    )
+                cursor.execute('ALTER SEQUENCE {} OWNED BY {}.id'.format(sequence, table))
+
+        cursor.execute(
+            'SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint '
+            "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f') ORDER BY contype DESC, conname",
+            [old_table]
+        )
+        constraints = cursor.fetchall()
+        cursor.execute(
+            'SELECT pg_get_indexdef(indexrelid) FROM pg_index I WHERE indrelid = %s::regclass AND NOT EXISTS ('
+            'SELECT 1 FROM pg_constraint C WHERE C.conindid = I.indexrelid AND C.conrelid = I.indrelid) '
+            'ORDER BY 1',
+            [old_table]
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        # batches are copied in order_id order, a run resumes after the last copied order
+        cursor.execute('SELECT max(order_id) FROM {}'.format(table))
+        copied_id = cursor.fetchone()[0]
+        cursor.execute('SELECT min(order_id), max(order_id) FROM {} WHERE order_id > %s'.format(old_table),
+                       [copied_id if copied_id is not None else -1])
+        min_id, max_id = cursor.fetchone()
+        if min_id is not None:
+            # non-atomic migration: every batch is committed separately
+            for start in range(min_id, max_id + 1, BATCH_SIZE):
+                cursor.execute(
+                    'INSERT INTO {} SELECT * FROM {} WHERE order_id BETWEEN %s AND %s'.format(table, old_table),
+                    [start, start + BATCH_SIZE - 1]
+                )
+
+        with transaction.atomic(using=connection.alias):
+            cursor.execute('DROP TABLE {}'.format(old_table))
+            # constraints and indexes are created with their names, after the old ones are dropped
+            for name, kind, definition in constraints:
+                if kind == 'p':
+                    definition = 'PRIMARY KEY (id, order_id)' if partitions else 'PRIMARY KEY (id)'
+                cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table, name, definition))
+            for definition in indexes:
+                cursor.execute(re.sub(r' ON (ONLY )?\S+ USING ', ' ON {} USING '.format(table), definition))
+        cursor.execute('ANALYZE {}'.format(table))
+
+
+def partition(apps, schema_editor):
+    rebuild_orderitem_table(schema_editor, PARTITIONS)
+
+
+def unpartition(apps, schema_editor):
+    rebuild_orderitem_table(schema_editor, 0)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('shop', '0006_order_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
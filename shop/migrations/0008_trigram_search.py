@@ -0,0 +1,42 @@
+import warnings
+
+from django.db import migrations
+
+# (index, table, column): substring searches, Django's icontains is UPPER(column) LIKE UPPER('%...%')
+INDEXES = (
+    ('shop_order_number_trgm', 'shop_order', 'number'),
+    ('shop_product_sku_trgm', 'shop_product', 'sku'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            warnings.warn('pg_trgm is not available on the database server (PostgreSQL contrib), '
+                          'order and SKU searches will scan the tables. Install it, then migrate to shop 0007 and back.')
+            return
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, table, column in INDEXES:
+            # non-atomic migration: tables stay writable while the indexes are built
+            cursor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING gin (UPPER({}) gin_trgm_ops)'.format(
+                name, table, column,
+            ))
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name, table, column in INDEXES:
+            cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('shop', '0007_orderitem_hash_partitions'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.1.15 on 2026-10-18 13:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_daily_sales(apps, schema_editor):
+    # one aggregate over all the items, rebuild_daily_sales --workers does the same in parallel
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    Product = apps.get_model('shop', 'Product')
+    DailySales = apps.get_model('shop', 'DailySales')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {sales_table} (day, manufacturer_id, status_id, items, revenue, orders) '
+            'SELECT O.created, P.manufacturer_id, O.status_id, count(*), sum(I.price), count(DISTINCT O.id) '
+            'FROM {order_table} O JOIN {orderitem_table} I ON I.order_id = O.id '
+            'JOIN {product_table} P ON P.id = I.product_id GROUP BY 1, 2, 3'.format(
+                sales_table=DailySales._meta.db_table,
+                order_table=Order._meta.db_table,
+                orderitem_table=OrderItem._meta.db_table,
+                product_table=Product._meta.db_table,
+            )
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_trigram_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('items', models.IntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('orders', models.IntegerField(default=0)),
+                ('manufacturer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='shop.Manufacturer')),
+                ('status', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='shop.OrderStatus')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysales',
+            unique_together={('day', 'manufacturer', 'status')},
+        ),
+        migrations.RunPython(fill_daily_sales, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.15 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_daily_sales'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RepricingJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(unique=True)),
+                ('last_id', models.IntegerField(default=0)),
+                ('products', models.IntegerField(default=0)),
+                ('orders', models.IntegerField(default=0)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
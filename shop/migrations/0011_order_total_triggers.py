@@ -0,0 +1,83 @@
+from django.db import migrations
+
+# Order.total_price = delivery_price + the prices of its items, kept by the statements writing them.
+# Item triggers are per statement, with the written rows in transition tables: a bulk insert
+# updates every order once. Transition tables don't allow column lists (UPDATE OF price, order_id),
+# other updates find no price changes.
+CREATE_TRIGGERS_SQL = """
+CREATE FUNCTION shop_order_set_total_price() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        -- items are added by their own triggers
+        NEW.total_price := NEW.delivery_price;
+    ELSE
+        NEW.total_price := NEW.total_price - OLD.delivery_price + NEW.delivery_price;
+    END IF;
+    RETURN NEW;
+END $$;
+
+CREATE TRIGGER shop_order_total_price_insert BEFORE INSERT ON shop_order
+FOR EACH ROW EXECUTE FUNCTION shop_order_set_total_price();
+
+CREATE TRIGGER shop_order_total_price_update BEFORE UPDATE OF delivery_price ON shop_order
+FOR EACH ROW WHEN (OLD.delivery_price IS DISTINCT FROM NEW.delivery_price)
+EXECUTE FUNCTION shop_order_set_total_price();
+
+CREATE FUNCTION shop_orderitem_apply_total_price() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    -- a transition table exists only in the triggers declaring it
+    IF TG_OP = 'INSERT' THEN
+        UPDATE shop_order O SET total_price = O.total_price + D.delta
+        FROM (SELECT order_id, sum(price) AS delta FROM new_items GROUP BY order_id) D
+        WHERE O.id = D.order_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE shop_order O SET total_price = O.total_price - D.delta
+        FROM (SELECT order_id, sum(price) AS delta FROM old_items GROUP BY order_id) D
+        WHERE O.id = D.order_id;
+    ELSE
+        UPDATE shop_order O SET total_price = O.total_price + D.delta
+        FROM (
+            SELECT order_id, sum(price) AS delta FROM (
+                SELECT order_id, price FROM new_items
+                UNION ALL
+                SELECT order_id, -price FROM old_items
+            ) C GROUP BY order_id
+        ) D
+        WHERE O.id = D.order_id AND D.delta <> 0;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER shop_orderitem_total_price_insert AFTER INSERT ON shop_orderitem
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION shop_orderitem_apply_total_price();
+
+CREATE TRIGGER shop_orderitem_total_price_update AFTER UPDATE ON shop_orderitem
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION shop_orderitem_apply_total_price();
+
+CREATE TRIGGER shop_orderitem_total_price_delete AFTER DELETE ON shop_orderitem
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT EXECUTE FUNCTION shop_orderitem_apply_total_price();
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER shop_orderitem_total_price_delete ON shop_orderitem;
+DROP TRIGGER shop_orderitem_total_price_update ON shop_orderitem;
+DROP TRIGGER shop_orderitem_total_price_insert ON shop_orderitem;
+DROP FUNCTION shop_orderitem_apply_total_price();
+DROP TRIGGER shop_order_total_price_update ON shop_order;
+DROP TRIGGER shop_order_total_price_insert ON shop_order;
+DROP FUNCTION shop_order_set_total_price();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_repricing_job'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGERS_SQL, DROP_TRIGGERS_SQL),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.15 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_order_total_triggers'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['total_price', 'created', 'id'], name='shop_order_total_created_idx'),
+        ),
+    ]
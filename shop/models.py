@@ -1,8 +1,24 @@
 # 15:26 - 19:30
-from django.db import models, transaction, connection
-from django.db.models import F
+import threading
+from contextlib import contextmanager
+
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.db import models, router, transaction, connection
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Length
 from django.db.models.expressions import CombinedExpression, Combinable
 
+from mysite.db import ReturningSaveMixin
+from shop.response_cache import bump_data_version
+
+# orders whose writes are tracked by DailySalesQuerySet.track in this thread
+_tracking = threading.local()
+
+
+def _tracked_orders():
+    return getattr(_tracking, 'orders', frozenset())
+
 
 class User(models.Model):
     allowed_groups = models.ManyToManyField('StatusGroup')
@@ -18,59 +34,226 @@ class OrderStatus(models.Model):
     group = models.ForeignKey('StatusGroup', models.CASCADE)
 
 
-class Order(models.Model):
-    created = models.DateField(auto_now_add=True, db_index=True)
+class OrderQuerySet(models.QuerySet):
+    # SQL expressions of the denormalized item aggregates, O is the order being updated
+    item_aggregates_sql = {
+        'product_ids': (
+            'ARRAY(SELECT I.product_id FROM {orderitem_table} I WHERE I.order_id = O.id ORDER BY 1)'
+        ),
+        'manufacturer_ids': (
+            'ARRAY(SELECT DISTINCT P.manufacturer_id FROM {orderitem_table} I '
+            'JOIN {product_table} P ON P.id = I.product_id WHERE I.order_id = O.id ORDER BY 1)'
+        ),
+        'mismatched_items': (
+            '(SELECT count(*) FROM {orderitem_table} I '
+            'JOIN {product_table} P ON P.id = I.product_id WHERE I.order_id = O.id AND I.price <> P.price)'
+        ),
+    }
+
+    def update(self, **kwargs):
+        bump_data_version(self.db)
+        if not set(kwargs) & set(Order.sales_fields):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            order_ids = list(self.order_by().values_list('id', flat=True))
+            with DailySales.objects.track(order_ids):
+                return super(OrderQuerySet, self.filter(id__in=order_ids)).update(**kwargs)
+
+    def refresh_item_aggregates(self, fields=None):
+        """
+        Recompute denormalized item aggregates (Order.item_aggregate_fields) of the selected orders.
+        Every OrderItem write and product price change ends here, so it also bumps the order data version.
+        """
+        bump_data_version(self.db)
+        fields = fields or Order.item_aggregate_fields
+        ids_sql, ids_params = self.order_by().values('id').query.sql_with_params()
+        assignments = ', '.join(
+            '{} = {}'.format(field, self.item_aggregates_sql[field]).format(
+                orderitem_table=OrderItem._meta.db_table,
+                product_table=Product._meta.db_table,
+            )
+            for field in fields
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE {order_table} O SET {assignments} WHERE O.id IN ({ids_sql})'.format(
+                    order_table=Order._meta.db_table,
+                    assignments=assignments,
+                    ids_sql=ids_sql,
+                ),
+                ids_params
+            )
+            return cursor.rowcount
+
+
+class Order(ReturningSaveMixin, models.Model):
+    created = models.DateField(auto_now_add=True)
     number = models.TextField(unique=True)
     delivery_price = models.IntegerField(default=0)
     status = models.ForeignKey('OrderStatus', models.PROTECT)
-    total_price = models.IntegerField(default=0, db_index=True)
+    total_price = models.IntegerField(default=0)
+    # denormalized from OrderItem for single-table item filters, see OrderQuerySet.refresh_item_aggregates
+    product_ids = ArrayField(models.IntegerField(), default=list, blank=True)
+    manufacturer_ids = ArrayField(models.IntegerField(), default=list, blank=True)
+    # number of items sold not at the product price, partial index on mismatched_items > 0
+    mismatched_items = models.IntegerField(default=0)
+
+    objects = OrderQuerySet.as_manager()
+
+    # maintained by OrderItem writes, an instance never writes its (possibly stale) copy back
+    item_aggregate_fields = ('product_ids', 'manufacturer_ids', 'mismatched_items')
+    # the daily sales rollup depends on these, see DailySalesQuerySet.track
+    sales_fields = ('created', 'status', 'status_id')
+
+    class Meta:
+        indexes = [
+            # keyset pagination: every ordering ends with id, see shop.pagination
+            models.Index(fields=['created', 'id'], name='shop_order_created_id_idx'),
+            models.Index(fields=['total_price', 'id'], name='shop_order_total_price_id_idx'),
+            models.Index(fields=['total_price', 'created', 'id'], name='shop_order_total_created_idx'),
+            GinIndex(fields=['product_ids'], name='shop_order_product_ids_gin'),
+            GinIndex(fields=['manufacturer_ids'], name='shop_order_manuf_ids_gin'),
+        ]
 
     @classmethod
     def from_db(cls, db, field_names, values):
-        return super().from_db(db, field_names, values)
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_sales_values = instance.get_sales_values()
+        return instance
+
+    def get_sales_values(self):
+        # without loading deferred fields
+        return {name: self.__dict__.get(name) for name in ('created', 'status_id')}
 
     def save(self, *args, **kwargs):
-        # update total_price by changing delivery_price
+        # total_price is kept by triggers (migration 0011): the delivery_price on insert, plus its change
+        # on update, plus the item prices
         if not self._state.adding:
-            if isinstance(self.total_price, Combinable):
-                self.total_price = self.total_price - F('delivery_price') + self.delivery_price
+            if not isinstance(self.total_price, Combinable):
+                # not the (possibly stale) copy of the instance
+                self.total_price = F('total_price')
+            if kwargs.get('update_fields') is None:
+                # nor the fields of the rollup (see track) that haven't changed since they were loaded
+                loaded = getattr(self, '_loaded_sales_values', {})
+                unchanged = [name for name, value in self.get_sales_values().items() if loaded.get(name) == value]
+                kwargs['update_fields'] = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name not in self.item_aggregate_fields and f.attname not in unchanged
+                ]
+            # total_price is loaded back by the UPDATE ... RETURNING, see ReturningSaveMixin
+            if set(kwargs['update_fields']) & set(self.sales_fields):
+                with DailySales.objects.track([self.pk]):
+                    super().save(*args, **kwargs)
+                self._loaded_sales_values = self.get_sales_values()
             else:
-                self.total_price = F('total_price') - F('delivery_price') + self.delivery_price
-            super().save(*args, **kwargs)
-            self.refresh_from_db(fields=('total_price', )) # possible to use deferred field instead
+                super().save(*args, **kwargs)
         else:
+            # as set by the trigger
             self.total_price = self.delivery_price
             super().save(*args, **kwargs)
+            self._loaded_sales_values = self.get_sales_values()
+
+
+class OrderItemQuerySet(models.QuerySet):
+    def bulk_add(self, items, batch_size=None):
+        """
+        Insert new items with bulk_create (their prices are added to Order.total_price by
+        the insert trigger, once per order) and refresh the order item aggregates, in one transaction.
+        """
+        items = list(items)
+        if not items:
+            return items
+
+        order_ids = {item.order_id for item in items}
+        with DailySales.objects.track(order_ids):
+            items = self.bulk_create(items, batch_size=batch_size)
+            Order.objects.filter(id__in=order_ids).refresh_item_aggregates()
+        return items
 
+    def update(self, **kwargs):
+        bump_data_version(self.db)
+        if not set(kwargs) & set(OrderItem.sales_fields):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            order_ids = list(self.order_by().values_list('order_id', flat=True).distinct())
+            # items moved to another order
+            order = kwargs.get('order', kwargs.get('order_id'))
+            if order is not None:
+                order_ids.append(getattr(order, 'pk', order))
+            with DailySales.objects.track(order_ids):
+                result = super().update(**kwargs)
+                Order.objects.filter(id__in=order_ids).refresh_item_aggregates()
+            return result
 
-class OrderItem(models.Model):
+    def delete(self):
+        with transaction.atomic():
+            order_ids = list(self.order_by().values_list('order_id', flat=True).distinct())
+            with DailySales.objects.track(order_ids):
+                result = super().delete()
+            Order.objects.filter(id__in=order_ids).refresh_item_aggregates()
+        return result
+
+
+class OrderItem(ReturningSaveMixin, models.Model):
     created = models.DateField(auto_now_add=True)
     order = models.ForeignKey('Order', models.PROTECT)
     product = models.ForeignKey('Product', models.PROTECT)
     price = models.IntegerField()
 
+    objects = OrderItemQuerySet.as_manager()
+
+    # the order item aggregates and the daily sales rollup (see DailySalesQuerySet.track) depend on these
+    sales_fields = ('order', 'order_id', 'product', 'product_id', 'price')
+
     class Meta:
         unique_together = ('order', 'product')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_order_id = instance.__dict__.get('order_id')
+        return instance
+
     def save(self, *args, **kwargs):
-        if not self._state.adding:
-            with transaction.atomic():
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        'UPDATE {order_table} O '
-                        'SET total_price = O.total_price + %s - '
-                        '(SELECT price FROM {orderitem_table} I WHERE I.id = %s) WHERE O.id = %s'.format(
-                            order_table=Order._meta.db_table,
-                            orderitem_table=self._meta.db_table,
-                        ),
-                        [self.price, self.pk, self.product_id]
-                    )
-                super().save()
-        else:
-            with transaction.atomic():
-                super().save()
-                self.order.total_price = F('total_price') + self.price
-                self.order.save()
+        # Order.total_price is updated by the item triggers (migration 0011)
+        with DailySales.objects.track([self.order_id]):
+            super().save(*args, **kwargs)
+            Order.objects.filter(id=self.order_id).refresh_item_aggregates()
+        self._loaded_order_id = self.order_id
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # the primary key is (id, order_id) and id alone isn't unique-indexed (migration 0007):
+        # the row is looked up by both, in its own partition
+        loaded_order_id = getattr(self, '_loaded_order_id', None)
+        if loaded_order_id is not None:
+            base_qs = base_qs.filter(order_id=loaded_order_id)
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+    def delete(self, using=None, keep_parents=False):
+        # by id and order_id, see _do_update; the queryset delete tracks the sales and refreshes the order
+        using = using or router.db_for_write(OrderItem, instance=self)
+        result = OrderItem.objects.using(using).filter(
+            pk=self.pk, order_id=getattr(self, '_loaded_order_id', self.order_id),
+        ).delete()
+        setattr(self, self._meta.pk.attname, None)
+        return result
+
+
+class ProductQuerySet(models.QuerySet):
+    def search_sku(self, fragment):
+        """
+        Products with `fragment` in the SKU (a trigram index lookup, see migration 0008), the best matches
+        first: the SKU itself, SKUs starting with it, then the shortest ones.
+        """
+        return self.filter(sku__icontains=fragment).annotate(
+            sku_rank=Case(
+                When(sku__iexact=fragment, then=Value(0)),
+                When(sku__istartswith=fragment, then=Value(1)),
+                default=Value(2),
+                output_field=IntegerField(),
+            ),
+            sku_length=Length('sku'),
+        ).order_by('sku_rank', 'sku_length', 'id')
 
 
 class Product(models.Model):
@@ -78,6 +261,165 @@ class Product(models.Model):
     price = models.IntegerField()
     manufacturer = models.ForeignKey('Manufacturer', models.PROTECT)
 
+    objects = ProductQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_manufacturer_id = instance.__dict__.get('manufacturer_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            super().save(*args, **kwargs)
+        else:
+            update_fields = kwargs.get('update_fields')
+            manufacturer_changed = (
+                self.manufacturer_id != getattr(self, '_loaded_manufacturer_id', None)
+                and (update_fields is None or bool({'manufacturer', 'manufacturer_id'} & set(update_fields)))
+            )
+            orders = Order.objects.filter(product_ids__contains=[self.pk])
+            # price change may (un)match items of orders with this product,
+            # manufacturer change moves their manufacturer_ids and sales
+            with transaction.atomic():
+                if manufacturer_changed:
+                    with DailySales.objects.track(orders.values_list('id', flat=True)):
+                        super().save(*args, **kwargs)
+                    orders.refresh_item_aggregates(fields=('manufacturer_ids', 'mismatched_items'))
+                else:
+                    super().save(*args, **kwargs)
+                    orders.refresh_item_aggregates(fields=('mismatched_items', ))
+        self._loaded_manufacturer_id = self.manufacturer_id
+
 
 class Manufacturer(models.Model):
     name = models.TextField(unique=True)
+
+
+class DailySalesQuerySet(models.QuerySet):
+    # contribution of the orders %s to the rollup, O is the order
+    contributions_sql = (
+        'SELECT O.created, P.manufacturer_id, O.status_id, count(*), sum(I.price), count(DISTINCT O.id) '
+        'FROM {order_table} O JOIN {orderitem_table} I ON I.order_id = O.id '
+        'JOIN {product_table} P ON P.id = I.product_id {where} GROUP BY 1, 2, 3'
+    )
+
+    def get_contributions_sql(self, where):
+        return self.contributions_sql.format(
+            order_table=Order._meta.db_table,
+            orderitem_table=OrderItem._meta.db_table,
+            product_table=Product._meta.db_table,
+            where=where,
+        )
+
+    @contextmanager
+    def track(self, order_ids):
+        """
+        Keep the rollup up to date with the writes to the orders `order_ids` (their status or date, their items,
+        prices or products) done in the block: the contributions of these orders are subtracted before
+        and added back after it, in the same transaction. The orders are locked for the block.
+        Nested blocks only track the orders not tracked by the outer ones.
+        """
+        order_ids = sorted(set(order_ids) - _tracked_orders())
+        with transaction.atomic():
+            if not order_ids:
+                yield
+                return
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'WITH L AS (SELECT id FROM {order_table} WHERE id = ANY(%s) ORDER BY id FOR UPDATE) '.format(
+                        order_table=Order._meta.db_table,
+                    ) + self.get_contributions_sql(
+                        # order_id = ANY prunes the item partitions
+                        'JOIN L ON L.id = O.id WHERE I.order_id = ANY(%s)'
+                    ),
+                    [order_ids, order_ids]
+                )
+                before = cursor.fetchall()
+            _tracking.orders = _tracked_orders() | set(order_ids)
+            try:
+                yield
+            finally:
+                _tracking.orders -= set(order_ids)
+            self.add_orders(order_ids, subtract=before)
+
+    def add_orders(self, order_ids, subtract=()):
+        """
+        Add the current contributions of the orders `order_ids` (e.g. just created) to the rollup,
+        minus `subtract` rows (day, manufacturer_id, status_id, items, revenue, orders).
+        """
+        values = ''.join(' UNION ALL SELECT %s::date, %s, %s, -%s, -%s, -%s' for _ in subtract)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {sales_table} AS S (day, manufacturer_id, status_id, items, revenue, orders) '
+                'SELECT day, manufacturer_id, status_id, sum(items), sum(revenue), sum(orders) FROM ('
+                '{contributions}{values}) D (day, manufacturer_id, status_id, items, revenue, orders) '
+                'GROUP BY 1, 2, 3 HAVING sum(items) <> 0 OR sum(revenue) <> 0 OR sum(orders) <> 0 '
+                'ON CONFLICT (day, manufacturer_id, status_id) DO UPDATE SET '
+                'items = S.items + EXCLUDED.items, revenue = S.revenue + EXCLUDED.revenue, '
+                'orders = S.orders + EXCLUDED.orders'.format(
+                    sales_table=DailySales._meta.db_table,
+                    contributions=self.get_contributions_sql('WHERE O.id = ANY(%s) AND I.order_id = ANY(%s)'),
+                    values=values,
+                ),
+                [list(order_ids), list(order_ids)] + [value for row in subtract for value in row]
+            )
+
+    def rebuild(self, day_from, day_to):
+        """
+        Recompute the rollup of the days in [day_from, day_to] from the orders, returns the number of rows.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            # tracked writes to these orders wait, or are already committed and are recomputed here
+            cursor.execute(
+                'SELECT count(*) FROM (SELECT FROM {order_table} WHERE created BETWEEN %s AND %s FOR SHARE) L'.format(
+                    order_table=Order._meta.db_table,
+                ),
+                [day_from, day_to]
+            )
+            cursor.execute(
+                'DELETE FROM {sales_table} WHERE day BETWEEN %s AND %s'.format(
+                    sales_table=DailySales._meta.db_table,
+                ),
+                [day_from, day_to]
+            )
+            cursor.execute(
+                'INSERT INTO {sales_table} (day, manufacturer_id, status_id, items, revenue, orders) '
+                '{contributions}'.format(
+                    sales_table=DailySales._meta.db_table,
+                    contributions=self.get_contributions_sql('WHERE O.created BETWEEN %s AND %s'),
+                ),
+                [day_from, day_to]
+            )
+            return cursor.rowcount
+
+
+class DailySales(models.Model):
+    """
+    Items sold per day (Order.created), product manufacturer and order status. Maintained by the order
+    and item writes (see DailySalesQuerySet.track), rebuilt by the rebuild_daily_sales command.
+    """
+    day = models.DateField()
+    manufacturer = models.ForeignKey('Manufacturer', models.CASCADE)
+    status = models.ForeignKey('OrderStatus', models.CASCADE)
+    items = models.IntegerField(default=0)
+    revenue = models.BigIntegerField(default=0)
+    orders = models.IntegerField(default=0)
+
+    objects = DailySalesQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('day', 'manufacturer', 'status')
+
+
+class RepricingJob(models.Model):
+    """
+    Progress of a product repricing (see shop.repricing), committed with every batch: an interrupted job
+    resumes after last_id.
+    """
+    name = models.TextField(unique=True)
+    last_id = models.IntegerField(default=0)
+    products = models.IntegerField(default=0)
+    orders = models.IntegerField(default=0)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
@@ -0,0 +1,184 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+from rest_framework.utils.urls import replace_query_param
+
+from mysite.concurrency import fetch_concurrently
+
+# position - values of every ordering field (tiebreaker included) of the row the page starts after
+Cursor = namedtuple('Cursor', ('reverse', 'position'))
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Keyset (seek) pagination over the whole ordering.
+
+    Unlike CursorPagination, which filters on the first ordering field only and falls back to
+    offsets for ties, the ordering always ends with the unique `tiebreaker` field and the cursor
+    keeps the values of all ordering fields, so every page is a range condition on
+    an (ordering fields..., id) index and never needs an offset.
+    """
+    page_size_query_param = 'page_size'
+    tiebreaker = 'id'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if self.tiebreaker not in [field.lstrip('-') for field in ordering]:
+            # same direction as the last field so (..., id) indexes can be scanned either way
+            ordering += ('-' + self.tiebreaker if ordering[-1].startswith('-') else self.tiebreaker, )
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            reverse, current_position = False, None
+        else:
+            reverse, current_position = self.cursor
+            current_position = self.clean_position(queryset, current_position)
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if current_position is not None:
+            queryset = self.filter_after_position(queryset, ordering, current_position)
+
+        # fetch an extra row to know whether there is a page following this one,
+        # one-to-many prefetches are queried at the same time as each other
+        results = fetch_concurrently(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following_position = len(results) > len(self.page)
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None
+            self.has_previous = has_following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None
+
+        if self.page:
+            self.next_position = self._get_position_from_instance(self.page[-1], self.ordering)
+            self.previous_position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            self.next_position = self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def filter_after_position(self, queryset, ordering, position):
+        """
+        Keep rows strictly after `position` in `ordering`.
+        """
+        directions = {field.startswith('-') for field in ordering}
+        names = [field.lstrip('-') for field in ordering]
+        columns = self._get_columns(queryset, names)
+
+        if len(directions) == 1 and columns is not None:
+            # a row value comparison is a single index condition on (field..., id)
+            operator = '<' if directions.pop() else '>'
+            return queryset.extra(
+                where=['({}) {} ({})'.format(', '.join(columns), operator, ', '.join(['%s'] * len(columns)))],
+                params=list(position),
+            )
+
+        # mixed directions or annotations: lexicographic OR of prefixes,
+        # the first field bound is repeated so the planner gets a range on it
+        conditions = []
+        for i, (field, value) in enumerate(zip(ordering, position)):
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            equal_prefix = {name: prefix_value for name, prefix_value in zip(names[:i], position[:i])}
+            conditions.append(Q(**equal_prefix) & Q(**{names[i] + lookup: value}))
+        first_bound = Q(**{names[0] + ('__lte' if ordering[0].startswith('-') else '__gte'): position[0]})
+        return queryset.filter(first_bound & reduce(or_, conditions))
+
+    def clean_position(self, queryset, position):
+        """
+        Cursor values converted by the ordering fields, a crafted cursor is not found.
+        """
+        values = []
+        for name, value in zip([field.lstrip('-') for field in self.ordering], position):
+            field = self._get_field(queryset, name)
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                raise NotFound(self.invalid_cursor_message)
+            # rows are never after NULL, and lookups reject it
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            values.append(value)
+        return values
+
+    def _get_field(self, queryset, name):
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        try:
+            return queryset.model._meta.get_field('id' if name == 'pk' else name)
+        except FieldDoesNotExist:
+            raise NotFound(self.invalid_cursor_message)
+
+    def _get_columns(self, queryset, names):
+        # quoted table.column for concrete model fields, None if any name is an annotation
+        model = queryset.model
+        quote_name = connections[queryset.db].ops.quote_name
+        columns = []
+        for name in names:
+            if name in queryset.query.annotations:
+                return None
+            try:
+                field = model._meta.get_field('id' if name == 'pk' else name)
+            except FieldDoesNotExist:
+                return None
+            columns.append('{}.{}'.format(quote_name(model._meta.db_table), quote_name(field.column)))
+        return columns
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(reverse=False, position=self.next_position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(reverse=True, position=self.previous_position))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            reverse, *position = json.loads(urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(reverse=bool(reverse), position=position)
+
+    def encode_cursor(self, cursor):
+        # compact json [reverse, value..., id], dates are sent as iso strings
+        data = json.dumps([int(cursor.reverse)] + list(cursor.position), separators=(',', ':'), default=str)
+        encoded = urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _get_position_from_instance(self, instance, ordering):
+        names = [field.lstrip('-') for field in ordering]
+        if isinstance(instance, dict):
+            return [instance[name] for name in names]
+        return [getattr(instance, name) for name in names]
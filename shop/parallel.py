@@ -0,0 +1,45 @@
+import multiprocessing
+
+from django.db import connection, connections
+
+
+def split_range(start, stop, size):
+    """
+    Split inclusive id range [start, stop] into inclusive (lo, hi) chunks of at most `size` ids.
+    """
+    return [(lo, min(lo + size - 1, stop)) for lo in range(start, stop + 1, size)]
+
+
+def execute_sql(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+    return sql
+
+
+def get_partitions(table):
+    """
+    Partitions of `table`, each can be loaded or maintained by a separate worker.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass ORDER BY 1', [table]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def run_parallel(func, tasks, workers):
+    """
+    Yield func(task) for every task, computed by `workers` forked processes in completion order.
+
+    Every worker process opens its own database connections. func must be a module-level
+    function; with workers <= 1 tasks run in this process.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    # forked children must not share the parent's connection sockets
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        yield from pool.imap_unordered(func, tasks)
@@ -0,0 +1,183 @@
+import bisect
+import csv
+import hashlib
+import json
+import time
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, Max, Min
+from django.utils import timezone
+from psycopg2 import errorcodes
+
+from shop.models import Order, OrderItem, Product, RepricingJob
+from shop.parallel import split_range
+
+# a batch waiting for these is rolled back and retried
+RETRY_ERRORS = (errorcodes.LOCK_NOT_AVAILABLE, errorcodes.DEADLOCK_DETECTED)
+
+
+def read_price_file(path):
+    """
+    {sku: price} from a CSV file with `sku` and `price` columns.
+    """
+    with open(path, newline='') as f:
+        return {row['sku']: int(row['price']) for row in csv.DictReader(f)}
+
+
+def resolve_skus(sku_prices, chunk_size=10000):
+    """
+    {product id: price} of `sku_prices` and the list of unknown SKUs.
+    """
+    skus = list(sku_prices)
+    prices, known = {}, set()
+    for start in range(0, len(skus), chunk_size):
+        for sku, product_id in Product.objects.filter(sku__in=skus[start:start + chunk_size]).values_list('sku', 'id'):
+            prices[product_id] = sku_prices[sku]
+            known.add(sku)
+    return prices, [sku for sku in skus if sku not in known]
+
+
+class Repricing:
+    """
+    Changes product prices in batches of ids. Every batch is a transaction updating the products, the
+    Order.mismatched_items of their orders and the progress of the RepricingJob, so it's never applied twice.
+    Rows locked by other writers are waited for at most `lock_timeout` milliseconds, then the batch is retried.
+    """
+    kind = None
+
+    def __init__(self, batch_size=1000, lock_timeout=2000):
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+
+    def get_key(self):
+        raise NotImplementedError
+
+    def get_name(self):
+        data = json.dumps(self.get_key(), sort_keys=True, default=str)
+        return '{}:{}'.format(self.kind, hashlib.md5(data.encode()).hexdigest())
+
+    def get_job(self, name=None):
+        return RepricingJob.objects.get_or_create(name=name or self.get_name())[0]
+
+    def get_batches(self, after_id):
+        """
+        Inclusive (lo, hi) id ranges with at most batch_size products to change each, above `after_id`.
+        """
+        raise NotImplementedError
+
+    def new_prices_sql(self, lo, hi):
+        """
+        SQL selecting (id, price) of the products in [lo, hi] to change and its parameters.
+        """
+        raise NotImplementedError
+
+    def apply_batch(self, job, lo, hi):
+        sql, params = self.new_prices_sql(lo, hi)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", [str(self.lock_timeout)])
+            cursor.execute(
+                'UPDATE {product_table} P SET price = N.price FROM ({new_prices}) N (id, price) '
+                'WHERE P.id = N.id AND P.id BETWEEN %s AND %s AND P.price <> N.price RETURNING P.id'.format(
+                    product_table=Product._meta.db_table,
+                    new_prices=sql,
+                ),
+                params + [lo, hi]
+            )
+            product_ids = [row[0] for row in cursor.fetchall()]
+            orders = 0
+            if product_ids:
+                # the item index on product_id, the planner overestimates product_ids && of many ids;
+                # the other item aggregates don't depend on product prices; it bumps the order data version,
+                # which reaches the web processes only through a shared SHOP_RESPONSE_CACHE
+                order_ids = OrderItem.objects.filter(product_id__in=product_ids).values('order_id')
+                orders = Order.objects.filter(id__in=order_ids).refresh_item_aggregates(
+                    fields=('mismatched_items', )
+                )
+            RepricingJob.objects.filter(pk=job.pk).update(
+                last_id=hi, products=F('products') + len(product_ids), orders=F('orders') + orders,
+            )
+        job.last_id = hi
+        job.products += len(product_ids)
+        job.orders += orders
+        return len(product_ids), orders
+
+    def run(self, job, batches, pause=0, retries=3):
+        """
+        Apply `batches` (see get_batches) to the products, sleeping `pause` seconds after every batch,
+        and mark the job finished. Yields (lo, hi, products, orders) of every batch.
+        """
+        for lo, hi in batches:
+            for attempt in range(retries + 1):
+                try:
+                    products, orders = self.apply_batch(job, lo, hi)
+                    break
+                except OperationalError as e:
+                    if getattr(e.__cause__, 'pgcode', None) not in RETRY_ERRORS or attempt == retries:
+                        raise
+                    time.sleep(pause)
+            yield lo, hi, products, orders
+            if pause:
+                time.sleep(pause)
+        job.finished = timezone.now()
+        RepricingJob.objects.filter(pk=job.pk).update(finished=job.finished)
+
+
+class PriceListRepricing(Repricing):
+    """
+    New prices from a list, {product id: price}.
+    """
+    kind = 'prices'
+
+    def __init__(self, prices, **kwargs):
+        super().__init__(**kwargs)
+        self.prices = sorted(prices.items())
+        self.ids = [product_id for product_id, price in self.prices]
+
+    def get_key(self):
+        return self.prices
+
+    def get_batches(self, after_id):
+        ids = self.ids[bisect.bisect_right(self.ids, after_id):]
+        return [(ids[start], ids[min(start + self.batch_size, len(ids)) - 1])
+                for start in range(0, len(ids), self.batch_size)]
+
+    def new_prices_sql(self, lo, hi):
+        prices = self.prices[bisect.bisect_left(self.ids, lo):bisect.bisect_right(self.ids, hi)]
+        return (
+            'VALUES {}'.format(', '.join(['(%s, %s)'] * len(prices))),
+            [value for pair in prices for value in pair],
+        )
+
+
+class PercentRepricing(Repricing):
+    """
+    Prices of the products of manufacturers changed by a percentage, {manufacturer id: percent},
+    rounded to whole units.
+    """
+    kind = 'percent'
+
+    def __init__(self, percents, **kwargs):
+        super().__init__(**kwargs)
+        self.percents = percents
+
+    def get_key(self):
+        return sorted(self.percents.items())
+
+    def get_batches(self, after_id):
+        bounds = Product.objects.filter(manufacturer_id__in=self.percents, id__gt=after_id).aggregate(
+            lo=Min('id'), hi=Max('id'),
+        )
+        if bounds['lo'] is None:
+            return []
+        return split_range(bounds['lo'], bounds['hi'], self.batch_size)
+
+    def new_prices_sql(self, lo, hi):
+        return (
+            'SELECT P.id, GREATEST(round(P.price * (100 + R.percent) / 100), 0)::integer '
+            'FROM {product_table} P JOIN (VALUES {values}) R (manufacturer_id, percent) '
+            'ON R.manufacturer_id = P.manufacturer_id WHERE P.id BETWEEN %s AND %s'.format(
+                product_table=Product._meta.db_table,
+                values=', '.join(['(%s, %s::numeric)'] * len(self.percents)),
+            ),
+            [value for pair in self.percents.items() for value in pair] + [lo, hi],
+        )
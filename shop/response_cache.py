@@ -0,0 +1,155 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+VERSION_KEY = 'shop:orders:version'
+LOCK_POLL_INTERVAL = 0.05  # seconds
+
+
+def get_cache():
+    return caches[settings.SHOP_RESPONSE_CACHE]
+
+
+def get_data_version():
+    """
+    Global version of order data, a part of every cached response key.
+    """
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # start above any version used before the key was evicted
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def is_process_local():
+    """
+    True if the cache is per process (the default locmem backend): versions bumped by management
+    commands or other workers never reach the web processes, their cached responses only expire.
+    """
+    return isinstance(get_cache(), LocMemCache)
+
+
+def _incr_data_version():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        get_data_version()
+
+
+def bump_data_version(using=None):
+    """
+    Invalidate cached order responses, now and once more when the current transaction commits:
+    a response computed in between may have read data from before the commit.
+    """
+    _incr_data_version()
+    transaction.on_commit(_incr_data_version, using=using)
+
+
+def make_response_cache_key(request, access_context):
+    data = json.dumps([
+        get_data_version(),
+        request.get_host(),
+        request.path,
+        sorted((name, sorted(values)) for name, values in request.query_params.lists()),
+        access_context.status_ids,
+        access_context.favorite_manufacturer_ids,
+    ], default=str)
+    return 'shop:response:' + hashlib.md5(data.encode()).hexdigest()
+
+
+class CacheLock:
+    """
+    Lock held while a result is computed: a cache.add() entry expiring after `timeout` seconds,
+    atomic across processes with memcached and redis, within the process with locmem.
+    """
+
+    def __init__(self, cache, key, timeout):
+        self.cache = cache
+        self.key = key + ':lock'
+        self.timeout = timeout
+
+    def acquire(self):
+        return self.cache.add(self.key, 1, self.timeout)
+
+    def release(self):
+        self.cache.delete(self.key)
+
+
+class FileLock:
+    """
+    Lock of FileBasedCache, whose add() isn't atomic: flock() of a file in the cache directory,
+    released by the system if the process dies.
+    """
+
+    def __init__(self, cache, key, timeout):
+        self.path = os.path.join(cache._dir, hashlib.md5(key.encode()).hexdigest() + '.lock')
+        self.file = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.file = lock_file
+        return True
+
+    def release(self):
+        # a waiter locking the removed file finds the result once it has the lock
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def get_lock(cache, key, timeout):
+    if isinstance(cache, FileBasedCache):
+        return FileLock(cache, key, timeout)
+    return CacheLock(cache, key, timeout)
+
+
+def get_or_compute(key, compute):
+    """
+    Cached compute() result. Concurrent calls with the same key are coalesced: one computes it
+    while others (in any process sharing the cache) wait for the result, at most SHOP_RESPONSE_CACHE_LOCK_TIMEOUT.
+    """
+    cache = get_cache()
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    lock_timeout = settings.SHOP_RESPONSE_CACHE_LOCK_TIMEOUT
+    lock = get_lock(cache, key, lock_timeout)
+    deadline = time.monotonic() + lock_timeout
+    while not lock.acquire():
+        if time.monotonic() >= deadline:
+            return compute()
+        time.sleep(LOCK_POLL_INTERVAL)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    try:
+        # computed by the previous holder of the lock
+        result = cache.get(key)
+        if result is None:
+            result = compute()
+            cache.set(key, result, settings.SHOP_RESPONSE_CACHE_TTL)
+    finally:
+        lock.release()
+    return result
@@ -9,6 +9,12 @@ class OrderStatusSerializer(serializers.ModelSerializer):
         fields = ('name', 'group')
 
 
+class ProductSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = ('id', 'sku', 'price', 'manufacturer')
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -21,3 +27,61 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ('id', 'created', 'number', 'delivery_price', 'status', 'total_price', 'items')
 
     items = OrderItemSerializer(many=True, source='orderitem_set')
+
+
+class OrderValuesSerializer:
+    """
+    Read-only fast path producing the same data as OrderSerializer(many=True).
+
+    Works on dicts from `prepare_queryset()` instead of model instances and DRF fields:
+    items of all orders are fetched with one values_list() query and nested directly.
+    """
+    order_fields = ('id', 'created', 'number', 'delivery_price', 'status', 'total_price')
+
+    def __init__(self, instance=None, many=True, **kwargs):
+        assert many, 'OrderValuesSerializer serializes lists only'
+        self.instance = instance
+
+    @classmethod
+    def prepare_queryset(cls, queryset):
+        # annotations stay in the rows for cursor positions (e.g. slow_total_price ordering)
+        return queryset.select_related(None).prefetch_related(None).values(
+            *cls.order_fields, *queryset.query.annotations
+        )
+
+    @property
+    def data(self):
+        orders = [
+            {
+                'id': row['id'],
+                'created': row['created'].isoformat(),
+                'number': row['number'],
+                'delivery_price': row['delivery_price'],
+                'status': row['status'],
+                'total_price': row['total_price'],
+                'items': [],
+            }
+            for row in self.instance
+        ]
+        orders_by_id = {order['id']: order for order in orders}
+        if orders_by_id:
+            items = OrderItem.objects.filter(order_id__in=orders_by_id).order_by('id').values_list(
+                'created', 'order_id', 'product_id', 'price',
+            )
+            for created, order_id, product_id, price in items:
+                orders_by_id[order_id]['items'].append({
+                    'created': created.isoformat(),
+                    'order': order_id,
+                    'product': product_id,
+                    'price': price,
+                })
+        return orders
+
+
+class SalesSerializer(serializers.Serializer):
+    # rows of DailySales grouped by day and manufacturer, see SalesReportView
+    day = serializers.DateField()
+    manufacturer = serializers.IntegerField()
+    items = serializers.IntegerField(source='total_items')
+    revenue = serializers.IntegerField(source='total_revenue')
+    orders = serializers.IntegerField(source='total_orders')
@@ -0,0 +1,40 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from shop.access import access_context_cache
+from shop.models import User, OrderStatus, Order
+from shop.response_cache import bump_data_version
+
+
+@receiver(m2m_changed, sender=User.allowed_groups.through)
+@receiver(m2m_changed, sender=User.favorite_manufactures.through)
+def invalidate_user_access_context(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        access_context_cache.delete(instance.pk)
+    elif pk_set is None:
+        # reverse clear (e.g. group.user_set.clear()) doesn't report affected users
+        access_context_cache.clear()
+    else:
+        for user_id in pk_set:
+            access_context_cache.delete(user_id)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user_access_context(sender, instance, **kwargs):
+    access_context_cache.delete(instance.pk)
+
+
+@receiver(post_save, sender=OrderStatus)
+@receiver(post_delete, sender=OrderStatus)
+def invalidate_all_access_contexts(sender, **kwargs):
+    # status moved to another group or removed - any user may be affected
+    access_context_cache.clear()
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_order_responses(sender, using, **kwargs):
+    # OrderItem and Product price writes bump the version in OrderQuerySet.refresh_item_aggregates
+    bump_data_version(using)
@@ -1,11 +1,50 @@
-from django.db.models import Avg, F
-from django.test import TestCase
-from django.urls import reverse
+import asyncio
+import base64
+import csv
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from io import StringIO
+from unittest import mock
+
+from psycopg2 import extensions
 from rest_framework import status
 
-from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Product, Manufacturer
-from shop.factories import ManufacturerFactory, ProductFactory, OrderFactory, OrderItemFactory
-from shop.serializers import OrderSerializer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Avg, Count, F, Prefetch, Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from mysite import metrics, routers
+from mysite.asgi import application as asgi_application
+from mysite.concurrency import fetch_concurrently, run_concurrently
+from mysite.pooled_postgresql.base import DatabaseWrapper, pool_utilization
+from mysite.pooled_postgresql.pool import ConnectionPool, PoolTimeout, no_wait
+from mysite.query_guard import QueryBudgetExceeded, QueryCapture, QueryGuardTestMixin, normalize_sql
+from shop.access import access_context_cache, get_access_context
+from shop.checks import check_partitioned_tables
+from shop.models import (
+    User, StatusGroup, OrderStatus, Order, OrderItem, Product, Manufacturer, DailySales, RepricingJob,
+)
+from shop.management.commands.advise_indexes import Candidate, parse_query_log
+from shop.management.commands.benchmark_order_filters import Command as BenchmarkCommand
+from shop.parallel import get_partitions
+from shop.factories import UserFactory, ManufacturerFactory, ProductFactory, OrderFactory, OrderItemFactory
+from shop.response_cache import get_or_compute
+from shop.serializers import OrderSerializer, OrderValuesSerializer
+from shop.views import OrderExportView, OrderFilter, OrderView
+
+orderitem_partitions = importlib.import_module('shop.migrations.0007_orderitem_hash_partitions')
 
 
 class ShopAbstractTestCase(TestCase):
@@ -20,18 +59,23 @@ class ShopAbstractTestCase(TestCase):
         OrderStatus.objects.create(name='in work', group=st_group_in_process)
         OrderStatus.objects.create(name='closed', group=st_group_finished)
 
-        ManufacturerFactory.create_batch(10)
-        ProductFactory.create_batch(30)
-        OrderFactory.create_batch(15)
+        ManufacturerFactory.create_bulk(10)
+        ProductFactory.create_bulk(30)
+        OrderFactory.create_bulk(15)
 
         cls.user = User.objects.create()
         cls.user.allowed_groups.add(st_group_in_process)
         cls.user.favorite_manufactures.set(Manufacturer.objects.all()[:5])
 
+    def setUp(self):
+        # test transactions are rolled back without m2m_changed signals
+        access_context_cache.clear()
+        cache.clear()
+
 
-class OrderViewTestCase(ShopAbstractTestCase):
+class OrderViewTestCase(QueryGuardTestMixin, ShopAbstractTestCase):
     def test_pagination(self):
-        OrderFactory.create_batch(30)
+        OrderFactory.create_bulk(30)
         response = self.client.get(self.url, {
             'user': self.user.id,
             'page_size': 10,
@@ -42,6 +86,131 @@ class OrderViewTestCase(ShopAbstractTestCase):
         response3 = self.client.get(response2.data['previous'])
         self.assertEqual(response3.status_code, status.HTTP_200_OK)
 
+    def assertKeysetPagination(self, ordering, order_by):
+        expected = list(Order.objects.filter(
+            status__group__in=self.user.allowed_groups.values('id'),
+        ).order_by(*order_by).values_list('id', flat=True))
+
+        params = {'user': self.user.id, 'page_size': 4}
+        if ordering:
+            params['ordering'] = ordering
+        response = self.client.get(self.url, params)
+        ids = [order['id'] for order in response.data['results']]
+        pages = [response]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [order['id'] for order in response.data['results']]
+            pages.append(response)
+        self.assertEqual(ids, expected)
+
+        # and back through the previous links
+        back_ids = list(reversed(pages[-1].data['results']))
+        response = pages[-1]
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            back_ids += list(reversed(response.data['results']))
+        self.assertEqual([order['id'] for order in reversed(back_ids)], expected)
+
+    def test_keyset_pagination(self):
+        # many orders per date make created alone a non-unique cursor
+        Order.objects.update(created=date(2019, 1, 1))
+        Order.objects.filter(id__in=Order.objects.order_by('id').values('id')[:5]).update(created=date(2019, 1, 2))
+        # its slow_total_price has no items to sum
+        OrderFactory.create(gen_order_items=False, status=OrderStatus.objects.get(name='new'))
+        cases = (
+            (None, ('-created', '-id')),
+            ('created', ('created', 'id')),
+            ('-total_price', ('-total_price', '-id')),
+            ('total_price,created', ('total_price', 'created', 'id')),
+            ('total_price,-created', ('total_price', '-created', '-id')),
+            ('-slow_total_price', ('-total_price', '-id')),
+        )
+        for ordering, order_by in cases:
+            with self.subTest(ordering=ordering):
+                self.assertKeysetPagination(ordering, order_by)
+
+    @override_settings(SHOP_RESPONSE_CACHE_TTL=0)
+    def test_queries_do_not_grow_with_page_size(self):
+        OrderFactory.create_bulk(30)
+        cases = (
+            {},
+            {'serialization': 'values'},
+            {'favorite_m': True, 'ordering': '-slow_total_price'},
+            {'count': 'true', 'price_differ': True},
+        )
+        for params in cases:
+            with self.subTest(**params):
+                def get_page(page_size, params=params):
+                    return self.client.get(self.url, dict(params, user=self.user.id, page_size=page_size))
+
+                get_page(1)  # access context and count are cached
+                self.assertConstantQueries(get_page, sizes=(1, 5, 40))
+                with self.assertQueryBudget(OrderView.query_budget, repeat_threshold=1):
+                    cache.clear()
+                    access_context_cache.clear()
+                    self.client.get(self.url, dict(params, user=self.user.id, count='true'))
+
+    def test_exact_count(self):
+        response = self.client.get(self.url, {'user': self.user.id, 'count': 'true', 'page_size': 2})
+        count = Order.objects.filter(status__group__in=self.user.allowed_groups.values('id')).count()
+        self.assertEqual(response.data['count'], count)
+        self.assertTrue(response.data['count_exact'])
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_count_is_cached(self):
+        params = {'user': self.user.id, 'count': 'true', 'favorite_m': 'true'}
+        count = self.client.get(self.url, params).data['count']
+        with self.assertNumQueries(2):  # page + prefetch, no EXPLAIN or COUNT
+            response = self.client.get(self.url, dict(params, favorite_m='True', ordering='total_price'))
+        self.assertEqual(response.data['count'], count)
+
+    def test_count_without_allowed_statuses(self):
+        user = User.objects.create()
+        response = self.client.get(self.url, {'user': user.id, 'count': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['count'], response.data['count_exact']), (0, True))
+
+    def test_cached_count_follows_data_changes(self):
+        params = {'user': self.user.id, 'count': 'true'}
+        count = self.client.get(self.url, params).data['count']
+        OrderFactory.create(gen_order_items=False, status=OrderStatus.objects.get(name='new'))
+        self.assertEqual(self.client.get(self.url, dict(params, page_size=1)).data['count'], count + 1)
+
+    def test_expensive_filter_count_is_estimated(self):
+        response = self.client.get(self.url, {'user': self.user.id, 'count': 'true', 'slow_total_price__gte': 0})
+        self.assertFalse(response.data['count_exact'])
+        self.assertIsInstance(response.data['count'], int)
+
+    @override_settings(SHOP_EXACT_COUNT_THRESHOLD=0)
+    def test_large_count_is_estimated(self):
+        response = self.client.get(self.url, {'user': self.user.id, 'count': 'true'})
+        self.assertFalse(response.data['count_exact'])
+
+    def test_no_count_by_default(self):
+        response = self.client.get(self.url, {'user': self.user.id})
+        self.assertNotIn('count', response.data)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'user': self.user.id, 'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_crafted_cursor(self):
+        cases = (
+            (None, [0, 'x', 1]),
+            ('total_price', [0, 'x', 1]),
+            ('total_price', [0, None, 1]),
+            ('-slow_total_price', [0, None, 1]),
+        )
+        for ordering, data in cases:
+            with self.subTest(ordering=ordering, data=data):
+                cursor = base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+                params = {'user': self.user.id, 'cursor': cursor}
+                if ordering:
+                    params['ordering'] = ordering
+                response = self.client.get(self.url, params)
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_favorite_m_filter(self):
         response = self.client.get(self.url, {
             'user': self.user.id,
@@ -50,9 +219,25 @@ class OrderViewTestCase(ShopAbstractTestCase):
         count = Order.objects.filter(
             status__group__in=self.user.allowed_groups.values('id'),
             orderitem__product__manufacturer__in=self.user.favorite_manufactures.values('id')
-        ).count()
+        ).distinct().count()
         self.assertEqual(len(response.data['results']), count)
 
+    def test_manufacturer_filter(self):
+        manufacturer_id = Product.objects.filter(
+            orderitem__order__status__group__in=self.user.allowed_groups.values('id')
+        ).first().manufacturer_id
+        response = self.client.get(self.url, {
+            'user': self.user.id,
+            'manufacturer': manufacturer_id,
+        })
+        ids = [order['id'] for order in response.data['results']]
+        self.assertEqual(len(ids), len(set(ids)))
+        count = Order.objects.filter(
+            status__group__in=self.user.allowed_groups.values('id'),
+            orderitem__product__manufacturer=manufacturer_id,
+        ).distinct().count()
+        self.assertEqual(len(ids), count)
+
     def test_fast_total_price_lte_filter(self):
         avg_total_price = Order.objects.aggregate(avg=Avg('total_price'))['avg']
         response = self.client.get(self.url, {
@@ -101,6 +286,21 @@ class OrderViewTestCase(ShopAbstractTestCase):
         ).count()
         self.assertEqual(len(response.data['results']), count)
 
+    def test_slow_total_price_filter_with_slow_ordering(self):
+        avg_total_price = Order.objects.aggregate(avg=Avg('total_price'))['avg']
+        response = self.client.get(self.url, {
+            'user': self.user.id,
+            'slow_total_price__gte': avg_total_price,
+            'ordering': '-slow_total_price',
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_non_integer_id_filters(self):
+        for name in ('manufacturer', 'product'):
+            with self.subTest(name=name):
+                response = self.client.get(self.url, {'user': self.user.id, name: '1.5'})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_product_filter(self):
         product_id = Product.objects.filter(
             orderitem__order__status__group__in=self.user.allowed_groups.values('id')
@@ -203,6 +403,986 @@ class OrderViewTestCase(ShopAbstractTestCase):
         self.assertEqual(response.data['results'][0]['id'], first_id)
 
 
+class SearchTestCase(ShopAbstractTestCase):
+    def search_orders(self, fragment):
+        response = self.client.get(self.url, {'user': self.user.id, 'search': fragment})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {order['id'] for order in response.data['results']}
+
+    def test_order_search(self):
+        allowed = Order.objects.filter(status__group__in=self.user.allowed_groups.values('id'))
+        order = allowed.first()
+        Order.objects.filter(id=order.id).update(number='ab-Needle-42')
+        self.assertEqual(self.search_orders('needle'), {order.id})
+
+        product = Product.objects.get(id=order.product_ids[0])
+        Product.objects.filter(id=product.id).update(sku='HAYSTACK-01')
+        self.assertEqual(
+            self.search_orders('stack-0'),
+            set(allowed.filter(product_ids__contains=[product.id]).values_list('id', flat=True)),
+        )
+        self.assertEqual(self.search_orders('no such fragment'), set())
+
+        response = self.client.get(self.url, {'user': self.user.id, 'search': 'ab'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_search(self):
+        products = list(Product.objects.order_by('id')[:4])
+        for product, sku in zip(products, ('xx-part-1', 'part', 'part-100', 'part-1')):
+            Product.objects.filter(id=product.id).update(sku=sku)
+        response = self.client.get(reverse('shop:product-search'), {'search': 'PART'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([product['sku'] for product in response.data], ['part', 'part-1', 'part-100', 'xx-part-1'])
+
+        response = self.client.get(reverse('shop:product-search'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DailySalesTestCase(ShopAbstractTestCase):
+    def get_sales(self):
+        return set(DailySales.objects.exclude(items=0).values_list(
+            'day', 'manufacturer', 'status', 'items', 'revenue', 'orders'
+        ))
+
+    def assertSalesRebuilt(self):
+        sales = self.get_sales()
+        call_command('rebuild_daily_sales', workers=1, chunk_days=30, stdout=StringIO())
+        self.assertEqual(sales, self.get_sales())
+        self.assertFalse(DailySales.objects.filter(items=0).exists())
+
+    def test_incremental_maintenance(self):
+        self.assertTrue(self.get_sales())
+        self.assertSalesRebuilt()
+        order = Order.objects.order_by('id').first()
+        statuses = list(OrderStatus.objects.order_by('id'))
+        item = order.orderitem_set.order_by('id').first()
+
+        item.price += 100
+        item.save()
+        item.delete()
+        self.assertSalesRebuilt()
+
+        product = Product.objects.exclude(id__in=order.product_ids).first()
+        OrderItemFactory.build(order=order, product=product).save()
+        OrderItem.objects.bulk_add([
+            OrderItemFactory.build(order=order, product=product)
+            for product in Product.objects.exclude(id__in=order.product_ids + [product.id])[:2]
+        ])
+        self.assertSalesRebuilt()
+
+        order.refresh_from_db()
+        order.status = statuses[2]
+        order.save()
+        Order.objects.filter(id__lte=order.id + 3).update(status=statuses[1], created=date(2020, 2, 29))
+        self.assertSalesRebuilt()
+
+        OrderItem.objects.filter(order__in=Order.objects.order_by('id')[:5]).update(price=F('price') + 1)
+        OrderItem.objects.filter(product=product).delete()
+        product = Product.objects.get(id=order.product_ids[0])
+        product.manufacturer = Manufacturer.objects.exclude(id=product.manufacturer_id).first()
+        product.save()
+        self.assertSalesRebuilt()
+
+    def test_rollback(self):
+        sales = self.get_sales()
+        order = Order.objects.first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.filter(id=order.id).update(created=date(2020, 1, 1))
+            OrderItem.objects.bulk_add([OrderItemFactory.build(order=order, product_id=order.product_ids[0])])
+        self.assertEqual(self.get_sales(), sales)
+
+    def test_report(self):
+        url = reverse('shop:sales-report')
+        manufacturer = Manufacturer.objects.get(id=OrderItem.objects.first().product.manufacturer_id)
+        days = list(Order.objects.values_list('created', flat=True))
+        params = {'date_from': min(days), 'date_to': max(days)}
+        response = self.client.get(url, dict(params, manufacturer=manufacturer.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        items = OrderItem.objects.filter(product__manufacturer=manufacturer)
+        expected = items.values('order__created').annotate(
+            items=Count('id'), revenue=Sum('price'), orders=Count('order', distinct=True)
+        ).order_by('order__created')
+        self.assertEqual(
+            [(row['day'], row['items'], row['revenue'], row['orders']) for row in response.data['results']],
+            [(str(row['order__created']), row['items'], row['revenue'], row['orders']) for row in expected],
+        )
+        self.assertEqual({row['manufacturer'] for row in response.data['results']}, {manufacturer.id})
+
+        response = self.client.get(url, dict(params, status=OrderStatus.objects.first().id))
+        self.assertEqual(sum(row['items'] for row in response.data['results']),
+                         OrderItem.objects.filter(order__status=OrderStatus.objects.first()).count())
+
+        self.assertEqual(self.client.get(url, {'date_from': '2020-01-01'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'date_from': '2020-01-01', 'date_to': '2021-12-31'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RepricingTestCase(ShopAbstractTestCase):
+    def reprice(self, *args):
+        stdout = StringIO()
+        call_command('reprice_products', *args, batch_size=5, pause=0, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def assertMismatchedItemsRefreshed(self):
+        mismatched = list(Order.objects.order_by('id').values_list('mismatched_items', flat=True))
+        Order.objects.refresh_item_aggregates(fields=('mismatched_items', ))
+        self.assertEqual(list(Order.objects.order_by('id').values_list('mismatched_items', flat=True)), mismatched)
+
+    def test_percent(self):
+        manufacturer = Product.objects.first().manufacturer
+        prices = dict(Product.objects.values_list('id', 'price'))
+        self.reprice('--percent', '10', '--manufacturer', str(manufacturer.id))
+        for product in Product.objects.all():
+            if product.manufacturer_id == manufacturer.id:
+                self.assertEqual(product.price, round(prices[product.id] * 1.1))
+            else:
+                self.assertEqual(product.price, prices[product.id])
+        self.assertMismatchedItemsRefreshed()
+
+        job = RepricingJob.objects.get()
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(job.products, manufacturer.product_set.count())
+        # a finished job is not applied again
+        self.assertIn('--restart', self.reprice('--percent', '10', '--manufacturer', str(manufacturer.id)))
+        self.assertEqual(RepricingJob.objects.get().products, job.products)
+
+    def test_price_file_resume(self):
+        products = list(Product.objects.order_by('id'))
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(['sku', 'price'])
+            for product in products:
+                writer.writerow([product.sku, product.price + 1])
+            writer.writerow(['no such sku', 1])
+        self.addCleanup(os.remove, f.name)
+
+        # interrupted after the first batch
+        RepricingJob.objects.create(name='prices', last_id=products[4].id)
+        self.assertIn('Resuming', self.reprice('--file', f.name, '--job', 'prices'))
+        self.assertEqual(
+            [product.price for product in Product.objects.order_by('id')],
+            [product.price + (i >= 5) for i, product in enumerate(products)],
+        )
+        self.assertMismatchedItemsRefreshed()
+
+        with self.assertRaises(CommandError):
+            self.reprice('--manufacturer', '1')
+
+
+class ReconcileOrderTotalsTestCase(ShopAbstractTestCase):
+    def reconcile(self, **options):
+        stdout, self.stderr = StringIO(), StringIO()
+        call_command('reconcile_order_totals', workers=1, range_size=4, repair_batch_size=2,
+                     stdout=stdout, stderr=self.stderr, **options)
+        return stdout.getvalue()
+
+    @override_settings(SHOP_RESPONSE_CACHE_TTL=60)
+    def test_process_local_cache_warning(self):
+        # the default cache is locmem
+        self.reconcile(repair=True)
+        self.assertIn('SHOP_RESPONSE_CACHE is per process', self.stderr.getvalue())
+
+    def test_reconcile(self):
+        self.assertIn('15 orders checked, 0 mismatched', self.reconcile())
+        orders = list(Order.objects.order_by('id')[3:6])
+        Order.objects.filter(id__in=[order.id for order in orders]).update(total_price=F('total_price') + 7)
+
+        output = self.reconcile()
+        self.assertIn('3 mismatched, 0 repaired', output)
+        self.assertIn('order {}: total_price {}, expected {}'.format(
+            orders[0].id, orders[0].total_price + 7, orders[0].total_price
+        ), output)
+        self.assertIn('3 mismatched, 3 repaired', self.reconcile(repair=True))
+        self.assertEqual(self.stderr.getvalue(), '')
+        self.assertEqual(list(Order.objects.order_by('id')[3:6].values_list('total_price', flat=True)),
+                         [order.total_price for order in orders])
+        self.assertIn('0 mismatched', self.reconcile())
+
+
+class OrderExportViewTestCase(ShopAbstractTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.export_url = reverse('shop:order-export')
+
+    def get_export(self, **params):
+        response = self.client.get(self.export_url, dict(params, user=self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def expected_orders(self, **filters):
+        queryset = Order.objects.filter(status__group__in=self.user.allowed_groups.values('id'), **filters)
+        return OrderValuesSerializer(queryset.order_by('-created').values(*OrderValuesSerializer.order_fields)).data
+
+    def test_ndjson(self):
+        with mock.patch.object(OrderExportView, 'chunk_size', 3):
+            content = self.get_export()
+        orders = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            sorted(orders, key=lambda order: order['id']),
+            sorted(self.expected_orders(), key=lambda order: order['id']),
+        )
+
+    def test_csv(self):
+        rows = list(csv.reader(StringIO(self.get_export(export_format='csv', price_differ=True))))
+        self.assertEqual(rows[0], list(OrderExportView.csv_header))
+        expected = self.expected_orders(mismatched_items__gt=0)
+        self.assertEqual(len(rows) - 1, sum(max(len(order['items']), 1) for order in expected))
+        self.assertEqual({int(row[0]) for row in rows[1:]}, {order['id'] for order in expected})
+
+    def test_invalid_format(self):
+        response = self.client.get(self.export_url, {'user': self.user.id, 'export_format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class QueryGuardTestCase(QueryGuardTestMixin, ShopAbstractTestCase):
+    middleware = settings.MIDDLEWARE + ['mysite.query_guard.QueryGuardMiddleware']
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql('SELECT "t1"."id" FROM t1 WHERE id IN (%s, %s, %s) AND name = \'a\'\'b\' LIMIT 21'),
+            'SELECT "t1"."id" FROM t1 WHERE id IN (?) AND name = ? LIMIT ?',
+        )
+        self.assertEqual(normalize_sql('WHERE id = 1'), normalize_sql('WHERE id = 22'))
+
+    def test_repeated_shape(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(repeat_threshold=2):
+                for order in Order.objects.all()[:3]:
+                    order.status.name
+
+    @override_settings(SHOP_RESPONSE_CACHE_TTL=0)
+    def test_middleware_budget(self):
+        with override_settings(MIDDLEWARE=self.middleware, QUERY_GUARD_RAISE=True):
+            self.client.get(reverse('shop:order'), {'user': self.user.id})
+            with mock.patch.object(OrderView, 'query_budget', 1):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(reverse('shop:order'), {'user': self.user.id})
+
+    def test_middleware_logs_in_production(self):
+        with override_settings(MIDDLEWARE=self.middleware, QUERY_GUARD_RAISE=False):
+            with mock.patch.object(OrderView, 'query_budget', 1):
+                with self.assertLogs('mysite.query_guard', 'WARNING'):
+                    response = self.client.get(reverse('shop:order'), {'user': self.user.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class MetricsTestCase(ShopAbstractTestCase):
+    def setUp(self):
+        super().setUp()
+        for metric in metrics.registry:
+            metric.clear()
+
+    def test_order_view_metrics(self):
+        status_id = OrderStatus.objects.filter(group__user=self.user).first().id
+        self.client.get(self.url, {'user': self.user.id, 'favorite_m': True, 'status': status_id,
+                                   'ordering': '-total_price'})
+        self.client.get(self.url, {'user': self.user.id, 'ordering': 'number'})
+        content = self.client.get(reverse('metrics')).content.decode()
+
+        labels = 'view="OrderView",method="GET",status="200",filters="favorite_m,status",ordering="-total_price"'
+        self.assertIn('# TYPE http_request_duration_seconds histogram', content)
+        self.assertIn('http_request_duration_seconds_count{%s} 1' % labels, content)
+        self.assertIn('http_request_duration_seconds_bucket{%s,le="+Inf"} 1' % labels, content)
+        self.assertIn('http_request_db_duration_seconds_count{%s} 1' % labels, content)
+        # access context (2), status choice, page, items
+        self.assertIn('http_request_db_queries_total{%s} 5.0' % labels, content)
+        self.assertIn('http_request_serialization_seconds_total{%s}' % labels, content)
+        # orderings outside of ordering_fields don't make new series
+        self.assertIn('filters="",ordering="invalid"', content)
+        self.assertNotIn('number', content)
+
+    def test_label_values_are_bounded(self):
+        view = OrderView.as_view()
+        self.assertEqual(metrics.get_view_labels(view, {'ordering': 'created,-created,created'}),
+                         ('OrderView', '', 'created'))
+        many_filters = dict.fromkeys(['status', 'product', 'manufacturer', 'search'], '1')
+        self.assertEqual(metrics.get_view_labels(view, many_filters), ('OrderView', 'many', ''))
+        with mock.patch.object(metrics, 'MAX_LABEL_TERMS', 1):
+            self.assertEqual(metrics.get_view_labels(view, {'ordering': 'total_price,created'})[2], 'many')
+
+
+@override_settings(SHOP_RESPONSE_CACHE_TTL=60)
+class ResponseCacheTestCase(ShopAbstractTestCase):
+    def get(self, **params):
+        return self.client.get(self.url, dict(params, user=self.user.id)).content
+
+    def test_cached(self):
+        content = self.get(ordering='total_price')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(ordering='total_price'), content)
+        self.assertNotEqual(self.get(ordering='-total_price'), content)
+
+    def test_invalidated_by_writes(self):
+        order = Order.objects.filter(status__group__user=self.user).first()
+        item = order.orderitem_set.first()
+        product = item.product
+        writes = (
+            lambda: OrderItem.objects.filter(id=item.id).update(price=F('price') + 1),
+            lambda: order.save(),
+            lambda: OrderItemFactory.build(
+                order=order, product=Product.objects.exclude(id__in=order.product_ids).first(),
+            ).save(),
+            lambda: setattr(product, 'price', product.price + 1) or product.save(),
+            lambda: Order.objects.filter(id=order.id).update(delivery_price=F('delivery_price') + 1),
+        )
+        for write in writes:
+            self.get()
+            write()
+            with self.assertNumQueries(2):
+                self.get()
+
+    def test_access_context_is_a_part_of_the_key(self):
+        self.get()
+        self.user.allowed_groups.set(StatusGroup.objects.all())
+        with self.assertNumQueries(4):  # access context, page, items
+            self.get()
+
+    def test_concurrent_requests_are_coalesced(self):
+        self.assertCoalesced()
+
+    def test_file_cache_requests_are_coalesced(self):
+        # FileBasedCache.add() isn't atomic, a file lock is used
+        with tempfile.TemporaryDirectory() as cache_dir:
+            file_cache = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir}
+            with override_settings(CACHES=dict(settings.CACHES, file=file_cache), SHOP_RESPONSE_CACHE='file'):
+                self.assertCoalesced()
+                self.assertEqual([name for name in os.listdir(cache_dir) if name.endswith('.lock')], [])
+
+    def assertCoalesced(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'result': 1}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(get_or_compute('shop:test:coalesce', compute)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'result': 1}] * 5)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], DATABASE_REPLICA_MAX_LAG=5)
+class ReplicaRouterTestCase(ShopAbstractTestCase):
+    def setUp(self):
+        super().setUp()
+        routers._lags.clear()
+        self.router = routers.ReplicaRouter()
+        lags = {'replica1': 1.0, 'replica2': 30.0}
+        patcher = mock.patch('mysite.routers.measure_replica_lag', side_effect=lags.get)
+        self.measure_replica_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_outside_views_use_default(self):
+        self.assertIsNone(self.router.db_for_read(Order))
+        self.assertEqual(self.router.db_for_write(Order), 'default')
+
+    def test_lagging_replica_is_out_of_rotation(self):
+        for _ in range(10):
+            with routers.replica_reads():
+                self.assertEqual(self.router.db_for_read(Order), 'replica1')
+                self.assertEqual(self.router.db_for_read(OrderItem), 'replica1')
+        # lags are measured once per DATABASE_REPLICA_LAG_CHECK_INTERVAL
+        self.assertEqual(self.measure_replica_lag.call_count, 2)
+
+    @override_settings(DATABASE_REPLICA_LAG_CHECK_INTERVAL=0)
+    def test_no_healthy_replica(self):
+        self.measure_replica_lag.side_effect = lambda alias: None
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_read(Order), 'default')
+
+    def test_reads_after_write_stay_on_primary(self):
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_write(Order), 'default')
+            self.assertIsNone(self.router.db_for_read(Order))
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_read(Order), 'replica1')
+
+    @override_settings(DATABASE_REPLICAS=['default'], SHOP_RESPONSE_CACHE_TTL=0)
+    def test_sticky_cookie(self):
+        self.measure_replica_lag.side_effect = lambda alias: 0.0
+        self.client.get(self.url, {'user': self.user.id})
+        self.assertEqual(self.measure_replica_lag.call_count, 1)
+
+        self.client.cookies[routers.STICKY_COOKIE] = '1'
+        routers._lags.clear()
+        self.client.get(self.url, {'user': self.user.id})
+        # reads went to the primary, replicas weren't even checked
+        self.assertEqual(self.measure_replica_lag.call_count, 1)
+
+    @override_settings(DATABASE_REPLICAS=['default'])
+    def test_sticky_cookie_is_set_after_writes(self):
+        self.measure_replica_lag.side_effect = lambda alias: 0.0
+
+        def write(request):
+            with routers.replica_reads():
+                StatusGroup.objects.filter(name='in process').update(name='in process')
+            return HttpResponse()
+
+        def fail_write(request):
+            write(request)
+            return HttpResponse(status=400)
+
+        cases = (
+            ('post', write, True),
+            ('post', fail_write, False),
+            ('post', lambda request: HttpResponse(), False),
+            ('get', write, False),
+        )
+        for method, view, sticky in cases:
+            with self.subTest(method=method, view=view):
+                response = routers.PrimaryStickinessMiddleware(view)(getattr(RequestFactory(), method)('/'))
+                self.assertEqual(routers.STICKY_COOKIE in response.cookies, sticky)
+
+        # a POST without writes, e.g. a 405
+        response = self.client.post('{}?user={}'.format(self.url, self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        self.assertNotIn(routers.STICKY_COOKIE, response.cookies)
+
+    @override_settings(DATABASE_REPLICAS=['default'], SHOP_RESPONSE_CACHE_TTL=0)
+    def test_view_reads_from_replica(self):
+        self.measure_replica_lag.side_effect = lambda alias: 0.0
+        with mock.patch.object(routers, 'get_healthy_replicas', wraps=routers.get_healthy_replicas) as healthy:
+            response = self.client.get(self.url, {'user': self.user.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        healthy.assert_called_once_with()
+
+    @override_settings(DATABASE_REPLICAS=['default'], SHOP_RESPONSE_CACHE_TTL=60)
+    def test_cached_response_is_read_from_primary(self):
+        self.measure_replica_lag.side_effect = lambda alias: 0.0
+        get_access_context(self.user.id)  # cached apart, it may come from a replica
+        with mock.patch.object(routers, 'get_healthy_replicas', wraps=routers.get_healthy_replicas) as healthy:
+            response = self.client.get(self.url, {'user': self.user.id, 'count': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        healthy.assert_not_called()
+
+
+class ReplicaLagTestCase(TestCase):
+    def test_primary_lag(self):
+        self.assertEqual(routers.measure_replica_lag('default'), 0)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def make_pool(self, **options):
+        params = connection.get_connection_params()
+        pool = ConnectionPool(lambda: DatabaseWrapper.Database.connect(**params), **options)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_reuse(self):
+        pool = self.make_pool(min_size=1)
+        first = pool.get()
+        pool.put(first)
+        self.assertIs(pool.get(), first)
+        self.assertEqual(pool.utilization()['created'], 1)
+        self.assertEqual(pool.utilization()['in_use'], 1)
+
+    def test_recycle_after_max_uses(self):
+        pool = self.make_pool(max_uses=2)
+        first = pool.get()
+        pool.put(first)
+        self.assertIs(pool.get(), first)
+        pool.put(first)
+        self.assertTrue(first.closed)
+        self.assertIsNot(pool.get(), first)
+        self.assertEqual(pool.utilization()['recycled'], 1)
+
+    def test_health_check_on_borrow(self):
+        pool = self.make_pool(check_after=0)
+        first = pool.get()
+        pool.put(first)
+        first.close()
+        second = pool.get()
+        self.assertIsNot(second, first)
+        self.assertEqual(pool.utilization()['failed_checks'], 1)
+        self.assertEqual(pool.utilization()['size'], 1)
+
+    def test_transaction_is_rolled_back_on_put(self):
+        pool = self.make_pool()
+        conn = pool.get()
+        conn.cursor().execute('SELECT 1')
+        self.assertEqual(conn.get_transaction_status(), extensions.TRANSACTION_STATUS_INTRANS)
+        pool.put(conn)
+        self.assertEqual(conn.get_transaction_status(), extensions.TRANSACTION_STATUS_IDLE)
+
+    def test_checkout_timeout(self):
+        pool = self.make_pool(max_size=1, timeout=0.05)
+        pool.get()
+        with self.assertRaises(PoolTimeout):
+            pool.get()
+        self.assertEqual(pool.utilization()['timeouts'], 1)
+
+    def test_threads_wait_for_connections(self):
+        pool = self.make_pool(max_size=2)
+        errors = []
+
+        def work():
+            try:
+                conn = pool.get()
+                time.sleep(0.02)
+                pool.put(conn)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(pool.utilization()['created'], 2)
+        self.assertEqual(pool.utilization()['checkouts'], 6)
+
+
+class PooledBackendTestCase(TransactionTestCase):
+    def test_connections_are_reused(self):
+        connection.close()
+        Order.objects.count()
+        connection_id = id(connection.connection)
+        stats = pool_utilization()[connection.alias, connection.settings_dict['NAME']]
+        connection.close()
+        Order.objects.count()
+        self.assertEqual(id(connection.connection), connection_id)
+        new_stats = pool_utilization()[connection.alias, connection.settings_dict['NAME']]
+        self.assertEqual(new_stats['checkouts'], stats['checkouts'] + 1)
+        self.assertEqual(new_stats['created'], stats['created'])
+
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('db_pool_connections{alias="default",database="%s",state="in_use"}'
+                      % connection.settings_dict['NAME'], content)
+
+
+class ConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        group = StatusGroup.objects.create(name='in process')
+        OrderStatus.objects.create(name='new', group=group)
+        ManufacturerFactory.create_bulk(5)
+        ProductFactory.create_bulk(10)
+        OrderFactory.create_bulk(12)
+        self.user = User.objects.create()
+        self.user.allowed_groups.add(group)
+
+    def test_run_concurrently(self):
+        def thread_name(result):
+            return lambda: (result, threading.current_thread().name)
+
+        results = run_concurrently(thread_name(1), None, thread_name(2), thread_name(3))
+        self.assertEqual([result and result[0] for result in results], [1, None, 2, 3])
+        self.assertEqual(results[0][1], threading.current_thread().name)
+        self.assertTrue(all(result[1].startswith('orm') for result in results[2:]))
+
+        with transaction.atomic():
+            results = run_concurrently(thread_name(1), thread_name(2))
+        self.assertEqual({name for result, name in results}, {threading.current_thread().name})
+
+    def test_saturated_pool(self):
+        # the pool has no free connection: tasks run in the caller, which holds one, instead of waiting
+        connection.ensure_connection()
+        pool = connection.pool
+        held = []
+        with mock.patch.object(pool, 'max_size', pool.size), no_wait():
+            while True:
+                try:
+                    held.append(pool.get())
+                except PoolTimeout:
+                    break
+        try:
+            with mock.patch.object(pool, 'max_size', pool.size):
+                results = run_concurrently(
+                    lambda: (Order.objects.count(), threading.current_thread().name),
+                    lambda: (OrderItem.objects.count(), threading.current_thread().name),
+                )
+        finally:
+            for conn in held:
+                pool.put(conn)
+        self.assertEqual(results, [
+            (Order.objects.count(), threading.current_thread().name),
+            (OrderItem.objects.count(), threading.current_thread().name),
+        ])
+        self.assertEqual(pool.utilization()['timeouts'], 0)
+
+    def test_tasks_use_caller_execute_wrappers(self):
+        with QueryCapture() as captured:
+            run_concurrently(lambda: Order.objects.count(), lambda: OrderItem.objects.count())
+        self.assertEqual(len(captured), 2)
+
+    def test_fetch_concurrently(self):
+        queryset = Order.objects.order_by('-total_price', 'id').prefetch_related(
+            Prefetch('orderitem_set', OrderItem.objects.select_related('product').order_by('id')),
+            Prefetch('orderitem_set', OrderItem.objects.filter(price__gt=F('product__price')), to_attr='overpriced'),
+            'status',
+        )[:5]
+        with QueryCapture() as captured:
+            orders = fetch_concurrently(queryset)
+        # the page once, items, overpriced items and statuses
+        self.assertEqual(len(captured), 4)
+        expected = list(queryset)
+        self.assertEqual(orders, expected)
+        with self.assertNumQueries(0):
+            for order, expected_order in zip(orders, expected):
+                self.assertEqual(
+                    [(item.id, item.product.sku) for item in order.orderitem_set.all()],
+                    [(item.id, item.product.sku) for item in expected_order.orderitem_set.all()],
+                )
+                self.assertEqual(order.overpriced, expected_order.overpriced)
+                self.assertEqual(order.status, expected_order.status)
+
+        # a single one-to-many prefetch is left to prefetch_related
+        with QueryCapture() as captured:
+            orders = fetch_concurrently(queryset.prefetch_related(None).prefetch_related('orderitem_set'))
+        self.assertEqual(len(captured), 2)
+
+    def test_benchmark_counts_concurrent_queries(self):
+        get_queryset = OrderView.get_queryset
+
+        def with_two_item_prefetches(view):
+            return get_queryset(view).prefetch_related(Prefetch('orderitem_set', to_attr='items'))
+
+        command = BenchmarkCommand()
+        with mock.patch.object(OrderView, 'get_queryset', with_two_item_prefetches):
+            result = command.run_case(self.user, {}, page_size=5, repeat=1, explain=True)
+        # the page and both item prefetches, one of them run by another thread
+        self.assertEqual(result['queries'], 3)
+        self.assertIn('Limit', result['explain'])
+
+    def call_asgi(self, path, query_string):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': query_string.encode(),
+            'headers': [(b'host', b'testserver')],
+        }
+        asyncio.get_event_loop().run_until_complete(asgi_application(scope, receive, send))
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        self.assertFalse(messages[-1]['more_body'])
+        return messages[0]['status'], messages[1:]
+
+    def test_asgi(self):
+        query_string = 'user={}&count=true'.format(self.user.id)
+        status_code, messages = self.call_asgi(reverse('shop:order'), query_string)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        data = json.loads(b''.join(message['body'] for message in messages))
+        self.assertEqual(data['count'], Order.objects.count())
+        cache.clear()
+        self.assertEqual(data, self.client.get(reverse('shop:order') + '?' + query_string).json())
+
+        with mock.patch.object(OrderExportView, 'chunk_size', 5):
+            status_code, messages = self.call_asgi(reverse('shop:order-export'), 'user={}'.format(self.user.id))
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        # streamed as it is produced
+        self.assertGreater(len(messages), 2)
+        lines = b''.join(message['body'] for message in messages).decode().splitlines()
+        self.assertEqual(len(lines), Order.objects.count())
+
+
+class BenchmarkCommandTestCase(ShopAbstractTestCase):
+    def test_report_and_baseline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            report_path = os.path.join(directory, 'report.json')
+            call_command(
+                'benchmark_order_filters', user=self.user.id, repeat=1, output=report_path, stderr=StringIO(),
+            )
+            with open(report_path) as f:
+                report = json.load(f)
+
+            cases = {tuple(sorted(set(result['params']) - {'page_size'})) for result in report['results'].values()}
+            for name in OrderFilter.base_filters:
+                self.assertIn((name, ), cases)
+            self.assertIn(('manufacturer', 'ordering'), cases)
+            self.assertIn('Limit', report['results']['default']['explain'])
+
+            call_command(
+                'benchmark_order_filters', user=self.user.id, repeat=1, singles=True, no_explain=True,
+                baseline=report_path, output=report_path, threshold=1000, stderr=StringIO(),
+            )
+            with open(report_path) as f:
+                self.assertEqual(json.load(f)['regressions'], [])
+
+
+class AdviseIndexesTestCase(ShopAbstractTestCase):
+    def test_advise(self):
+        with connection.cursor() as cursor:
+            # indexes can't be created with foreign key checks of the test data pending
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        with tempfile.TemporaryDirectory() as directory:
+            report_path = os.path.join(directory, 'report.json')
+            migration_path = os.path.join(directory, '0100_advised_indexes.py')
+            call_command(
+                'advise_indexes', user=self.user.id, repeat=1, min_improvement=-1000,
+                output=report_path, migration=migration_path, stderr=StringIO(),
+            )
+            with open(report_path) as f:
+                report = json.load(f)
+            with open(migration_path) as f:
+                migration = f.read()
+
+        composite = [c for c in report['candidates'] if c['kind'] == 'composite' and c['table'] == 'shop_order']
+        self.assertTrue(any('(status_id, ' in candidate['sql'] for candidate in composite))
+        for candidate in report['candidates']:
+            self.assertIn('before_ms', candidate)
+            self.assertIn('after_ms', candidate)
+        # candidates are dropped after the measurement
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_indexes WHERE indexname = ANY(%s)",
+                           [[candidate['name'] for candidate in report['candidates']]])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+        compile(migration, migration_path, 'exec')
+        self.assertIn(repr(MigrationLoader(connection).graph.leaf_nodes('shop')[0]), migration)
+        for name in report['recommended']:
+            self.assertIn('CREATE INDEX CONCURRENTLY {} '.format(name), migration)
+
+    def test_query_log(self):
+        log = (
+            '2026-10-18 12:00:00 UTC [1] LOG:  duration: 1.5 ms  statement: SELECT 1 FROM shop_order\n'
+            '2026-10-18 12:00:01 UTC [1] LOG:  statement: UPDATE shop_order SET total_price = 0\n'
+        )
+        self.assertEqual(parse_query_log(log), ['SELECT 1 FROM shop_order'])
+        self.assertEqual(parse_query_log('SELECT 1;\nSELECT 2;\n'), ['SELECT 1', 'SELECT 2'])
+
+    def test_partitioned_migration_sql(self):
+        candidate = Candidate('composite', 'shop_orderitem', ['product_id'], include=['order_id'])
+        forward, reverse = candidate.migration_sql(['shop_orderitem_p0', 'shop_orderitem_p1'])
+        self.assertEqual(forward[0], 'CREATE INDEX {} ON ONLY shop_orderitem (product_id) INCLUDE (order_id)'.format(
+            candidate.name))
+        self.assertEqual(forward[1], 'CREATE INDEX CONCURRENTLY {}_p0 ON shop_orderitem_p0 (product_id) '
+                                     'INCLUDE (order_id)'.format(candidate.name))
+        self.assertEqual(forward[-1], 'ALTER INDEX {0} ATTACH PARTITION {0}_p1'.format(candidate.name))
+        self.assertEqual(reverse, ['DROP INDEX IF EXISTS {}'.format(candidate.name)])
+
+
+class FillShopDbTestCase(TransactionTestCase):
+    def fill(self, **options):
+        call_command('fill_shop_db', scale=0.0002, interactive=False, stdout=StringIO(), **options)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT sum(total_price), sum(mismatched_items), md5(string_agg(number, \',\' ORDER BY id)) '
+                           'FROM shop_order')
+            return cursor.fetchone()
+
+    def test_fill(self):
+        checksum = self.fill(workers=2, seed=7)
+
+        self.assertEqual(Manufacturer.objects.count(), 1)
+        self.assertEqual(Product.objects.count(), 600)
+        self.assertEqual(Order.objects.count(), 200)
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(OrderItem.objects.order_by().values('order', 'product').distinct().count(),
+                         OrderItem.objects.count())
+
+        for order in Order.objects.annotate(items_price=Sum('orderitem__price')):
+            self.assertEqual(order.total_price, order.items_price + order.delivery_price)
+        expected_mismatched = list(Order.objects.order_by('id').values_list('mismatched_items', flat=True))
+        expected_product_ids = list(Order.objects.order_by('id').values_list('product_ids', flat=True))
+        Order.objects.refresh_item_aggregates()
+        self.assertEqual(list(Order.objects.order_by('id').values_list('mismatched_items', flat=True)),
+                         expected_mismatched)
+        self.assertEqual(list(Order.objects.order_by('id').values_list('product_ids', flat=True)),
+                         expected_product_ids)
+
+        # indexes and constraints are restored
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_indexes WHERE tablename = 'shop_order'")
+            self.assertGreaterEqual(cursor.fetchone()[0], 7)
+            # attached to the indexes and constraints of the partitioned table
+            cursor.execute("SELECT indexrelid::regclass::text, indisvalid FROM pg_index "
+                           "WHERE indrelid = 'shop_orderitem'::regclass")
+            indexes = dict(cursor.fetchall())
+            self.assertIn('shop_orderitem_pkey', indexes)
+            self.assertTrue(all(indexes.values()))
+            cursor.execute("SELECT count(*) FROM pg_constraint WHERE conrelid = 'shop_orderitem'::regclass")
+            self.assertEqual(cursor.fetchone()[0], 4)
+            cursor.execute("SELECT count(*) FROM pg_index I JOIN pg_inherits P ON P.inhrelid = I.indrelid "
+                           "WHERE P.inhparent = 'shop_orderitem'::regclass")
+            self.assertEqual(cursor.fetchone()[0], len(indexes) * orderitem_partitions.PARTITIONS)
+        # the rollup is rebuilt after the load
+        self.assertEqual(DailySales.objects.aggregate(items=Sum('items'))['items'], OrderItem.objects.count())
+        # sequences continue after the loaded ids
+        order = Order.objects.first()
+        OrderItemFactory.build(order=order, product=Product.objects.exclude(id__in=order.product_ids).first()).save()
+
+        # the same data for the same seed, whatever the number of workers
+        self.assertEqual(self.fill(workers=1, seed=7), checksum)
+        self.assertNotEqual(self.fill(workers=1, seed=8), checksum)
+
+    def test_failed_load_restores_indexes(self):
+        def count_constraints():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_constraint WHERE conrelid IN "
+                               "('shop_order'::regclass, 'shop_orderitem'::regclass)")
+                return cursor.fetchone()[0]
+
+        constraints = count_constraints()
+        with mock.patch('shop.management.commands.fill_shop_db.load_orders', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.fill(workers=1)
+        self.assertEqual(count_constraints(), constraints)
+
+
+class OrderItemPartitionsTestCase(TestCase):
+    def test_partitions(self):
+        partitions = get_partitions(OrderItem._meta.db_table)
+        self.assertEqual(len(partitions), orderitem_partitions.PARTITIONS)
+
+        ManufacturerFactory()
+        product = ProductFactory()
+        OrderStatus.objects.create(name='', group=StatusGroup.objects.create(name=''))
+        order = OrderFactory(gen_order_items=False)
+        OrderItemFactory(order=order, product=product)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            OrderItemFactory(order=order, product=product)
+
+        # queries by order read a single partition
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN SELECT * FROM shop_orderitem WHERE order_id = %s', [order.id])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertEqual(sum(partition in plan.split() for partition in partitions), 1)
+
+    def test_items_are_written_by_id_and_order(self):
+        ManufacturerFactory()
+        product = ProductFactory()
+        OrderStatus.objects.create(name='', group=StatusGroup.objects.create(name=''))
+        item = OrderItemFactory(order=OrderFactory(gen_order_items=False), product=product)
+        item = OrderItem.objects.get(id=item.id)
+        with QueryCapture() as captured:
+            item.order = OrderFactory(gen_order_items=False)
+            item.save()
+            item.delete()
+        writes = [sql for sql in captured.queries if sql.startswith(('UPDATE "shop_orderitem"', 'DELETE'))]
+        self.assertEqual(len(writes), 2)
+        # id alone isn't unique-indexed, the partition is found by order_id
+        self.assertTrue(all('"shop_orderitem"."order_id" = ' in sql for sql in writes))
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_backend_check(self):
+        self.assertEqual(check_partitioned_tables(None), [])
+        with mock.patch.object(connection.introspection, 'lists_partitioned_tables', False):
+            self.assertEqual([error.id for error in check_partitioned_tables(None)], ['shop.E001'])
+
+    def test_maintain_partitions(self):
+        stdout = StringIO()
+        call_command('maintain_partitions', analyze=True, reindex=True, workers=1, stdout=stdout)
+        self.assertIn('ANALYZE shop_orderitem_p0', stdout.getvalue())
+        self.assertIn('REINDEX TABLE shop_orderitem_p0', stdout.getvalue())
+
+
+class OrderItemPartitionsMigrationTestCase(TransactionTestCase):
+    def setUp(self):
+        group = StatusGroup.objects.create(name='in process')
+        OrderStatus.objects.create(name='new', group=group)
+        ManufacturerFactory.create_bulk(3)
+        ProductFactory.create_bulk(5)
+        OrderFactory.create_bulk(10)
+
+    def rebuild(self, fail_on=None):
+        def interrupt(execute, sql, params, many, context):
+            if fail_on and sql.startswith(fail_on[0]):
+                fail_on[1] -= 1
+                if not fail_on[1]:
+                    raise DatabaseError('interrupted')
+            return execute(sql, params, many, context)
+
+        schema_editor = mock.Mock(connection=connection)
+        with connection.execute_wrapper(interrupt):
+            orderitem_partitions.rebuild_orderitem_table(schema_editor, orderitem_partitions.PARTITIONS)
+
+    def test_interrupted_rebuild_is_resumed(self):
+        items = list(OrderItem.objects.order_by('id').values_list('id', 'order_id', 'product_id', 'price'))
+        cases = (
+            ['INSERT', 2],  # during the copy
+            ['DROP TABLE', 1],  # the copy is done
+        )
+        for fail_on in cases:
+            with self.subTest(fail_on=fail_on[0]):
+                with mock.patch.object(orderitem_partitions, 'BATCH_SIZE', 3), self.assertRaisesMessage(DatabaseError, 'interrupted'):
+                    self.rebuild(fail_on)
+                with mock.patch.object(orderitem_partitions, 'BATCH_SIZE', 3):
+                    self.rebuild()
+                self.assertEqual(
+                    list(OrderItem.objects.order_by('id').values_list('id', 'order_id', 'product_id', 'price')),
+                    items,
+                )
+                self.assertEqual(len(get_partitions(OrderItem._meta.db_table)), orderitem_partitions.PARTITIONS)
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_get_constraintdef(oid) FROM pg_constraint "
+                                   "WHERE conrelid = 'shop_orderitem'::regclass AND contype = 'p'")
+                    self.assertEqual(cursor.fetchone()[0], 'PRIMARY KEY (id, order_id)')
+                    self.assertFalse(orderitem_partitions.table_exists(cursor, 'shop_orderitem_old'))
+
+    def test_requires_partition_aware_backend(self):
+        with mock.patch.object(connection.introspection, 'lists_partitioned_tables', False):
+            with self.assertRaises(RuntimeError):
+                self.rebuild()
+
+
+class AccessContextTestCase(ShopAbstractTestCase):
+    def test_context(self):
+        context = get_access_context(self.user.id)
+        self.assertEqual(
+            set(context.status_ids),
+            set(OrderStatus.objects.filter(group__user=self.user).values_list('id', flat=True)),
+        )
+        self.assertEqual(
+            set(context.favorite_manufacturer_ids),
+            set(self.user.favorite_manufactures.values_list('id', flat=True)),
+        )
+
+    def test_context_is_cached(self):
+        get_access_context(self.user.id)
+        with self.assertNumQueries(0):
+            get_access_context(self.user.id)
+
+    def test_unknown_user(self):
+        with self.assertRaises(User.DoesNotExist):
+            get_access_context(self.user.id + 1)
+
+    def test_user_without_groups(self):
+        user = User.objects.create()
+        context = get_access_context(user.id)
+        self.assertEqual(context.status_ids, ())
+        response = self.client.get(self.url, {'user': user.id})
+        self.assertEqual(response.data['results'], [])
+
+    def test_allowed_groups_change_invalidates(self):
+        get_access_context(self.user.id)
+        self.user.allowed_groups.set(StatusGroup.objects.all())
+        self.assertEqual(len(get_access_context(self.user.id).status_ids), OrderStatus.objects.count())
+
+    def test_reverse_allowed_groups_change_invalidates(self):
+        get_access_context(self.user.id)
+        StatusGroup.objects.get(name='finished').user_set.add(self.user)
+        self.assertEqual(len(get_access_context(self.user.id).status_ids), OrderStatus.objects.count())
+
+    def test_favorite_manufactures_change_invalidates(self):
+        get_access_context(self.user.id)
+        self.user.favorite_manufactures.clear()
+        self.assertEqual(get_access_context(self.user.id).favorite_manufacturer_ids, ())
+
+    @override_settings(SHOP_RESPONSE_CACHE_TTL=0)
+    def test_view_reuses_context(self):
+        self.client.get(self.url, {'user': self.user.id})
+        with self.assertNumQueries(2):  # page + orderitem_set prefetch
+            self.client.get(self.url, {'user': self.user.id})
+
+
 class OrderSaveModelTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -220,6 +1400,16 @@ class OrderSaveModelTestCase(TestCase):
         order.refresh_from_db()
         self.assertEqual(order.total_price, 40)
 
+    def test_update_delivery_price_single_query(self):
+        order = OrderFactory(gen_order_items=False, delivery_price=30)
+        OrderItemFactory.build(order=order).save()
+        order.refresh_from_db()
+        items_price = order.total_price - 30
+        order.delivery_price = 10
+        with self.assertNumQueries(1):
+            order.save()
+        self.assertEqual(order.total_price, items_price + 10)
+
 
 class OrderItemSaveModelTestCase(TestCase):
     @classmethod
@@ -250,9 +1440,248 @@ class OrderItemSaveModelTestCase(TestCase):
         self.order.refresh_from_db()
         self.assertEqual(self.order.total_price, old_price + item.price)
 
+    def test_item_delete_and_move(self):
+        old_price = self.order.total_price
+        items = [OrderItemFactory.build(order=self.order, product=product) for product in Product.objects.all()]
+        OrderItem.objects.bulk_add(items)
+        items[0].delete()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total_price, old_price + items[1].price + items[2].price)
+
+        other = OrderFactory.create(gen_order_items=False)
+        OrderItem.objects.filter(id=items[1].id).update(order=other)
+        OrderItem.objects.filter(id=items[2].id).update(price=F('price') + 5)
+        self.order.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.order.total_price, old_price + items[2].price + 5)
+        self.assertEqual(other.total_price, other.delivery_price + items[1].price)
+        OrderItem.objects.filter(order=self.order).delete()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total_price, old_price)
+
+
+class OrderTotalTriggersTestCase(TransactionTestCase):
+    def test_concurrent_writers(self):
+        ManufacturerFactory.create()
+        ProductFactory.create_batch(20)
+        OrderStatus.objects.create(name='', group=StatusGroup.objects.create(name=''))
+        order = OrderFactory.create(gen_order_items=False, delivery_price=10)
+        products = list(Product.objects.all())
+
+        def add_items(products):
+            try:
+                for product in products:
+                    OrderItem(order_id=order.id, product=product, price=3).save()
+                    Order.objects.filter(id=order.id).update(delivery_price=F('delivery_price') + 1)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add_items, args=(products[i::4], )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        order.refresh_from_db()
+        self.assertEqual(order.delivery_price, 30)
+        self.assertEqual(order.total_price, 30 + 3 * 20)
+
+
+class OrderItemBulkAddTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ManufacturerFactory.create_batch(3)
+        ProductFactory.create_batch(10)
+        OrderStatus.objects.create(name='', group=StatusGroup.objects.create(name=''))
+        cls.orders = OrderFactory.create_batch(2, gen_order_items=False)
+
+    def test_bulk_add(self):
+        products = list(Product.objects.order_by('id'))
+        items = [
+            OrderItemFactory.build(order=order, product=product)
+            for order in self.orders for product in products
+        ]
+        # savepoint, sales before, insert (totals by the trigger), aggregates update, sales update, release
+        with self.assertNumQueries(6):
+            OrderItem.objects.bulk_add(items)
+
+        self.assertTrue(all(item.pk for item in items))
+        for order in self.orders:
+            order.refresh_from_db()
+            self.assertEqual(
+                order.total_price,
+                order.delivery_price + sum(item.price for item in items if item.order_id == order.id),
+            )
+            self.assertEqual(order.product_ids, [product.id for product in products])
+
+    def test_bulk_add_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(OrderItem.objects.bulk_add([]), [])
+
+
+class OrderItemAggregatesTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ManufacturerFactory.create_batch(3)
+        ProductFactory.create_batch(3)
+        OrderStatus.objects.create(name='', group=StatusGroup.objects.create(name=''))
+        cls.order = OrderFactory.create(gen_order_items=False)
+        cls.products = list(Product.objects.order_by('id'))
+
+    def assertAggregates(self, products):
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.product_ids, sorted(p.id for p in products))
+        self.assertEqual(self.order.manufacturer_ids, sorted({p.manufacturer_id for p in products}))
+
+    def test_item_creation(self):
+        self.assertAggregates([])
+        OrderItemFactory.build(order=self.order, product=self.products[0]).save()
+        OrderItemFactory.build(order=self.order, product=self.products[1]).save()
+        self.assertAggregates(self.products[:2])
+
+    def test_item_delete(self):
+        item = OrderItemFactory.build(order=self.order, product=self.products[0])
+        item.save()
+        OrderItemFactory.build(order=self.order, product=self.products[1]).save()
+        item.delete()
+        self.assertAggregates(self.products[1:2])
+
+    def test_mismatched_items(self):
+        item = OrderItemFactory.build(order=self.order, product=self.products[0])
+        item.price = self.products[0].price
+        item.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mismatched_items, 0)
+        item.price += 10
+        item.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mismatched_items, 1)
+
+    def test_product_price_change_updates_mismatched_items(self):
+        product = self.products[0]
+        item = OrderItemFactory.build(order=self.order, product=product)
+        item.price = product.price
+        item.save()
+        product.price += 10
+        product.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mismatched_items, 1)
+        product.price -= 10
+        product.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mismatched_items, 0)
+
+    def test_product_manufacturer_change_updates_manufacturer_ids(self):
+        # not self.products[0], changing it would leak into the other tests
+        product = Product.objects.get(id=self.products[0].id)
+        OrderItemFactory.build(order=self.order, product=product).save()
+        product.manufacturer = Manufacturer.objects.exclude(id=product.manufacturer_id).first()
+        product.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.manufacturer_ids, [product.manufacturer_id])
+        self.assertEqual(Order.objects.filter(manufacturer_ids__contains=[product.manufacturer_id]).count(), 1)
+
+    def test_rebuild_mismatched_items_command(self):
+        product = self.products[0]
+        item = OrderItemFactory.build(order=self.order, product=product)
+        item.price = product.price + 1
+        item.save()
+        Order.objects.update(mismatched_items=0)
+        call_command('rebuild_mismatched_items', stdout=StringIO())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mismatched_items, 1)
+
+    def test_queryset_update(self):
+        items = [OrderItemFactory.build(order=self.order, product=product) for product in self.products[:2]]
+        OrderItem.objects.bulk_add(items)
+        OrderItem.objects.filter(id=items[0].id).update(price=self.products[0].price + 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mismatched_items, 1 + (items[1].price != self.products[1].price))
+
+        OrderItem.objects.filter(id=items[1].id).update(product=self.products[2])
+        self.assertAggregates([self.products[0], self.products[2]])
+        other = OrderFactory.create(gen_order_items=False)
+        OrderItem.objects.filter(id=items[1].id).update(order=other)
+        self.assertAggregates(self.products[:1])
+        other.refresh_from_db()
+        self.assertEqual(other.product_ids, [self.products[2].id])
+
+    def test_queryset_delete(self):
+        for product in self.products:
+            OrderItemFactory.build(order=self.order, product=product).save()
+        OrderItem.objects.filter(product__in=self.products[:2]).delete()
+        self.assertAggregates(self.products[2:])
+
+
+class FactoriesTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        StatusGroup.objects.create(name='in process')
+        OrderStatus.objects.create(name='new', group=StatusGroup.objects.create(name='finished'))
+        ManufacturerFactory.create_bulk(5)
+        ProductFactory.create_bulk(20)
+
+    def test_create_bulk(self):
+        # statuses, products, savepoint, orders, created dates, items, sales, release
+        with self.assertNumQueries(8):
+            orders = OrderFactory.create_bulk(10)
+        self.assertEqual(Order.objects.count(), 10)
+        self.assertTrue(all(3 <= len(order.product_ids) <= 10 for order in orders))
+
+        created = {order.id: order.created for order in orders}
+        self.assertEqual(dict(Order.objects.values_list('id', 'created')), created)
+        self.assertTrue(all(day < date.today() for day in created.values()))
+
+        for order in Order.objects.annotate(items_price=Sum('orderitem__price')):
+            self.assertEqual(order.total_price, order.items_price + order.delivery_price)
+        expected = list(Order.objects.order_by('id').values_list(*Order.item_aggregate_fields))
+        Order.objects.refresh_item_aggregates()
+        self.assertEqual(list(Order.objects.order_by('id').values_list(*Order.item_aggregate_fields)), expected)
+
+    def test_create_bulk_without_items(self):
+        orders = OrderFactory.create_bulk(3, gen_order_items=False)
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual([order.total_price for order in orders], [order.delivery_price for order in orders])
+
+    def test_user_create_bulk(self):
+        users = UserFactory.create_bulk(3)
+        for user in users:
+            self.assertTrue(1 <= user.favorite_manufactures.count() <= 5)
+            self.assertTrue(1 <= user.allowed_groups.count() <= 2)
+
 
 class OrderSerializerTestCase(ShopAbstractTestCase):
     def test_serializer(self):
         order = Order.objects.first()
         serializer = OrderSerializer(instance=order)
-        serializer.data
\ No newline at end of file
+        serializer.data
+
+    def test_values_serializer_output_is_identical(self):
+        cases = (
+            {},
+            {'ordering': 'total_price'},
+            {'ordering': '-slow_total_price'},
+            {'favorite_m': True, 'ordering': 'created'},
+        )
+        for params in cases:
+            with self.subTest(**params):
+                params = dict(params, user=self.user.id, page_size=5)
+                response = self.client.get(self.url, dict(params, serialization='model'))
+                fast_response = self.client.get(self.url, dict(params, serialization='values'))
+                # links differ only by the serialization parameter
+                self.assertEqual(fast_response.content.replace(b'=values', b'=model'), response.content)
+                # and the second page, reached through a cursor built from values rows
+                self.assertEqual(
+                    self.client.get(fast_response.data['next']).content.replace(b'=values', b'=model'),
+                    self.client.get(response.data['next']).content,
+                )
+
+    def test_values_serializer_queries(self):
+        self.client.get(self.url, {'user': self.user.id})
+        with self.assertNumQueries(2):  # orders page + items of the page
+            self.client.get(self.url, {'user': self.user.id, 'serialization': 'values'})
+
+    @override_settings(SHOP_ORDER_SERIALIZATION='values')
+    def test_values_serialization_setting(self):
+        response = self.client.get(self.url, {'user': self.user.id})
+        self.assertIsInstance(response.data['results'][0], dict)
+        self.assertNotIsInstance(response.data['results'][0], OrderedDict)
\ No newline at end of file
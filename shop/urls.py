@@ -5,4 +5,7 @@ from . import views
 app_name = 'shop'
 urlpatterns = [
     path('', views.OrderView.as_view(), name='order'),
+    path('export/', views.OrderExportView.as_view(), name='order-export'),
+    path('sales/', views.SalesReportView.as_view(), name='sales-report'),
+    path('products/', views.ProductSearchView.as_view(), name='product-search'),
 ]
@@ -1,11 +1,30 @@
-from django.db.models import F, Sum, Q
+import csv
+import json
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+
+from django import forms
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import F, Func, IntegerField, Sum, Subquery, Q, Prefetch
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
 from rest_framework.filters import OrderingFilter
 from rest_framework.generics import ListAPIView
 from django_filters import rest_framework as filters
-from rest_framework.pagination import PageNumberPagination, CursorPagination
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
-from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Product, Manufacturer
+from mysite.concurrency import run_concurrently
+from mysite.metrics import serialization_timer
+from mysite.routers import ReplicaReadMixin, iter_with_replica_reads, primary_reads
+from shop.access import get_access_context
+from shop.counting import get_result_count, make_count_cache_key
+from shop.models import User, StatusGroup, Order, OrderItem, Product, Manufacturer, DailySales
+from shop.pagination import KeysetCursorPagination
+from shop.response_cache import get_or_compute, make_response_cache_key
 
 # Написать Viewset, который отображает список заказов.
 # Заказы должны быть отфильтрованы по группе статусов заказов, с которыми работает этот пользователь.
@@ -24,24 +43,36 @@ from shop.models import User, StatusGroup, OrderStatus, Order, OrderItem, Produc
 
 # В ответа должна быть выведена  структура заказа со вложенными объектами,
 # как в базе - OrderItem, OrderStatus
-from shop.serializers import OrderSerializer
+from shop.serializers import OrderSerializer, OrderValuesSerializer, ProductSerializer, SalesSerializer
 
 
 def annotate_queryset_with_slow_total_price(queryset):
     if 'slow_total_price' not in queryset.query.annotations:
-        return queryset.annotate(slow_total_price=Sum('orderitem__price') + F('delivery_price'))
+        # orders without items sum to NULL, which can't be a keyset cursor value
+        return queryset.annotate(slow_total_price=Coalesce(Sum('orderitem__price'), 0) + F('delivery_price'))
+    return queryset
+
+
+class IntegerFilter(filters.NumberFilter):
+    # ids: 1.5 is invalid rather than 1
+    field_class = forms.IntegerField
 
 
 class OrderFilter(filters.FilterSet):
     favorite_m = filters.BooleanFilter(method='favorite_m_filter')
     price_differ = filters.BooleanFilter(method='price_differ_filter')
-    manufacturer = filters.NumberFilter('orderitem__product__manufacturer')
-    product = filters.NumberFilter('orderitem__product')
+    # a trigram index needs at least 3 characters
+    search = filters.CharFilter(method='search_filter', min_length=3)
+    manufacturer = IntegerFilter(method='manufacturer_filter')
+    product = IntegerFilter(method='product_filter')
     fast_total_price__lte = filters.NumberFilter('total_price', lookup_expr='lte')
     fast_total_price__gte = filters.NumberFilter('total_price', lookup_expr='gte')
     slow_total_price__lte = filters.NumberFilter(method='slow_total_price_filter')
     slow_total_price__gte = filters.NumberFilter(method='slow_total_price_filter')
 
+    # filters that turn counting into a full aggregation, counts with them are estimated
+    expensive_count_filters = ('slow_total_price__lte', 'slow_total_price__gte')
+
     class Meta:
         model = Order
         fields = ('status', )
@@ -51,55 +82,244 @@ class OrderFilter(filters.FilterSet):
             return queryset
         else:
             return queryset.filter(
-                orderitem__product__manufacturer__in=
-                self.request.user.favorite_manufactures.values('id')
+                manufacturer_ids__overlap=list(self.request.access_context.favorite_manufacturer_ids)
             )
 
+    def manufacturer_filter(self, queryset, name, value):
+        return queryset.filter(manufacturer_ids__contains=[value])
+
+    def product_filter(self, queryset, name, value):
+        return queryset.filter(product_ids__contains=[value])
+
     def price_differ_filter(self, queryset, name, value):
         if value is False:
             return queryset
         else:
-            ids = queryset.order_by('id').filter(
-                ~Q(orderitem__price=F('orderitem__product__price'))
-            ).distinct('id').values('id')
-            return queryset.filter(id__in=ids)
+            # Order.mismatched_items is backed by a partial index
+            return queryset.filter(mismatched_items__gt=0)
+
+    def search_filter(self, queryset, name, value):
+        # a fragment of the order number or of an item SKU, both backed by trigram indexes
+        product_ids = Product.objects.search_sku(value)[:settings.SHOP_SEARCH_PRODUCTS_LIMIT].values('id')
+        product_ids = Func(Subquery(product_ids), function='ARRAY', output_field=ArrayField(IntegerField()))
+        return queryset.filter(Q(number__icontains=value) | Q(product_ids__overlap=product_ids))
 
     def slow_total_price_filter(self, queryset, name, value):
         queryset = annotate_queryset_with_slow_total_price(queryset)
         return queryset.filter(**{name: value})
 
 
-class OrderView(ListAPIView):
+class OrderView(ReplicaReadMixin, ListAPIView):
     queryset = Order.objects.all()
     filter_backends = (filters.DjangoFilterBackend, OrderingFilter)
     filterset_class = OrderFilter
     serializer_class = OrderSerializer
     ordering_fields = ('created', 'total_price', 'slow_total_price')
     ordering = ('-created',)
-    pagination_class = CursorPagination
-    pagination_class.page_size_query_param = 'page_size'
+    pagination_class = KeysetCursorPagination
+    # access context (when not cached), page, items of the page, ?count=true EXPLAIN and COUNT
+    query_budget = 6
 
     def perform_authentication(self, request):
-        request.user = User.objects.get(id=request.query_params['user'])
+        # allowed statuses and favorites are resolved once and cached, see shop.access
+        request.access_context = get_access_context(int(request.query_params['user']))
+        request.user = User(id=request.access_context.user_id)
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        user_allowed_statuses = OrderStatus.objects.filter(group__user=self.request.user).values('id')
+        user_allowed_statuses = self.request.access_context.status_ids
 
         if self.request.query_params.get('ordering', '').endswith('slow_total_price'):
             queryset = annotate_queryset_with_slow_total_price(queryset)
 
         return queryset.filter(status__in=user_allowed_statuses)\
             .select_related('status')\
-            .prefetch_related('orderitem_set')
+            .prefetch_related(Prefetch('orderitem_set', queryset=OrderItem.objects.order_by('id')))
+
+    def get_serializer_class(self):
+        # ?serialization=values|model, SHOP_ORDER_SERIALIZATION by default
+        serialization = self.request.query_params.get('serialization', settings.SHOP_ORDER_SERIALIZATION)
+        if serialization == 'values':
+            return OrderValuesSerializer
+        return super().get_serializer_class()
+
+    def get_result_count(self, queryset):
+        """
+        (count, is_exact) of the filtered queryset, cached per user statuses and normalized filters.
+        """
+        filterset = self.filterset_class(self.request.query_params, queryset=queryset, request=self.request)
+        filterset.is_valid()  # invalid filters were already rejected by filter_queryset
+        filters = {
+            name: value for name, value in filterset.form.cleaned_data.items()
+            if value is not None and value != ''
+        }
+        context = self.request.access_context
+        cache_key = make_count_cache_key(
+            context.status_ids,
+            context.favorite_manufacturer_ids if filters.get('favorite_m') else None,
+            filters,
+        )
+        exact_allowed = not set(filters) & set(self.filterset_class.expensive_count_filters)
+        # cached under the data version too
+        with primary_reads():
+            return get_result_count(queryset, cache_key, exact_allowed)
 
     def list(self, request, *args, **kwargs):
+        # identical requests (the user parameter included, it's in the page links) share a response
+        # until order data changes
+        if not settings.SHOP_RESPONSE_CACHE_TTL:
+            return Response(self.get_list_data(request))
+        cache_key = make_response_cache_key(request, request.access_context)
+
+        def compute():
+            # cached under the current data version, which a lagging replica may not have caught up with
+            with primary_reads():
+                return self.get_list_data(request)
+
+        return Response(get_or_compute(cache_key, compute))
+
+    def get_list_data(self, request):
         queryset = self.filter_queryset(self.get_queryset())
+        # ?count=true adds the total to the response: "count" and "count_exact" (false for an estimate)
+        count_task = None
+        if request.query_params.get('count', '').lower() in ('1', 'true'):
+            count_task = partial(self.get_result_count, queryset)
+
+        page_queryset = queryset
+        if self.get_serializer_class() is OrderValuesSerializer:
+            page_queryset = OrderValuesSerializer.prepare_queryset(queryset)
 
-        page = self.paginate_queryset(queryset)
+        # the count is independent of the page, both are queried at the same time
+        page, count = run_concurrently(partial(self.paginate_queryset, page_queryset), count_task)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+            with serialization_timer(request):
+                data = serializer.data
+            data = self.get_paginated_response(data).data
+            if count is not None:
+                data = OrderedDict([('count', count[0]), ('count_exact', count[1])] + list(data.items()))
+            return data
+
+        return self.get_serializer(page_queryset, many=True).data
+
+
+class Echo:
+    # file-like object for csv.writer, returns the line instead of buffering it
+    def write(self, value):
+        return value
+
+
+class ProductFilter(filters.FilterSet):
+    search = filters.CharFilter(method='search_filter', min_length=3, required=True)
+
+    class Meta:
+        model = Product
+        fields = ('manufacturer', )
+
+    def search_filter(self, queryset, name, value):
+        return queryset.search_sku(value)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+
+class ProductSearchView(ReplicaReadMixin, ListAPIView):
+    """
+    Products by a fragment of the SKU, ?search=, the best matches first (see ProductQuerySet.search_sku).
+    """
+    queryset = Product.objects.all()
+    filter_backends = (filters.DjangoFilterBackend, )
+    filterset_class = ProductFilter
+    serializer_class = ProductSerializer
+    pagination_class = None
+    max_results = 50
+
+    def filter_queryset(self, queryset):
+        return super().filter_queryset(queryset)[:self.max_results]
+
+
+class SalesFilter(filters.FilterSet):
+    date_from = filters.DateFilter(field_name='day', lookup_expr='gte', required=True)
+    date_to = filters.DateFilter(field_name='day', lookup_expr='lte', required=True)
+    # plain ids, validating them would cost a query each
+    manufacturer = filters.NumberFilter()
+    status = filters.NumberFilter()
+    max_days = 366
+
+    class Meta:
+        model = DailySales
+        fields = ('date_from', 'date_to', 'manufacturer', 'status')
+
+    def filter_queryset(self, queryset):
+        days = (self.form.cleaned_data['date_to'] - self.form.cleaned_data['date_from']).days + 1
+        if days > self.max_days:
+            raise ValidationError({'date_to': 'At most {} days can be requested.'.format(self.max_days)})
+        return super().filter_queryset(queryset)
+
+
+class SalesReportView(ReplicaReadMixin, ListAPIView):
+    """
+    Items, revenue and orders per day and manufacturer for ?date_from=&date_to= (see SalesFilter.max_days),
+    optionally of a ?manufacturer= or order ?status=, read from the DailySales rollup.
+    """
+    queryset = DailySales.objects.all()
+    filter_backends = (filters.DjangoFilterBackend, )
+    filterset_class = SalesFilter
+    serializer_class = SalesSerializer
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        # days of an order that lost all its items keep zero rows
+        return queryset.filter(items__gt=0).values('day', 'manufacturer').annotate(
+            total_items=Sum('items'),
+            total_revenue=Sum('revenue'),
+            total_orders=Sum('orders'),
+        ).order_by('day', 'manufacturer')
+
+
+class OrderExportView(OrderView):
+    """
+    Streams all orders matching OrderFilter as NDJSON (an order per line, same structure as OrderView)
+    or CSV (a row per order item). ?export_format=ndjson|csv
+
+    Order rows are read through a server-side cursor `chunk_size` rows at a time and the items
+    are fetched per chunk, so memory use doesn't depend on the result size.
+    """
+    pagination_class = None
+    chunk_size = 2000
+    csv_header = (
+        'id', 'created', 'number', 'delivery_price', 'status', 'total_price',
+        'item_created', 'item_product', 'item_price',
+    )
+
+    def iter_orders(self, queryset):
+        rows = OrderValuesSerializer.prepare_queryset(queryset).iterator(chunk_size=self.chunk_size)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            yield from OrderValuesSerializer(chunk, many=True).data
+
+    def iter_ndjson(self, orders):
+        for order in orders:
+            yield json.dumps(order, separators=(',', ':')) + '\n'
+
+    def iter_csv(self, orders):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.csv_header)
+        for order in orders:
+            order_columns = [order[field] for field in OrderValuesSerializer.order_fields]
+            if not order['items']:
+                yield writer.writerow(order_columns + ['', '', ''])
+            for item in order['items']:
+                yield writer.writerow(order_columns + [item['created'], item['product'], item['price']])
+
+    def list(self, request, *args, **kwargs):
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise ValidationError({'export_format': 'Expected ndjson or csv.'})
+
+        orders = iter_with_replica_reads(self.iter_orders(self.filter_queryset(self.get_queryset())))
+        if export_format == 'csv':
+            response = StreamingHttpResponse(self.iter_csv(orders), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(self.iter_ndjson(orders), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="orders.{}"'.format(export_format)
+        return response